@@ -1,114 +1,129 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
-import json
-import subprocess
 import os
-import errno
-import sys
-import signal
-import time
-import pathlib
-from multiprocessing.connection import Listener
-from multiprocessing.connection import Client
 
-import octoprint.plugin
+from .serialPrinter import serial_printer
+from .serialSupervisor import SessionSupervisor
+from .serialPorts import PortInventory
 
-class serial_printer(object):
-    def __init__(self, comm_instance, port, baudrate, read_timeout):
-        self.comm_instance = comm_instance
-        self.port = port
-        self.baudrate = baudrate
-        self.read_timeout = read_timeout
-        
-        # Get permission firsthand (so that timeouts in communication with serialDaemon do not get triggered by the user taking time to press "yes" on the permission popup)
-        subprocess.check_output(['termux-usb', '-r', port])
+import flask
+import octoprint.plugin
+from octoprint.access.permissions import Permissions
+from octoprint.events import Events
+from octoprint.filemanager.destinations import FileDestinations
 
-        # OOPI = Octoprint Out Printer In   
-        self.OOPIaddress = ('localhost', 6000)     # family is deduced to be 'AF_INET'
-        self.OOPIlistener = Listener(self.OOPIaddress, authkey=b'secret password')
-        self.OOPIlistener._listener._socket.settimeout(3)
-        
-        # Start the Daemon, so that it can attach to OOPIlistener, and open a OIPOlistener
-        cdcDaemonpath = str(pathlib.Path(__file__).parent.absolute() / pathlib.Path("serialDaemon.py"))
-        self.fd_env = os.environ.copy()
-        self.fd_env["TERMUX_CDC_ACM_BAUDRATE"] = str(baudrate)
-        self.fd_proc = subprocess.Popen("termux-usb -e "+cdcDaemonpath+" "+port, shell=True, env=self.fd_env, preexec_fn=os.setsid) 
-        
-        # Accept OOPI connection from Daemon
-        self.OOPIconn = self.OOPIlistener.accept()
-        
-        # Connect to Daemon's OIPOlistener
-        self.OIPOaddress = ('localhost', 6001)
-        self.OIPOconn = Client(self.OIPOaddress, authkey=b'secret password')
-    
-    @property
-    def timeout(self):
-        return self.read_timeout
-    
-    @timeout.setter
-    def timeout(self, value):
-        self.read_timeout = value
-    
-    def write(self, data):
-        self.OOPIconn.send_bytes(data)
-        return len(data)
-        
-    def readline(self):
-        try:
-            if self.OIPOconn.poll(self.read_timeout):
-                return self.OIPOconn.recv_bytes()
-            else:
-                return b''
-        except EOFError: # serialClient crashed
-            self.close()
-            return b''
-        
-    def close(self):
-        try:
-            self.OOPIconn.close()
-        except AttributeError: # this fails if connection has been closed beforehand (e.g. __del__() after close())
-            pass
-        try:
-            self.OOPIlistener.close()
-        except AttributeError:
-            pass
-        try:
-            self.OIPOconn.close()
-        except AttributeError:
-            pass
-        try:
-            self.fd_proc.terminate()
-        except AttributeError:
-            pass
-        
-    def __del__(self):
-        self.close()
-        
+# Telemetry from serialDaemon -> custom event, fired as plugin_<identifier>_<event> on octoprint's event bus and sent to
+# the web interface as plugin messages: a file the daemon streams (see serialStreamer.py), errors, and the SERIAL_STATE
+# notifications of CDC-ACM boards (resets, overruns)
+EVENTS = {
+    "started": "stream_started",
+    "progress": "stream_progress",
+    "resend": "stream_resend",
+    "done": "stream_done",
+    "refused": "stream_refused",
+    "error": "error",
+    "serial_state": "serial_state",
+    }
 
-class Termux_CDC_ACM_Plugin(octoprint.plugin.SettingsPlugin, octoprint.plugin.TemplatePlugin):
-    port_names = list()
+class Termux_CDC_ACM_Plugin(octoprint.plugin.SettingsPlugin, octoprint.plugin.TemplatePlugin, octoprint.plugin.ShutdownPlugin,
+        octoprint.plugin.SimpleApiPlugin, octoprint.plugin.EventHandlerPlugin):
+    def __init__(self):
+        self.supervisor = SessionSupervisor(serial_printer) # one session per printer, several can be connected at once
+        self.ports = PortInventory() # termux-usb -l is slow, it runs in the background instead of in octoprint's requests
+        self.ports.start()
     
     def serial_printer_factory(self, comm_instance, port, baudrate, read_timeout):
-        if not port in self.port_names:
+        # At startup (autoconnect) the first listing may still be running, after that only the cached list counts
+        self.ports.wait()
+        if not port in self.ports:
+            self.ports.missed(port)
             return None
 
-        serial_obj = serial_printer(
+        self.supervisor.reap()
+        serial_obj = self.supervisor.open(
             comm_instance=comm_instance,
             port=port,
             baudrate=baudrate,
             read_timeout=float(read_timeout),
         )
+        serial_obj.on_telemetry = lambda event: self._telemetry_event(port, event)
         return serial_obj
     
+    def get_api_commands(self):
+        # POST /api/plugin/<identifier> {"command": "stream", "path": "<file in octoprint's uploads>"} has serialDaemon
+        # print the file by itself, without octoprint handling every line. "cancel_stream" stops it.
+        return {"stream": ["path"], "cancel_stream": []}
+    
+    def on_api_command(self, command, data):
+        if not Permissions.PRINT.can():
+            return flask.abort(403)
+        port = self._printer.get_current_connection()[1]
+        session = self.supervisor.get(port) if port else None
+        if session is None:
+            return flask.make_response("Not connected to a printer through this plugin", 409)
+        if command == "cancel_stream":
+            session.cancel_stream()
+            return flask.jsonify(port=port)
+        if self._printer.is_printing():
+            return flask.make_response("Octoprint is printing already", 409)
+        if session.streaming:
+            return flask.make_response("A file is streaming already", 409)
+        path = self._file_manager.path_on_disk(FileDestinations.LOCAL, data["path"])
+        if not os.path.isfile(path):
+            return flask.make_response(f"No such file: {data['path']}", 404)
+        start = data.get("start", 0)
+        if type(start) is not int or not 0 <= start <= os.path.getsize(path):
+            return flask.make_response(f"start must be a byte offset into the file, not {start!r}", 400)
+        if not session.stream_file(path, start):
+            return flask.make_response("Streaming needs serialDaemon (not TERMUX_CDC_ACM_INPROCESS)", 409)
+        return flask.jsonify(port=port, path=data["path"])
+    
+    def _telemetry_event(self, port, event):
+        # Called from octoprint's comm thread reading the session, temperatures reach octoprint through it already
+        name = EVENTS.get(event["event"])
+        if name is None:
+            return
+        payload = dict(event, port=port)
+        self._event_bus.fire(f"plugin_{self._identifier}_{name}", payload)
+        self._plugin_manager.send_plugin_message(self._identifier, payload)
+    
+    def register_custom_events(self, *args, **kwargs):
+        return list(EVENTS.values())
+    
+    def _streaming_session(self):
+        # The session of the printer octoprint is connected to, if serialDaemon streams a file to it
+        port = self._printer.get_current_connection()[1]
+        session = self.supervisor.get(port) if port else None
+        return session if session is not None and session.streaming else None
+    
+    def on_event(self, event, payload):
+        # Octoprint doesn't know about a file serialDaemon streams, it lets the user start a print of its own meanwhile
+        if event == Events.PRINT_STARTED and self._streaming_session() is not None:
+            self._logger.error("A file is streaming from serialDaemon, cancelling octoprint's print")
+            self._printer.cancel_print()
+    
+    def gate_job_lines(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        # Until that print is cancelled, none of its lines go to the printer (serialDaemon would refuse them too)
+        if tags and "source:file" in tags and self._streaming_session() is not None:
+            return (None,)
+        return None
+    
+    def on_shutdown(self):
+        # Daemons kept warm for reconnecting would otherwise hold on to the printers until their idle timeout
+        self.supervisor.close_all()
+        self.ports.stop()
+    
     
     def get_additional_port_names(self, *args, **kwargs):
-        self.port_names = json.loads(subprocess.check_output(['termux-usb', '-l']))
-        return self.port_names
+        # Octoprint asks when the connection panel gets refreshed, which is when a new printer should show up
+        self.ports.kick()
+        self.ports.wait()
+        return list(self.ports.names)
 
 __plugin_name__ = "Termux CDC_ACM"
 __plugin_version__ = "1.0.0"
 __plugin_description__ = "Print from Android if your printer usually shows up as /dev/ttyACM*"
-__plugin_pythoncompat__ = ">=2.7,<4"
+__plugin_pythoncompat__ = ">=3.8,<4"
 
 def __plugin_load__():
     plugin = Termux_CDC_ACM_Plugin()
@@ -120,4 +135,6 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.comm.transport.serial.factory": plugin.serial_printer_factory,
         "octoprint.comm.transport.serial.additional_port_names": plugin.get_additional_port_names,
+        "octoprint.events.register_custom_events": plugin.register_custom_events,
+        "octoprint.comm.protocol.gcode.queuing": plugin.gate_job_lines,
     }
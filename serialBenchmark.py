@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the plugin's hot paths, run e.g. "python serialBenchmark.py transport" inside Termux
+
+import sys
+import os
+import time
+import signal
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import Listener, Client
+
+import serialTransport
+from serialEmulator import EMULATE_ENV
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def report(name, results):
+    print(f"{name}:")
+    for key, value in results.items():
+        print(f"    {key:>24}: {value}")
+
+# ----------------------------------------------------------------------------
+# Transport: the old pair of multiprocessing.connection TCP connections vs. one framed unix socket
+
+def _echo_multiprocessing(listener):
+    conn = listener.accept()
+    try:
+        while True:
+            conn.send_bytes(conn.recv_bytes())
+    except EOFError:
+        pass
+
+def _echo_framed(listener):
+    conn = serialTransport.accept(listener)
+    try:
+        while True:
+            conn.send(*conn.recv())
+    except EOFError:
+        pass
+
+def _echo_shm(rx, tx):
+    while True:
+        data = tx.read(timeout=1)
+        if not data:
+            break
+        rx.write(data)
+
+def _open_multiprocessing():
+    listener = Listener(('localhost', 0), authkey=b'secret password')
+    proc = multiprocessing.get_context("fork").Process(target=_echo_multiprocessing, args=(listener,))
+    proc.start()
+    start = time.perf_counter()
+    conn = Client(listener.address, authkey=b'secret password')
+    connect_time = time.perf_counter() - start
+    listener.close()
+    return conn.send_bytes, conn.recv_bytes, conn.close, proc, connect_time
+
+def _open_framed():
+    address = serialTransport.new_address()
+    listener = serialTransport.listen(address)
+    proc = multiprocessing.get_context("fork").Process(target=_echo_framed, args=(listener,))
+    proc.start()
+    start = time.perf_counter()
+    conn = serialTransport.connect(address)
+    connect_time = time.perf_counter() - start
+    serialTransport.close_listener(listener, address)
+    send = lambda data: conn.send(serialTransport.CHANNEL_DATA, data)
+    recv = lambda: conn.recv()[1]
+    return send, recv, conn.close, proc, connect_time
+
+def _open_shm():
+    # The rings are created before forking, so the echo process simply inherits them
+    rx = serialTransport.ShmPipe()
+    tx = serialTransport.ShmPipe()
+    proc = multiprocessing.get_context("fork").Process(target=_echo_shm, args=(rx, tx))
+    proc.start()
+    pending = deque()
+    partial = [b'']
+    def recv():
+        # One line per call like the others, even though a read may return several at once (or end within one)
+        while not pending:
+            lines = (partial[0] + rx.read(timeout=None)).split(b'\n')
+            partial[0] = lines.pop()
+            pending.extend(lines)
+        return pending.popleft()
+    def close():
+        proc.join()
+        rx.close()
+        tx.close()
+    return tx.write, recv, close, proc, 0.0
+
+def bench_transport(messages=20000, roundtrips=5000, size=32):
+    payload = b"G1 X10.0 Y10.0 E0.1 F1800".ljust(size - 1, b' ') + b'\n'
+    openers = (
+        ("multiprocessing.connection over TCP", _open_multiprocessing),
+        ("framed unix socket", _open_framed),
+        ("shared memory rings", _open_shm),
+        )
+    for name, opener in openers:
+        send, recv, close, proc, connect_time = opener()
+
+        # Throughput: send everything from a second thread while receiving the echoes
+        sender = threading.Thread(target=lambda: [send(payload) for _ in range(messages)])
+        start = time.perf_counter()
+        sender.start()
+        for _ in range(messages):
+            recv()
+        duration = time.perf_counter() - start
+        sender.join()
+
+        # Latency: ping-pong, like octoprint sending a line and waiting for "ok"
+        latencies = []
+        for _ in range(roundtrips):
+            start = time.perf_counter()
+            send(payload)
+            recv()
+            latencies.append(time.perf_counter() - start)
+
+        close()
+        proc.join()
+        report(name, {
+            "connect [ms]": f"{connect_time * 1e3:.3f}",
+            "messages/s": f"{messages / duration:.0f}",
+            "roundtrip p50 [us]": f"{percentile(latencies, 50) * 1e6:.1f}",
+            "roundtrip p99 [us]": f"{percentile(latencies, 99) * 1e6:.1f}",
+            })
+
+# ----------------------------------------------------------------------------
+# Stress: several emulated printers through SessionSupervisor, each with its own serialDaemon
+
+def _pingpong(printer, count, latencies=None):
+    for i in range(count):
+        start = time.perf_counter()
+        printer.write(b"G1 X%d\n" % i)
+        while not printer.readline().startswith(b"ok"):
+            pass
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start)
+
+def bench_stress(printers=4, roundtrips=2000):
+    from serialPrinter import serial_printer
+    from serialSupervisor import SessionSupervisor
+
+    os.environ[EMULATE_ENV] = "1"
+    supervisor = SessionSupervisor(serial_printer)
+    try:
+        start = time.perf_counter()
+        sessions = [supervisor.open(port=f"emulated{i}", comm_instance=None, baudrate=115200, read_timeout=2.0) for i in range(printers)]
+        connect_time = time.perf_counter() - start
+        first, others = sessions[0], sessions[1:]
+
+        alone = []
+        _pingpong(first, roundtrips, alone)
+
+        # Same again, while all other printers are streaming as fast as they can
+        stop = threading.Event()
+        def stream(printer, counter):
+            while not stop.is_set():
+                _pingpong(printer, 100)
+                counter[0] += 100
+        counters = [[0] for _ in others]
+        threads = [threading.Thread(target=stream, args=(printer, counter)) for printer, counter in zip(others, counters)]
+        for thread in threads:
+            thread.start()
+        busy = []
+        start = time.perf_counter()
+        _pingpong(first, roundtrips, busy)
+        duration = time.perf_counter() - start
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        # Killing one daemon must not take the others down
+        if others: # the whole process group, termux-usb (here the shell) and the daemon
+            os.killpg(others[0].fd_proc.pid, signal.SIGKILL)
+        time.sleep(0.5)
+        reaped = supervisor.reap()
+        _pingpong(first, 10)
+
+        report(f"{printers} emulated printers", {
+            "sessions": len(sessions),
+            "connect all [ms]": f"{connect_time * 1e3:.1f}",
+            "alone p50 [us]": f"{percentile(alone, 50) * 1e6:.1f}",
+            "alone p99 [us]": f"{percentile(alone, 99) * 1e6:.1f}",
+            "busy p50 [us]": f"{percentile(busy, 50) * 1e6:.1f}",
+            "busy p99 [us]": f"{percentile(busy, 99) * 1e6:.1f}",
+            "others lines/s": f"{sum(c[0] for c in counters) / duration:.0f}",
+            "reaped after kill": reaped,
+            "still connected": len(supervisor),
+            })
+    finally:
+        supervisor.close_all()
+        del os.environ[EMULATE_ENV]
+
+# ----------------------------------------------------------------------------
+# Coalesce: streaming lines into a printer whose every usb transfer costs a frame, one transfer per line vs. merged
+
+def bench_coalesce(lines=3000, transfer_time=0.001):
+    from serialSession import SerialSession
+    from serialEmulator import serial_Emulated
+
+    payload = b"G1 X10.0 Y10.0 E0.1 F1800\n"
+    configs = (
+        ("one transfer per line", dict(tx_max_transfer=0)),
+        ("merged", dict()),
+        ("merged, 1ms deadline", dict(tx_deadline=1.0)),
+        )
+    for name, kwargs in configs:
+        serial = serial_Emulated(transfer_time=transfer_time)
+        session = SerialSession(serial, None, lambda: None, **kwargs)
+        session.start()
+        start = time.perf_counter()
+        for _ in range(lines):
+            session.write(payload)
+        while serial.lines_received < lines:
+            time.sleep(0.001)
+        duration = time.perf_counter() - start
+        session.stop()
+        stats = session.writer.stats()
+        report(name, {
+            "lines/s": f"{lines / duration:.0f}",
+            "transfers": stats["transfers"],
+            "bytes/transfer": f"{stats['bytes/transfer']:.1f}",
+            "zero length packets": stats["zero length packets"],
+            })
+
+# ----------------------------------------------------------------------------
+# Connect: where the time goes when serial_printer starts a daemon, phase by phase (see ConnectTimer)
+
+def bench_connect(cycles=20):
+    from serialPrinter import serial_printer
+
+    os.environ[EMULATE_ENV] = "1"
+    try:
+        phases = {}
+        totals = []
+        for i in range(cycles):
+            start = time.perf_counter()
+            printer = serial_printer(None, "emulated", 115200, 2.0)
+            totals.append(time.perf_counter() - start)
+            for name, seconds in printer.connect_timings.items():
+                phases.setdefault(name, []).append(seconds)
+            printer.close()
+        results = {f"{name} p50 [ms]": f"{percentile(values, 50) * 1e3:.2f}" for name, values in phases.items()}
+        results["total p50 [ms]"] = f"{percentile(totals, 50) * 1e3:.2f}"
+        results["total max [ms]"] = f"{max(totals) * 1e3:.2f}"
+        report("cold connect to an emulated printer", results)
+    finally:
+        del os.environ[EMULATE_ENV]
+
+# ----------------------------------------------------------------------------
+# Reconnect: octoprint disconnecting and connecting again, with a fresh daemon each time vs. the warm one
+
+def bench_reconnect(cycles=20):
+    from serialPrinter import serial_printer
+    from serialSupervisor import SessionSupervisor
+
+    os.environ[EMULATE_ENV] = "1"
+    supervisor = SessionSupervisor(serial_printer)
+    try:
+        results = {}
+        for name, keep_warm in (("cold", False), ("warm", True)):
+            times = []
+            for i in range(cycles):
+                baudrate = (115200, 250000)[i % 2] # like octoprint's baudrate detection
+                start = time.perf_counter()
+                printer = supervisor.open(port="emulated", comm_instance=None, baudrate=baudrate, read_timeout=2.0)
+                _pingpong(printer, 1)
+                times.append(time.perf_counter() - start)
+                if not keep_warm:
+                    printer.warm = None # close() then ends the daemon like before
+                printer.close()
+            results[f"{name} p50 [ms]"] = f"{percentile(times, 50) * 1e3:.2f}"
+            results[f"{name} max [ms]"] = f"{max(times) * 1e3:.2f}"
+        report("connect, first ok and disconnect", results)
+    finally:
+        supervisor.close_all()
+        del os.environ[EMULATE_ENV]
+
+# ----------------------------------------------------------------------------
+# Send-ahead: octoprint's one line per "ok" against a printer that answers after delay, without and with SendAhead
+
+def bench_sendahead(lines=2000, delay=2.0):
+    from serialPrinter import serial_printer
+    from serialEmulator import EMULATE_DELAY_ENV
+    from serialSendAhead import SEND_AHEAD_ENV
+
+    os.environ[EMULATE_ENV] = "1"
+    os.environ[EMULATE_DELAY_ENV] = str(delay)
+    try:
+        for name, rx_budget in (("one line per ok", "0"), ("send-ahead, 127 bytes", "127")):
+            os.environ[SEND_AHEAD_ENV] = rx_budget
+            printer = serial_printer(None, "emulated", 115200, 2.0)
+            _pingpong(printer, 10) # warm up
+            start = time.perf_counter()
+            _pingpong(printer, lines)
+            duration = time.perf_counter() - start
+            printer.warm = None
+            printer.close()
+            report(f"{name}, printer answers after {delay:g}ms", {
+                "lines/s": f"{lines / duration:.0f}",
+                "round trip limit lines/s": f"{1000 / delay:.0f}",
+                })
+    finally:
+        for env in (EMULATE_ENV, EMULATE_DELAY_ENV, SEND_AHEAD_ENV):
+            os.environ.pop(env, None)
+
+# ----------------------------------------------------------------------------
+# Stream: a G-code file line by line from "octoprint" vs. serialDaemon streaming it by itself (FileStreamer), with the
+# cpu time this process spent on it
+
+def bench_stream(lines=5000, delay=0.0):
+    import tempfile
+    from serialPrinter import serial_printer
+    from serialEmulator import EMULATE_DELAY_ENV
+
+    os.environ[EMULATE_ENV] = "1"
+    os.environ[EMULATE_DELAY_ENV] = str(delay)
+    with tempfile.NamedTemporaryFile(suffix=".gcode") as f:
+        f.write(b"; generated\n" + b"".join(b"G1 X%d.0 Y%d.0 E0.1 F1800 ; move\n" % (i % 200, i % 180) for i in range(lines)))
+        f.flush()
+        try:
+            printer = serial_printer(None, "emulated", 115200, 2.0)
+            start, cpu = time.perf_counter(), time.process_time()
+            with open(f.name, "rb") as gcode:
+                for line in gcode:
+                    line = line.split(b";")[0].strip()
+                    if line:
+                        printer.write(line + b"\n")
+                        while not printer.readline().startswith(b"ok"):
+                            pass
+            duration, cpu = time.perf_counter() - start, time.process_time() - cpu
+            report("from octoprint, one line per ok", {
+                "lines/s": f"{lines / duration:.0f}",
+                "cpu here [us/line]": f"{cpu / lines * 1e6:.1f}",
+                })
+
+            start, cpu = time.perf_counter(), time.process_time()
+            printer.stream_file(f.name)
+            printer.timeout = 0.01 # readline() only returns for lines, not for events
+            while printer.stream_status is None or printer.stream_status["event"] != "done":
+                printer.readline()
+            duration, cpu = time.perf_counter() - start, time.process_time() - cpu
+            report("streamed by serialDaemon", {
+                "lines/s": f"{printer.stream_status['lines'] / duration:.0f}",
+                "cpu here [us/line]": f"{cpu / lines * 1e6:.1f}",
+                "resends": printer.stream_status["resends"],
+                })
+            printer.warm = None
+            printer.close()
+        finally:
+            for env in (EMULATE_ENV, EMULATE_DELAY_ENV):
+                os.environ.pop(env, None)
+
+# ----------------------------------------------------------------------------
+# Overrun: a device sending at 1Mbaud with a 64 byte FIFO, read one transfer at a time vs. with several always submitted
+# (USBReader with usblib.AsyncReader's emulated counterpart), while another thread keeps the interpreter busy like
+# octoprint would
+
+def bench_overrun(seconds=2.0, baudrate=1000000, work=0.0005):
+    from serialSession import SerialSession
+    from serialEmulator import serial_EmulatedStream
+
+    for name, transfers in (("one read at a time", 0), ("2 transfers", 2), ("4 transfers", 4), ("8 transfers", 8)):
+        device = serial_EmulatedStream(baudrate=baudrate)
+        received = [0]
+        def consume(data):
+            received[0] += len(data)
+            end = time.perf_counter() + work # holding the GIL, the reader has to wait for it
+            while time.perf_counter() < end:
+                pass
+        session = SerialSession(device, consume, lambda: None, rx_transfers=transfers)
+        session.start()
+        time.sleep(seconds)
+        session.stop()
+        device.close()
+        report(f"{name}, {baudrate} baud", {
+            "received [kB/s]": f"{received[0] / seconds / 1e3:.1f}",
+            "overrun [%]": f"{device.overruns / device.sent * 100:.2f}",
+            "frames without a transfer": device.starved,
+            })
+
+# ----------------------------------------------------------------------------
+# Read until: finding b"\n" after every 64 byte packet, in one long payload and in many short lines. usblib.RingBuffer
+# only scans what's new, the baseline is what Buffer did (find() over everything, then slicing off the front).
+
+class _SlicingBuffer():
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf.extend(data)
+
+    def find(self, expected):
+        return self.buf.find(expected)
+
+    def read_until(self, expected, size=-1):
+        n = self.buf.find(expected) + len(expected)
+        data = self.buf[:n]
+        self.buf[:n] = b""
+        return data
+
+def bench_readuntil(payload=1 << 20, lines=100000, chunk=64):
+    from usblib import RingBuffer
+
+    workloads = (
+        (f"one {payload >> 10}kB line", b"x" * (payload - 1) + b"\n"),
+        (f"{lines} short lines", b"ok T:210.0 /210.0 B:60.0 /60.0\n" * lines),
+        )
+    for name, data in workloads:
+        results = {}
+        for kind, buf in (("bytearray", _SlicingBuffer()), ("ring", RingBuffer(capacity=2 * payload))):
+            start = time.perf_counter()
+            found = 0
+            for i in range(0, len(data), chunk):
+                buf.write(data[i:i + chunk])
+                while buf.find(b"\n") != -1: # like read_until() after each wakeup
+                    found += len(buf.read_until(b"\n"))
+            duration = time.perf_counter() - start
+            assert found == len(data)
+            results[f"{kind} [MB/s]"] = f"{len(data) / duration / 1e6:.1f}"
+        report(f"read_until, {name} in {chunk} byte chunks", results)
+
+# ----------------------------------------------------------------------------
+
+BENCHMARKS = {
+    "transport": bench_transport,
+    "stress": bench_stress,
+    "coalesce": bench_coalesce,
+    "connect": bench_connect,
+    "reconnect": bench_reconnect,
+    "sendahead": bench_sendahead,
+    "stream": bench_stream,
+    "overrun": bench_overrun,
+    "readuntil": bench_readuntil,
+    }
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,136 @@
+import threading
+
+class LineRing():
+    # Fixed size ring buffer for assembling the lines the printer sends. USB reads go straight into it (free() and
+    # commit()) and complete lines get handed out as memoryviews into it (lines() and release()), so memory stays flat
+    # and bytes don't get copied around on their way to octoprint.
+    # One thread produces, one thread consumes.
+    def __init__(self, capacity=16384, max_line=4096, chunk=64):
+        # chunk is the size reads have to be a multiple of (the endpoint's wMaxPacketSize), capacity gets rounded up to it
+        self.chunk = chunk
+        self.capacity = -(-capacity // chunk) * chunk
+        self.max_line = max_line    # lines (with their b'\n') longer than this get cut, so that a printer never sending
+                                    # b'\n' can't block us
+        assert self.max_line + self.chunk <= self.capacity
+
+        # One chunk of slack behind the end, so that a read never has to be smaller than chunk because of the wraparound.
+        # commit() moves whatever landed there to the start.
+        self.buf = bytearray(self.capacity + chunk)
+        self.view = memoryview(self.buf)
+
+        # Absolute positions, modulo capacity gives the index into buf
+        self.head = 0       # start of the data that hasn't been released yet
+        self.tail = 0       # end of the data that has been committed
+        self.scanned = 0    # everything before this has been searched for b'\n' already
+        self.line_start = 0 # start of the line that hasn't been completed yet
+        self.complete = 0   # end of the last complete line
+        self.cut = False    # whether complete is the end of a line that got cut at max_line
+
+        self.overflows = 0          # how many lines were cut at max_line
+        self.overflow_bytes = 0     # how many bytes were in those lines
+        self.closed = False
+
+        self.lock = threading.Lock()
+        self.data_available = threading.Condition(self.lock)
+        self.space_available = threading.Condition(self.lock)
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def close(self):
+        # Wakes up whoever is waiting, free() and lines() return nothing afterwards
+        with self.lock:
+            self.closed = True
+            self.data_available.notify_all()
+            self.space_available.notify_all()
+
+    # Producer side
+
+    def free(self, timeout=None):
+        # Waits until there is room for at least one chunk and returns a writable memoryview of the contiguous free space
+        # at the tail, its length a multiple of chunk. Empty if timed out or closed.
+        with self.lock:
+            if not self.space_available.wait_for(lambda: self.closed or self.capacity - len(self) >= self.chunk, timeout):
+                return self.view[0:0]
+            if self.closed:
+                return self.view[0:0]
+            start = self.tail % self.capacity
+            size = min(self.capacity - len(self), self.capacity - start)
+            size = max(self.chunk, size - size % self.chunk)    # at the end, reaching into the slack is fine
+            return self.view[start:start + size]
+
+    def commit(self, size):
+        # Marks size bytes that were written into what free() returned as data
+        if not size:
+            return
+        start = self.tail % self.capacity
+        wrapped = start + size - self.capacity
+        if wrapped > 0: # part of it landed in the slack behind the end
+            self.buf[:wrapped] = self.view[self.capacity:self.capacity + wrapped]
+        with self.lock:
+            self.tail += size
+            self.data_available.notify()
+
+    # Consumer side
+
+    def _ranges(self, start, end):
+        # Index ranges into buf of the data between the absolute positions start and end, two if it wraps around
+        a = start % self.capacity
+        b = a + end - start
+        if b <= self.capacity:
+            return [(a, b)]
+        return [(a, self.capacity), (0, b - self.capacity)]
+
+    def _rfind(self, start, end):
+        # Absolute position of the last b'\n' between the absolute positions start and end, -1 if there is none
+        found = -1
+        offset = start
+        for a, b in self._ranges(start, end):
+            pos = self.buf.rfind(b'\n', a, b)
+            if pos != -1:
+                found = offset + pos - a
+            offset += b - a
+        return found
+
+    def _scan(self):
+        # Search only the bytes that arrived since the last scan for the last b'\n'. A cut line is the last one lines()
+        # hands out, what comes after it waits for release().
+        if self.cut and self.complete > self.head:
+            return
+        while self.tail - self.line_start >= self.max_line:
+            # Enough data for a line that's too long: max_line bytes after the start of a line must hold its end
+            end = self.line_start + self.max_line
+            pos = self._rfind(self.scanned, end)
+            if pos == -1:
+                self.complete = self.scanned = self.line_start = end
+                self.cut = True
+                self.overflows += 1
+                self.overflow_bytes += self.max_line
+                return
+            self.complete = self.scanned = self.line_start = pos + 1
+            self.cut = False
+        pos = self._rfind(self.scanned, self.tail)
+        if pos != -1:
+            self.complete = self.line_start = pos + 1
+            self.cut = False
+        self.scanned = self.tail
+
+    def lines(self, timeout=None):
+        # Waits for complete lines and returns (segments, cut). segments are memoryviews holding every complete line
+        # (two of them if the data wraps around), cut tells whether the last line got cut at max_line and is missing its
+        # b'\n'. They stay valid until release() gets called. Empty if timed out or closed.
+        with self.lock:
+            def available():
+                self._scan()
+                return self.closed or self.complete > self.head
+            if not self.data_available.wait_for(available, timeout) or self.closed:
+                return [], False
+            return [self.view[a:b] for a, b in self._ranges(self.head, self.complete)], self.cut
+
+    def release(self):
+        # Hands back the space of what lines() returned
+        with self.lock:
+            self.head = self.complete
+            self.cut = False
+            self.space_available.notify()
+
@@ -1,86 +1,148 @@
+import struct
 import usb
 import usb.core
 import usb.util
-import usb.control
+try: # part of the octoprint plugin package, or imported by serialDaemon.py as a script
+    from .usblib import ctrl_transfer, Endpoint
+    from .serialProfiles import DeviceProfile
+    from .serialDrivers import serial_USB, register
+except ImportError:
+    from usblib import ctrl_transfer, Endpoint
+    from serialProfiles import DeviceProfile
+    from serialDrivers import serial_USB, register
 
-def check_is_CDCACM(dev):
+# Class requests of the communications interface (CDC PSTN subclass, 6.3)
+SET_LINE_CODING = 0x20
+GET_LINE_CODING = 0x21
+SET_CONTROL_LINE_STATE = 0x22
+REQTYPE_OUT = usb.ENDPOINT_OUT | usb.TYPE_CLASS | usb.RECIP_INTERFACE   # [host-to-device, type: class, recipient: iface]
+REQTYPE_IN = usb.ENDPOINT_IN | usb.TYPE_CLASS | usb.RECIP_INTERFACE
+
+# Line coding: dwDTERate, bCharFormat, bParityType, bDataBits
+LINE_CODING = struct.Struct("<IBBB")
+STOP_BITS = {1: 0, 1.5: 1, 2: 2}
+PARITY = {"N": 0, "O": 1, "E": 2, "M": 3, "S": 4}
+
+# Notifications on the interrupt IN endpoint of the communications interface (CDC PSTN subclass, 6.5)
+NOTIFICATION = struct.Struct("<BBHHH")  # bmRequestType, bNotification, wValue, wIndex, wLength, then the data
+SERIAL_STATE = 0x20
+# bits of SERIAL_STATE's UART state bitmap: line states (bRxCarrier, bTxCarrier, bRingSignal) and errors
+SERIAL_STATE_BITS = ("dcd", "dsr", "break", "ring", "framing", "parity", "overrun")
+LINE_STATES = ("dcd", "dsr", "ring")
+LINE_ERRORS = ("break", "framing", "parity", "overrun")
+CARRIERS = ("dcd", "dsr")   # going away is what a resetting board looks like
+
+def line_coding(baudrate, data_bits=8, parity="N", stop_bits=1):
+    return LINE_CODING.pack(baudrate, STOP_BITS[stop_bits], PARITY[parity], data_bits)
+
+def probe_CDCACM(dev):
+    # Walks the active configuration for the interfaces and endpoints, None if this isn't a CDC-ACM device. open_serial
+    # keeps the result as a DeviceProfile, so that this only runs for devices it hasn't seen before.
     cfg = dev.get_active_configuration()
+    
+    # CDC-Interfaces can be identified using their Interface Class
     interface_CDC_Comm = usb.util.find_descriptor(cfg, bInterfaceClass=usb.CLASS_COMM)
     interface_CDC_Data = usb.util.find_descriptor(cfg, bInterfaceClass=usb.CLASS_DATA)
     if (interface_CDC_Comm is None) or (interface_CDC_Data is None):
-        return False
-    else:
-        return True
+        return None
+    
+    # Now we need to find the endpoints where we can transmit and receive serial data
+    # Helpful: https://www.keil.com/pack/doc/mw/USB/html/_u_s_b__endpoint__descriptor.html
+    endpoint_IN, endpoint_OUT = DeviceProfile.bulk_endpoints(interface_CDC_Data)
+    if endpoint_OUT == None:
+        print("serial_CDCACM:: Error: Could not find OUT-Endpoint!")
+    if endpoint_IN == None:
+        print("serial_CDCACM:: Error: Could not find IN-Endpoint!")
+    if endpoint_IN == None or endpoint_OUT == None:
+        return None
+    return DeviceProfile("CDCACM", interface_CDC_Comm.bInterfaceNumber, interface_CDC_Data.bInterfaceNumber, endpoint_IN, endpoint_OUT,
+        DeviceProfile.interrupt_endpoint(interface_CDC_Comm))
 
-class serial_CDCACM():
-    def __init__(self, dev, baudrate):
-        self.dev = dev
-        self.baudrate = baudrate
-        self.cfg = self.dev.get_active_configuration()
-        
-        # CDC-Interfaces can be identified using their Interface Class
-        self.interface_CDC_Comm = usb.util.find_descriptor(self.cfg, bInterfaceClass=usb.CLASS_COMM)
-        self.interface_CDC_Data = usb.util.find_descriptor(self.cfg, bInterfaceClass=usb.CLASS_DATA)
-        
-        print(f"{self.interface_CDC_Comm=}")
-        print(f"{self.interface_CDC_Data=}")
-        
-        # Lock usb device
-        usb.util.claim_interface(self.dev, self.interface_CDC_Data)
-        usb.util.claim_interface(self.dev, self.interface_CDC_Comm)
-        
-        # Now we need to find the endpoints where we can transmit and receive serial data
-        # Helpful: https://www.keil.com/pack/doc/mw/USB/html/_u_s_b__endpoint__descriptor.html
-        self.endpoint_OUT = None
-        self.endpoint_IN = None
-        for endpoint in self.interface_CDC_Data.endpoints():
-            if endpoint.bmAttributes==usb.ENDPOINT_TYPE_BULK: # Both endpoints have the "Bulk" attribute
-                # What's IN and OUT can be distinguished by bit 7 of the Endpoint Address
-                if endpoint.bEndpointAddress & 1<<7: # Bit7 of the bEndpointAddress determines the direction: 0=OUT, 1=IN
-                    self.endpoint_IN = endpoint
-                else:
-                    self.endpoint_OUT = endpoint
-        if self.endpoint_OUT == None:
-            print("serial_CDCACM:: Error: Could not find OUT-Endpoint!")
-        if self.endpoint_IN == None:
-            print("serial_CDCACM:: Error: Could not find IN-Endpoint!")
-                
-        
-        # Configure as baudrate (<- in little endian) and 8N1
-        serialConf = bytearray(list((self.baudrate).to_bytes(length=6, byteorder="little")) + [0x08])
-        
-        # OUT-Transfer, parameters are: bmRequestType, bmRequest, wValue, wIndex and data-payload
-        # Helpful: https://github.com/NordicPlayground/node-usb-cdc-acm/blob/master/src/usb-cdc-acm.js
-        self.dev.ctrl_transfer( # set line state
-            usb.ENDPOINT_OUT | usb.TYPE_CLASS | usb.RECIP_INTERFACE,   # bmRequestType: [host-to-device, type: class, recipient: iface]
-            0x22,   # SET_CONTROL_LINE_STATE
+def check_is_CDCACM(dev):
+    return probe_CDCACM(dev) is not None
+
+@register("CDCACM", interface_class=usb.CLASS_COMM)
+class serial_CDCACM(serial_USB):
+    probe = staticmethod(probe_CDCACM)
+
+    data_bits = 8
+    parity = "N"
+    stop_bits = 1
+
+    def setup(self):
+        print(f"serial_CDCACM:: {self.profile.to_dict()}")
+        # SERIAL_STATE notifications, read by SerialSession's NotificationReader
+        self.endpoint_notify = None
+        if self.profile.endpoint_notify is not None:
+            self.endpoint_notify = Endpoint(self.dev, *self.profile.endpoint_notify, self.profile.control_interface)
+            # a whole notification in one transfer, even with 8 byte packets
+            packet = self.endpoint_notify.wMaxPacketSize
+            self.notification_buffer = bytearray(-(-64 // packet) * packet)
+        self.line_state = dict.fromkeys(LINE_STATES, None) # unknown until the first notification
+        self.counters = dict.fromkeys(LINE_ERRORS + ("ring",) + tuple(f"{state} lost" for state in CARRIERS), 0)
+        ctrl_transfer(self.dev, # set line state
+            REQTYPE_OUT,
+            SET_CONTROL_LINE_STATE,
             0x00, #0x02 | 0x01, # 0x02 "Activate carrier" & 0x01 "DTE is present" 
-            self.interface_CDC_Comm.index, # interface index
+            self.profile.control_interface, # interface number
             None)   # No data-payload
-        self.dev.ctrl_transfer( # set line coding
-            usb.ENDPOINT_OUT | usb.TYPE_CLASS | usb.RECIP_INTERFACE,   # bmRequestType: [host-to-device, type: class, recipient: iface]
-            0x20,   # SET_LINE_CODING
-            0,      # Always zero
-            self.interface_CDC_Comm.index, # interface index
-            serialConf) # data-payload
     
-    def purge(self):
-        # Purge whatever the printer has sent while not being connected
-        while(True):
-            try:
-                self.endpoint_IN.read(64, timeout=1) # 1 millisecond timeout
-            except usb.core.USBTimeoutError:
-                break
+    def set_baudrate(self, baudrate):
+        self.set_line_coding(baudrate, self.data_bits, self.parity, self.stop_bits)
     
-    def write(self, data):
-        self.endpoint_OUT.write(data)
+    def set_line_coding(self, baudrate, data_bits=8, parity="N", stop_bits=1):
+        # Helpful: https://github.com/NordicPlayground/node-usb-cdc-acm/blob/master/src/usb-cdc-acm.js
+        self.baudrate = baudrate
+        self.data_bits, self.parity, self.stop_bits = data_bits, parity, stop_bits
+        wanted = line_coding(baudrate, data_bits, parity, stop_bits)
+        ctrl_transfer(self.dev, REQTYPE_OUT, SET_LINE_CODING, 0, self.profile.control_interface, wanted)
         
-    def read(self, size=1024, timeout=1):
+        # Read back what the device made of it, a board may round the rate or not take it at all
+        self.actual_baudrate = baudrate
         try:
-            return self.endpoint_IN.read(size, timeout=timeout).tobytes()
+            got = bytes(ctrl_transfer(self.dev, REQTYPE_IN, GET_LINE_CODING, 0, self.profile.control_interface, LINE_CODING.size))
+        except usb.core.USBError as e: # optional for devices, some stall it
+            print(f"serial_CDCACM:: {baudrate} baud {data_bits}{parity}{stop_bits:g}, couldn't read it back: {e}")
+            return
+        if len(got) < LINE_CODING.size:
+            print(f"serial_CDCACM:: Warning: short GET_LINE_CODING answer {got.hex()}")
+            return
+        self.actual_baudrate = LINE_CODING.unpack(got[:LINE_CODING.size])[0]
+        if got[:LINE_CODING.size] == wanted:
+            print(f"serial_CDCACM:: {baudrate} baud {data_bits}{parity}{stop_bits:g}, confirmed by the device")
+        else:
+            rate, char_format, parity_type, bits = LINE_CODING.unpack(got[:LINE_CODING.size])
+            print(f"serial_CDCACM:: Warning: asked for {baudrate} baud {data_bits}{parity}{stop_bits:g}, the device runs at "
+                f"{rate} baud with bDataBits={bits} bParityType={parity_type} bCharFormat={char_format}")
+    
+    def read_notification(self, timeout=1000):
+        # Waits up to timeout milliseconds for a notification, returns the SERIAL_STATE events in it: {"dcd": ...,
+        # "dsr": ..., "ring": ..., "errors": [LINE_ERRORS that occurred], "lost": [CARRIERS that went away], "counters": the
+        # counters so far}
+        try:
+            n = self.endpoint_notify.read_into(self.notification_buffer, timeout)
         except usb.core.USBTimeoutError:
-            return b''
-        
-    def close(self):
-        usb.util.release_interface(self.dev, self.interface_CDC_Data)
-        usb.util.release_interface(self.dev, self.interface_CDC_Comm)
+            return []
+        data = memoryview(self.notification_buffer)[:n]
+        events = []
+        while len(data) >= NOTIFICATION.size:
+            bmRequestType, bNotification, wValue, wIndex, wLength = NOTIFICATION.unpack(data[:NOTIFICATION.size])
+            payload = bytes(data[NOTIFICATION.size:NOTIFICATION.size + wLength])
+            data = data[NOTIFICATION.size + wLength:]
+            if bNotification != SERIAL_STATE or len(payload) < 1:
+                continue
+            bitmap = payload[0]
+            bits = {name: bool(bitmap & 1 << i) for i, name in enumerate(SERIAL_STATE_BITS)}
+            event = {state: bits[state] for state in LINE_STATES}
+            event["errors"] = [name for name in LINE_ERRORS if bits[name]]
+            event["lost"] = [state for state in CARRIERS if self.line_state[state] and not bits[state]]
+            for name in event["errors"]:
+                self.counters[name] += 1
+            if bits["ring"] and not self.line_state["ring"]:
+                self.counters["ring"] += 1
+            for state in event["lost"]:
+                self.counters[f"{state} lost"] += 1
+            self.line_state.update((state, bits[state]) for state in LINE_STATES)
+            event["counters"] = dict(self.counters)
+            events.append(event)
+        return events
@@ -1,101 +1,153 @@
 import usb
 import usb.core
 import usb.util
-import usb.control
+try: # part of the octoprint plugin package, or imported by serialDaemon.py as a script
+    from .usblib import ctrl_transfer
+    from .serialProfiles import DeviceProfile
+    from .serialDrivers import serial_USB, register
+except ImportError:
+    from usblib import ctrl_transfer
+    from serialProfiles import DeviceProfile
+    from serialDrivers import serial_USB, register
 
 CH340_bInterfaceClass = 0xff
+# The ids the Linux ch341 driver knows, all of them speak the same protocol
+CH340_IDS = ((0x1A86, 0x7523), (0x1A86, 0x7522), (0x1A86, 0x5523), (0x4348, 0x5523), (0x2184, 0x0057), (0x9986, 0x7523))
+
+# Baudrates get computed like the Linux ch341 driver does it: 48 MHz divided by a prescaler (ps, fact) and an 8 bit
+# divisor, written as (0x100 - divisor) << 8 | fact << 2 | ps to the prescaler/divisor registers
+CH340_CLKRATE = 48000000
+CH340_REQ_READ_VERSION = 0x5F
+CH340_REQ_WRITE_REG = 0x9A
+CH340_REG_PRESCALER_DIVISOR = 0x1312
+CH340_REG_0F2C = 0x0f2c     # undocumented, the current Linux driver never writes it
+CH340_NO_BUFFERING = 0x80   # chips after version 0x27 hold data back until a packet is full without it
+
+# The baud table of WCH's own driver, which this driver used before computing divisors: (prescaler/divisor, 0x0f2c).
+# ch340_divisor() comes to the same prescaler/divisor values (see serialChecks.py), 0x0f2c still gets written for these
+# rates so that they set up the chip exactly like before.
+CH340_WCH_BAUDS = {
+    2400: (0xd901, 0x0038),
+    4800: (0x6402, 0x001f),
+    9600: (0xb202, 0x0013),
+    19200: (0xd902, 0x000d),
+    38400: (0x6403, 0x000a),
+    115200: (0xcc03, 0x0008),
+    }
+
+def clk_div(ps, fact):
+    return 1 << (12 - 3 * ps - fact)
+
+CH340_MIN_BPS = -(-CH340_CLKRATE // (clk_div(0, 0) * 256))   # 46
+CH340_MAX_BPS = CH340_CLKRATE // (clk_div(3, 0) * 2)         # 3000000
+
+def ch340_divisor(baudrate):
+    # (register value, baudrate the chip actually runs at) for the closest rate it can do
+    speed = min(max(baudrate, CH340_MIN_BPS), CH340_MAX_BPS)
+
+    # The highest base clock (fact = 1) that gives a divisor below 512
+    fact = 1
+    for ps in range(3, -1, -1):
+        if speed > CH340_CLKRATE // (clk_div(ps, 1) * 512):
+            break
+    div = CH340_CLKRATE // (clk_div(ps, fact) * speed)
+
+    # Half the base clock if the divisor doesn't fit
+    if div < 9 or div > 255:
+        div //= 2
+        fact = 0
+
+    # The next divisor if that comes closer, scaled up against rounding errors at low rates
+    clock = clk_div(ps, fact)
+    if 16 * CH340_CLKRATE // (clock * div) - 16 * speed >= 16 * speed - 16 * CH340_CLKRATE // (clock * (div + 1)):
+        div += 1
+
+    # The lower base clock for an even divisor, the receiver tolerates more that way
+    if fact == 1 and div % 2 == 0:
+        div //= 2
+        fact = 0
+
+    return (0x100 - div) << 8 | fact << 2 | ps, CH340_CLKRATE / (clk_div(ps, fact) * div)
 
 def check_is_CH340(dev):
-    return dev.idVendor==0x1A86 and dev.idProduct==0x7523
+    return (dev.idVendor, dev.idProduct) in CH340_IDS
 
-class serial_CH340():
-    def __init__(self, dev, baudrate):
-        self.dev = dev
-        self.baudrate = baudrate
-        self.cfg = self.dev.get_active_configuration()
-        
-        self.interface = usb.util.find_descriptor(self.cfg, bInterfaceClass=CH340_bInterfaceClass)
-        usb.util.claim_interface(self.dev, self.interface)
-        
-        self.endpoint_OUT = None
-        self.endpoint_IN = None
-        for endpoint in self.interface.endpoints():
-            if endpoint.bmAttributes==usb.ENDPOINT_TYPE_BULK: # Both endpoints have the "Bulk" attribute
-                # What's IN and OUT can be distinguished by bit 7 of the Endpoint Address
-                if endpoint.bEndpointAddress & 1<<7: # Bit7 of the bEndpointAddress determines the direction: 0=OUT, 1=IN
-                    self.endpoint_IN = endpoint
-                else:
-                    self.endpoint_OUT = endpoint
-        if self.endpoint_OUT == None:
-            print("serial_CH340:: Error: Could not find OUT-Endpoint!")
-        if self.endpoint_IN == None:
-            print("serial_CH340:: Error: Could not find IN-Endpoint!")
+def probe_CH340(dev):
+    # Walks the active configuration for the interface and endpoints, None if this isn't a CH340
+    if not check_is_CH340(dev):
+        return None
+    cfg = dev.get_active_configuration()
+    interface = usb.util.find_descriptor(cfg, bInterfaceClass=CH340_bInterfaceClass)
+    if interface is None:
+        return None
+    endpoint_IN, endpoint_OUT = DeviceProfile.bulk_endpoints(interface)
+    if endpoint_OUT == None:
+        print("serial_CH340:: Error: Could not find OUT-Endpoint!")
+    if endpoint_IN == None:
+        print("serial_CH340:: Error: Could not find IN-Endpoint!")
+    if endpoint_IN == None or endpoint_OUT == None:
+        return None
+    return DeviceProfile("CH340", interface.bInterfaceNumber, interface.bInterfaceNumber, endpoint_IN, endpoint_OUT)
+
+@register("CH340", ids=CH340_IDS)
+class serial_CH340(serial_USB):
+    probe = staticmethod(probe_CH340)
+
+    def setup(self):
+        try:
+            self.version = ctrl_transfer(self.dev,
+                usb.TYPE_VENDOR | usb.ENDPOINT_IN,
+                CH340_REQ_READ_VERSION,
+                0,
+                0,
+                2)[0]
+        except usb.core.USBError:
+            self.version = 0
+        print(f"serial_CH340:: chip version {hex(self.version)}")
         
         # OUT-Transfer, parameters are: bmRequestType, bmRequest, wValue, wIndex and data-payload
         # Helpful: https://gist.github.com/z4yx/8d9ecad151dad351fbbb
-        self.dev.ctrl_transfer(
+        ctrl_transfer(self.dev,
             usb.TYPE_VENDOR | usb.ENDPOINT_OUT,
             0xa1,
             0x00,
-            self.interface.index, # interface index
+            self.profile.control_interface, # interface number
             None)   # No data-payload
-        self.dev.ctrl_transfer(
+        ctrl_transfer(self.dev,
             usb.TYPE_VENDOR | usb.ENDPOINT_OUT,
             0x9a,
             0x2518,
             0x0050,
             None)   # No data-payload
-        self.dev.ctrl_transfer(
+        ctrl_transfer(self.dev,
             usb.TYPE_VENDOR | usb.ENDPOINT_OUT,
             0xa1,
             0x501f,
             0xd90a,
             None)   # No data-payload
-            
-        # set baud rate
-        baud = {
-            2400:   (0xd901, 0x0038), 
-            4800:   (0x6402, 0x001f), 
-            9600:   (0xb202, 0x0013), 
-            19200:  (0xd902, 0x000d), 
-            38400:  (0x6403, 0x000a), 
-            115200: (0xcc03, 0x0008)
-            }
-        if not self.baudrate in baud:
-            print(f"serial_CH340:: Error: requested {self.baudrate=} not in baud table!")
-            
-        self.dev.ctrl_transfer(
-            usb.TYPE_VENDOR | usb.ENDPOINT_OUT,
-            0x9a,
-            0x1312,
-            baud[self.baudrate][0],
-            None)   # No data-payload
-        self.dev.ctrl_transfer(
-            usb.TYPE_VENDOR | usb.ENDPOINT_OUT,
-            0x9a,
-            0x0f2c,
-            baud[self.baudrate][1],
-            None)   # No data-payload
-        
-        
         
-    def purge(self):
-        # Purge whatever the printer has sent while not being connected
-        while(True):
-            try:
-                self.endpoint_IN.read(64, timeout=1) # 1 millisecond timeout
-            except usb.core.USBTimeoutError:
-                break
-        
-    def write(self, data):
-        self.endpoint_OUT.write(data)
-        
-    def read(self, size=1024, timeout=1):
-        try:
-            return self.endpoint_IN.read(size, timeout=timeout).tobytes()
-        except usb.core.USBTimeoutError:
-            return b''
+    def set_baudrate(self, baudrate):
+        self.baudrate = baudrate
         
+        value, self.actual_baudrate = ch340_divisor(baudrate)
+        error = (self.actual_baudrate - baudrate) / baudrate * 100
+        print(f"serial_CH340:: {baudrate} baud: running at {self.actual_baudrate:.0f} ({error:+.2f}%), registers {value:#06x}")
+        if abs(error) > 2:
+            print(f"serial_CH340:: Warning: {baudrate} baud is {error:+.2f}% off, the printer may not understand us")
+        if self.version > 0x27:
+            value |= CH340_NO_BUFFERING
         
-    def close(self):
-        usb.util.release_interface(self.dev, self.interface)
+        # OUT-Transfer, parameters are: bmRequestType, bmRequest, wValue, wIndex and data-payload
+        ctrl_transfer(self.dev,
+            usb.TYPE_VENDOR | usb.ENDPOINT_OUT,
+            CH340_REQ_WRITE_REG,
+            CH340_REG_PRESCALER_DIVISOR,
+            value,
+            None)   # No data-payload
+        if baudrate in CH340_WCH_BAUDS:
+            ctrl_transfer(self.dev,
+                usb.TYPE_VENDOR | usb.ENDPOINT_OUT,
+                CH340_REQ_WRITE_REG,
+                CH340_REG_0F2C,
+                CH340_WCH_BAUDS[baudrate][1],
+                None)   # No data-payload
@@ -0,0 +1,63 @@
+import struct
+import usb.core
+import usb.util
+try: # part of the octoprint plugin package, or imported by serialDaemon.py as a script
+    from .usblib import (ctrl_transfer, CP210x_REQTYPE_HOST2DEVICE, CP210x_IFC_ENABLE, CP210x_UART_ENABLE,
+        CP210x_UART_DISABLE, CP210x_SET_LINE_CTL, CP210x_LINE_CTL_DEFAULT, CP210x_SET_FLOW, CP210x_SET_MHS,
+        CP210x_MHS_DEFAULT, CP210x_SET_BAUDRATE)
+    from .serialProfiles import DeviceProfile
+    from .serialDrivers import serial_USB, register
+except ImportError:
+    from usblib import (ctrl_transfer, CP210x_REQTYPE_HOST2DEVICE, CP210x_IFC_ENABLE, CP210x_UART_ENABLE,
+        CP210x_UART_DISABLE, CP210x_SET_LINE_CTL, CP210x_LINE_CTL_DEFAULT, CP210x_SET_FLOW, CP210x_SET_MHS,
+        CP210x_MHS_DEFAULT, CP210x_SET_BAUDRATE)
+    from serialProfiles import DeviceProfile
+    from serialDrivers import serial_USB, register
+
+# Silicon Labs CP210x on the same SerialSession as the other drivers. usblib.CP210xSerial, with its own threads and
+# buffers, stays around as a standalone library (usblib.py run as a script).
+# CP2102/CP2102N/CP2104/CP2109, CP2105 (dual), CP2108 (quad), the multi port ones are used on their first port
+CP210x_IDS = ((0x10C4, 0xEA60), (0x10C4, 0xEA70), (0x10C4, 0xEA71))
+
+# SET_FLOW without flow control (ulControlHandshake, ulFlowReplace, ulXonLimit, ulXoffLimit), as in usblib
+CP210x_FLOW_OFF = struct.pack("<IIII", 0x01, 0x40, 0x8000, 0x2000)
+
+def check_is_CP210x(dev):
+    return (dev.idVendor, dev.idProduct) in CP210x_IDS
+
+def probe_CP210x(dev):
+    # The first interface with a pair of bulk endpoints, None if this isn't a CP210x
+    if not check_is_CP210x(dev):
+        return None
+    for interface in dev.get_active_configuration():
+        endpoint_IN, endpoint_OUT = DeviceProfile.bulk_endpoints(interface)
+        if endpoint_IN is not None and endpoint_OUT is not None:
+            return DeviceProfile("CP210x", interface.bInterfaceNumber, interface.bInterfaceNumber, endpoint_IN, endpoint_OUT)
+    print("serial_CP210x:: Error: Could not find the bulk endpoints!")
+    return None
+
+@register("CP210x", ids=CP210x_IDS)
+class serial_CP210x(serial_USB):
+    probe = staticmethod(probe_CP210x)
+
+    def _request(self, request, value=0, data=None):
+        # Vendor requests go to the interface of the port
+        ctrl_transfer(self.dev, CP210x_REQTYPE_HOST2DEVICE, request, value, self.profile.control_interface, data)
+
+    def setup(self):
+        # Same defaults as usblib.CP210xSerial: UART on, 8N1, no flow control, modem lines left alone
+        self._request(CP210x_IFC_ENABLE, CP210x_UART_ENABLE)
+        self._request(CP210x_SET_LINE_CTL, CP210x_LINE_CTL_DEFAULT)
+        self._request(CP210x_SET_FLOW, 0, CP210x_FLOW_OFF)
+        self._request(CP210x_SET_MHS, CP210x_MHS_DEFAULT)
+
+    def set_baudrate(self, baudrate):
+        self.baudrate = baudrate
+        self._request(CP210x_SET_BAUDRATE, 0, struct.pack("<I", baudrate))
+
+    def close(self):
+        try:
+            self._request(CP210x_IFC_ENABLE, CP210x_UART_DISABLE)
+        except usb.core.USBError: # unplugged already
+            pass
+        super().close()
@@ -0,0 +1,418 @@
+import io
+import os
+import sys
+import random
+import tempfile
+import ctypes
+import contextlib
+from types import SimpleNamespace
+try: # part of the octoprint plugin package, or run as a script like serialBenchmark.py
+    from . import usblib
+    from .serialCH340 import ch340_divisor, clk_div, CH340_CLKRATE, CH340_WCH_BAUDS
+    from .serialFTDI import ftdi_divisor, baudrate_request
+    from . import serialCDCACM
+    from .serialBuffer import LineRing
+    from .serialSendAhead import SendAhead, SYNC_LINE
+    from .serialStreamer import FileStreamer
+except ImportError:
+    import usblib
+    from serialCH340 import ch340_divisor, clk_div, CH340_CLKRATE, CH340_WCH_BAUDS
+    from serialFTDI import ftdi_divisor, baudrate_request
+    import serialCDCACM
+    from serialBuffer import LineRing
+    from serialSendAhead import SendAhead, SYNC_LINE
+    from serialStreamer import FileStreamer
+
+# Checks that need no printer: python serialChecks.py [name ...] runs them (all by default) and exits with 1 if one of
+# them failed. Each check returns what went wrong, an empty list if nothing did.
+
+# Rates printers and people use, from 50 baud up to the CH340's 3 Mbaud
+CH340_RATES = (50, 110, 300, 1200, 2400, 4800, 9600, 14400, 19200, 38400, 57600, 115200, 230400, 250000, 460800,
+    500000, 921600, 1000000, 1500000, 2000000, 3000000)
+# 48 MHz divides into these without a remainder, the chip must hit them exactly
+CH340_EXACT_RATES = (250000, 500000, 1000000, 1500000, 2000000, 3000000)
+
+def ch340_rate(value):
+    # What the chip makes of a prescaler/divisor register value: 48 MHz / (2^(12 - 3 ps - fact) * divisor), as in the
+    # CH340 datasheet, without anything of ch340_divisor()'s
+    ps, fact, div = value & 0x03, value >> 2 & 1, 0x100 - (value >> 8 & 0xff)
+    return CH340_CLKRATE / ((1 << (12 - 3 * ps - fact)) * div)
+
+def ch340_best_error(baudrate):
+    # The smallest error any register value can get, trying them all (fact = 1 needs a divisor of at least 9)
+    return min(abs(CH340_CLKRATE / (clk_div(ps, fact) * div) - baudrate)
+        for ps in range(4) for fact in (0, 1) for div in range(9 if fact else 2, 256))
+
+def check_ch340():
+    failures = []
+    for baudrate, (value, _) in CH340_WCH_BAUDS.items():
+        computed = ch340_divisor(baudrate)[0]
+        if computed != value:
+            failures.append(f"{baudrate}: {computed:#06x} instead of WCH's {value:#06x}")
+    for baudrate in CH340_RATES:
+        value, actual = ch340_divisor(baudrate)
+        error = (actual - baudrate) / baudrate * 100
+        print(f"{baudrate:>8}: {value:#06x} {actual:>10.0f} {error:+.2f}%")
+        if actual != ch340_rate(value):
+            failures.append(f"{baudrate}: {value:#06x} runs at {ch340_rate(value):.0f}, not {actual:.0f}")
+        if abs(actual - baudrate) > ch340_best_error(baudrate) + 1e-6:
+            failures.append(f"{baudrate}: {error:+.2f}% off, other register values come closer")
+        if baudrate in CH340_EXACT_RATES and actual != baudrate:
+            failures.append(f"{baudrate}: not exact")
+    return failures
+
+# Divisors for the 48 MHz chips from FTDI's application note AN232B-05
+FTDI_AN232B_05 = {9600: 0x4138, 19200: 0x809c, 38400: 0xc04e, 57600: 0xc034, 115200: 0x001a, 3000000: 0x0000,
+    2000000: 0x0001}
+# bcdDevice -> whether SET_BAUD_RATE carries the port in wIndex
+FTDI_PORT_INDEX = {0x0600: False, 0x0500: True, 0x0700: True, 0x0800: True, 0x0900: True, 0x1000: True}
+
+def check_ftdi():
+    failures = []
+    for baudrate, value in FTDI_AN232B_05.items():
+        computed = ftdi_divisor(baudrate)[0]
+        if computed != value:
+            failures.append(f"{baudrate}: {computed:#06x} instead of AN232B-05's {value:#06x}")
+    for baudrate in CH340_RATES + (12000000,):
+        for high_speed in (False, True):
+            value, actual = ftdi_divisor(baudrate, high_speed)
+            error = (actual - baudrate) / baudrate * 100
+            print(f"{baudrate:>8}{' H' if high_speed else '  '}: {value:#07x} {actual:>10.0f} {error:+.2f}%")
+            # Below 300 baud the 14 bit divisor runs out (on 48 MHz chips, below 1200 on high speed ones)
+            if 300 <= baudrate <= (12000000 if high_speed else 3000000) and abs(error) > 3:
+                failures.append(f"{baudrate}{' on a high speed chip' if high_speed else ''}: {error:+.2f}% off")
+    # 115200 on a high speed chip: divisor 104.125 of 12 MHz, its upper bits and the port both go into wIndex
+    value = ftdi_divisor(115200, True)[0]
+    for bcdDevice, port_index in FTDI_PORT_INDEX.items():
+        wValue, wIndex = baudrate_request(value, bcdDevice, 2)
+        expected = (value & 0xFFFF, value >> 8 & 0xFF00 | 2) if port_index else (value & 0xFFFF, value >> 16)
+        if (wValue, wIndex) != expected:
+            failures.append(f"bcdDevice {bcdDevice:#06x}: SET_BAUD_RATE {wValue:#06x}/{wIndex:#06x}, "
+                f"not {expected[0]:#06x}/{expected[1]:#06x}")
+    return failures
+
+def set_line_coding(readback, *args):
+    # serial_CDCACM.set_line_coding(*args) on a device that answers GET_LINE_CODING with readback: (what it sent with
+    # SET_LINE_CODING, actual_baudrate, what it printed)
+    sent = []
+    def ctrl_transfer(dev, bmRequestType, bRequest, wValue, wIndex, data_or_wLength):
+        if bRequest == serialCDCACM.SET_LINE_CODING:
+            sent.append(bytes(data_or_wLength))
+            return len(data_or_wLength)
+        return readback
+    driver = serialCDCACM.serial_CDCACM.__new__(serialCDCACM.serial_CDCACM)
+    driver.dev, driver.profile = None, SimpleNamespace(control_interface=0)
+    saved, serialCDCACM.ctrl_transfer = serialCDCACM.ctrl_transfer, ctrl_transfer
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            driver.set_line_coding(*args)
+    finally:
+        serialCDCACM.ctrl_transfer = saved
+    return sent, driver.actual_baudrate, output.getvalue()
+
+def check_line_coding():
+    failures = []
+    # dwDTERate 2000000 little endian, 1 stop bit, no parity, 8 data bits
+    wanted = bytes.fromhex("80841e00000008")
+    if serialCDCACM.line_coding(2000000) != wanted:
+        failures.append(f"2 Mbaud 8N1 is {serialCDCACM.line_coding(2000000).hex()}, not {wanted.hex()}")
+    if serialCDCACM.line_coding(250000, 7, "E", 2) != bytes.fromhex("90d00300020207"):
+        failures.append(f"250000 baud 7E2 is {serialCDCACM.line_coding(250000, 7, 'E', 2).hex()}")
+
+    sent, actual, output = set_line_coding(wanted, 2000000)
+    if sent != [wanted]:
+        failures.append(f"sent {[data.hex() for data in sent]} for 2 Mbaud")
+    if actual != 2000000 or "Warning" in output:
+        failures.append(f"a matching readback: {actual} baud, {output.strip()!r}")
+
+    # A board that rounds the rate (or ignores it) must be noticed
+    sent, actual, output = set_line_coding(serialCDCACM.line_coding(1843200), 2000000)
+    if actual != 1843200 or "Warning" not in output:
+        failures.append(f"a mismatching readback: {actual} baud, {output.strip()!r}")
+    sent, actual, output = set_line_coding(wanted[:4], 2000000)
+    if actual != 2000000 or "Warning" not in output:
+        failures.append(f"a short readback: {actual} baud, {output.strip()!r}")
+    return failures
+
+def check_line_ring():
+    # Random reads and lines (among them some far too long, without b'\n') through a small LineRing, wrapping around
+    # many times: everything comes out in order, no line is longer than max_line and only cut lines miss their b'\n'
+    failures = []
+    rng = random.Random(4)
+    ring = LineRing(capacity=256, max_line=64, chunk=16)
+    data = b''.join(b"x" * rng.choice((1, 10, 60, 63, 64, 65, 100, 200)) + (b"\n" if rng.random() < 0.8 else b"")
+        for _ in range(2000)) + b"\n"
+    received = []
+    written = 0
+    while written < len(data) or len(ring):
+        if written < len(data) and rng.random() < 0.6:
+            space = ring.free(timeout=0)
+            n = min(len(space), len(data) - written, rng.randint(1, 100))
+            space[:n] = data[written:written + n]
+            ring.commit(n)
+            written += n
+            continue
+        segments, cut = ring.lines(timeout=0)
+        if not segments:
+            continue
+        block = b''.join(segments)
+        lines = block.splitlines(keepends=True)
+        received.extend((line, cut and i == len(lines) - 1) for i, line in enumerate(lines))
+        ring.release()
+    if b''.join(line for line, _ in received) != data:
+        failures.append("data came out different")
+    for line, cut in received:
+        if len(line) > ring.max_line:
+            failures.append(f"a line of {len(line)} bytes, max_line is {ring.max_line}")
+            break
+        if not cut and not line.endswith(b"\n"):
+            failures.append(f"a line without b'\\n' that wasn't cut: {line!r}")
+            break
+        if cut and len(line) != ring.max_line:
+            failures.append(f"a line cut at {len(line)} bytes instead of {ring.max_line}")
+            break
+    if ring.tail < 10 * ring.capacity:
+        failures.append("didn't wrap around")
+    print(f"{len(received)} lines, {ring.overflows} cut, {ring.tail // ring.capacity} times around")
+    return failures
+
+def fake_send_ahead(rx_budget=127, max_lines=4):
+    # A SendAhead writing into printer, forwarding into octoprint
+    printer, octoprint = [], []
+    ahead = SendAhead(lambda data, flush: printer.append(bytes(data)), rx_budget, max_lines)
+    ahead.attach(lambda data: octoprint.append(bytes(data)))
+    return ahead, printer, octoprint
+
+def check_send_ahead():
+    failures = []
+    def expect(what, got, wanted):
+        if got != wanted:
+            failures.append(f"{what}: {got!r} instead of {wanted!r}")
+
+    # Up to max_lines go out ahead, answered right away. The printer's "ok"s free up its buffer and get swallowed.
+    ahead, printer, octoprint = fake_send_ahead()
+    ahead.submit(b"".join(b"G1 X%d\n" % i for i in range(6)))
+    expect("sent ahead", len(printer), 4)
+    expect("early oks", b"".join(octoprint), b"ok\n" * 4)
+    ahead.received(b"ok\nok\n")
+    expect("sent after two oks", len(printer), 6)
+    expect("oks octoprint got", b"".join(octoprint).count(b"ok"), 6)
+    # M105 isn't answered early, its "ok" with the temperatures is octoprint's
+    octoprint.clear()
+    ahead.submit(b"M105\n")
+    ahead.received(b"ok\n" * 4)
+    ahead.received(b"ok T:210.0 /210.0\n")
+    expect("M105's answer", b"".join(octoprint), b"ok T:210.0 /210.0\n")
+    expect("in flight", ahead.stats()["in flight"], 0)
+    # The budget counts bytes as well
+    ahead, printer, octoprint = fake_send_ahead(rx_budget=20)
+    ahead.submit(b"G1 X100 Y100\nG1 X200 Y200\n")
+    expect("sent within 20 bytes", len(printer), 1)
+
+    # Octoprint swallows the "ok" after a resend request, so that one isn't swallowed here
+    ahead, printer, octoprint = fake_send_ahead()
+    ahead.submit(b"N1 G1 X1*33\n")
+    octoprint.clear()
+    ahead.received(b"Resend: 1\nok\n")
+    expect("after a resend", b"".join(octoprint), b"Resend: 1\nok\n")
+
+    # An overrun ate an "ok": sync() holds octoprint's lines back behind SYNC_LINE, whose "ok T:" tells which ones
+    # are gone
+    ahead, printer, octoprint = fake_send_ahead()
+    ahead.submit(b"G1 X1\nG1 X2\n")
+    ahead.sync()
+    expect("SYNC_LINE", printer[-1:], [SYNC_LINE])
+    ahead.submit(b"G1 X3\n")
+    expect("held back while syncing", b"G1 X3\n" in printer, False)
+    ahead.received(b"ok\nok T:20.0 /0.0\n") # the "ok" of G1 X2 got lost
+    stats = ahead.stats()
+    expect("syncs", stats["syncs"], 1)
+    expect("lost oks", stats["lost oks"], 1)
+    expect("sent after the sync", printer[-1:], [b"G1 X3\n"])
+    expect("in flight after the sync", stats["in flight"], 1)
+
+    # The printer reset: nothing in flight gets answered anymore, pending lines go out at once
+    ahead, printer, octoprint = fake_send_ahead(max_lines=2)
+    ahead.submit(b"G1 X1\nG1 X2\nG1 X3\n")
+    ahead.resync()
+    expect("sent after a reset", printer[-1:], [b"G1 X3\n"])
+    expect("in flight after a reset", ahead.stats()["in flight"], 1)
+    return failures
+
+STREAM_FILE = b"; a comment\nG28\n\nG1 X1 ; move\nG1 X2\nG1 X3\nG1 X4\nG1 X5\n"
+STREAM_LINES = (b"G28", b"G1 X1", b"G1 X2", b"G1 X3", b"G1 X4", b"G1 X5")
+
+def numbered(number, line):
+    # What the printer must get for line number number, with a checksum computed here
+    line = b"N%d %s" % (number, line)
+    checksum = 0
+    for byte in line:
+        checksum ^= byte
+    return b"%s*%d\n" % (line, checksum)
+
+def check_file_streamer():
+    failures = []
+    def expect(what, got, wanted):
+        if got != wanted:
+            failures.append(f"{what}: {got!r} instead of {wanted!r}")
+    printer, octoprint, events = [], [], []
+    with tempfile.NamedTemporaryFile(suffix=".gcode", delete=False) as f:
+        f.write(STREAM_FILE)
+    try:
+        streamer = FileStreamer(f.name, lambda data, flush: printer.append(bytes(data)),
+            lambda data: octoprint.append(bytes(data)), lambda event, **values: events.append((event, values)),
+            max_lines=4)
+        streamer.start()
+        expect("first lines", printer, [b"M110 N0\n"] + [numbered(n, STREAM_LINES[n - 1]) for n in (1, 2, 3)])
+
+        # N2 got garbled: the printer asks for it once per line in flight, N2 to N4 go out again, once
+        streamer.received(b"ok\nok\n")
+        printer.clear()
+        streamer.received(b"Error:checksum mismatch, Last Line: 1\nResend: 2\nok\n")
+        streamer.received(b"Error:Line Number is not Last Line Number+1, Last Line: 1\nResend: 2\nok\n")
+        expect("resends", [event for event, values in events].count("resend"), 1)
+
+        # Octoprint's temperature polling goes in between, its answer is octoprint's. A numbered line means octoprint
+        # is printing on its own, that's refused (with an "ok", octoprint waits for one).
+        streamer.inject(b"M105\nN7 G1 X9*99\n")
+        expect("octoprint's numbered line", b"".join(octoprint), b"ok\n")
+        for _ in range(20):
+            if streamer.done:
+                break
+            streamer.received(b"ok T:20.0 /0.0\n" if streamer.inflight[0][1] else b"ok\n")
+        expect("octoprint's M105", b"".join(octoprint), b"ok\nok T:20.0 /0.0\n")
+        expect("sent after the resend", [line for line in printer if line.startswith(b"N")],
+            [numbered(n, STREAM_LINES[n - 1]) for n in range(2, 7)])
+        expect("M105 in between", b"M105\n" in printer, True)
+        expect("refused lines", [line for line in printer if line.startswith(b"N7")], [])
+        done = [values for event, values in events if event == "done"]
+        expect("done", [(values["cancelled"], values["resends"], values["pos"]) for values in done],
+            [(False, 1, len(STREAM_FILE))])
+
+        # Picking up at a byte offset numbers from 1 again
+        printer.clear()
+        streamer = FileStreamer(f.name, lambda data, flush: printer.append(bytes(data)), lambda data: None,
+            lambda event, **values: None, start=STREAM_FILE.index(b"G1 X4"))
+        streamer.start()
+        expect("from an offset", printer, [b"M110 N0\n", numbered(1, b"G1 X4"), numbered(2, b"G1 X5")])
+    finally:
+        os.unlink(f.name)
+    return failures
+
+class FakeLibusb():
+    # The part of libusb's asynchronous API usblib.AsyncReader uses, without a device: submitted transfers complete
+    # (with data, or cancelled) when handle_events runs, like libusb only ever calls back from there
+    def __init__(self):
+        self.transfers = []     # everything allocated, with their cdata kept alive
+        self.submitted = []
+        self.cancelled = set()
+        self.freed = []
+        self.incoming = []      # data for the next completions
+        self.stuck = False      # cancelled transfers never complete, like a hung device
+
+    def libusb_alloc_transfer(self, iso_packets):
+        transfer = ctypes.pointer(usblib._Transfer())
+        self.transfers.append(transfer)
+        return transfer
+
+    def libusb_submit_transfer(self, transfer):
+        self.submitted.append(transfer)
+        return 0
+
+    def libusb_cancel_transfer(self, transfer):
+        self.cancelled.add(ctypes.addressof(transfer.contents))
+        return 0
+
+    def libusb_free_transfer(self, transfer):
+        self.freed.append(ctypes.addressof(transfer.contents))
+
+    def libusb_handle_events_timeout_completed(self, ctx, tv, completed):
+        submitted, self.submitted = self.submitted, []
+        for transfer in submitted:
+            t = transfer.contents
+            if ctypes.addressof(t) in self.cancelled:
+                if self.stuck:
+                    self.submitted.append(transfer)
+                    continue
+                t.status, t.actual_length = usblib.LIBUSB_TRANSFER_CANCELLED, 0
+            elif self.incoming:
+                data = self.incoming.pop(0)
+                ctypes.memmove(t.buffer, data, len(data))
+                t.status, t.actual_length = usblib.LIBUSB_TRANSFER_COMPLETED, len(data)
+            else:
+                self.submitted.append(transfer)
+                continue
+            t.callback(transfer)
+        return 0
+
+    def libusb_handle_events_completed(self, ctx, completed):
+        return self.libusb_handle_events_timeout_completed(ctx, None, completed)
+
+    def libusb_error_name(self, ret):
+        return b"LIBUSB_ERROR_OTHER"
+
+def fake_async_reader(lib, on_data, count):
+    # An AsyncReader on lib, for a bulk IN endpoint of a device that doesn't exist
+    device = SimpleNamespace(backend=SimpleNamespace(ctx=None),
+        _ctx=SimpleNamespace(handle=SimpleNamespace(handle=ctypes.c_void_p(0))))
+    endpoint = SimpleNamespace(device=device, bEndpointAddress=0x81, wMaxPacketSize=64, bmAttributes=0x02)
+    saved, usblib._async_lib = usblib._async_lib, lib
+    try:
+        return usblib.AsyncReader(endpoint, on_data, count)
+    finally:
+        usblib._async_lib = saved
+
+def check_async_reader():
+    # usblib.AsyncReader's bookkeeping: every transfer submitted, data in order and submitted again, cancel() stopping
+    # that, close() freeing each transfer once and only after it came back from libusb
+    failures = []
+    lib = FakeLibusb()
+    received = []
+    reader = fake_async_reader(lib, lambda data: received.append(bytes(data)), 4)
+    reader.start()
+    if len(lib.submitted) != 4:
+        failures.append(f"{len(lib.submitted)} of 4 transfers submitted")
+    lib.incoming = [b"ok\n", b"T:20", b"0\nok\n"]
+    reader.handle_events(0)
+    if received != [b"ok\n", b"T:20", b"0\nok\n"]:
+        failures.append(f"received {received}")
+    if reader.pending != 4:
+        failures.append(f"{reader.pending} transfers pending after completions instead of 4")
+    reader.cancel()
+    lib.incoming = [b"late"]
+    reader.close()
+    if reader.pending:
+        failures.append(f"{reader.pending} transfers still pending after close()")
+    if sorted(lib.freed) != sorted(ctypes.addressof(t.contents) for t in lib.transfers):
+        failures.append(f"freed {len(lib.freed)} transfers of {len(lib.transfers)}, or some twice")
+
+    # A transfer that never comes back must not be freed, libusb would write into freed memory later
+    lib = FakeLibusb()
+    reader = fake_async_reader(lib, lambda data: None, 2)
+    reader.start()
+    lib.stuck = True
+    reader.close()
+    if lib.freed:
+        failures.append("freed transfers libusb still had")
+    return failures
+
+CHECKS = {
+    "ch340": check_ch340,
+    "ftdi": check_ftdi,
+    "linecoding": check_line_coding,
+    "linering": check_line_ring,
+    "sendahead": check_send_ahead,
+    "streamer": check_file_streamer,
+    "asyncreader": check_async_reader,
+    }
+
+if __name__ == "__main__":
+    failed = False
+    for name in sys.argv[1:] or list(CHECKS):
+        failures = CHECKS[name]()
+        for failure in failures:
+            print(f"{name}: Error: {failure}")
+        print(f"{name}: {'failed' if failures else 'ok'}")
+        failed = failed or bool(failures)
+    sys.exit(1 if failed else 0)
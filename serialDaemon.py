@@ -1,80 +1,313 @@
 #!/usr/bin/env python3
 
-import usb
-import usb.core
-import usb.util
-import usb.control
-from usblib import device_from_fd
+import time
+STARTED = time.perf_counter() # before the other imports, so that they count towards the connect time
 import sys
-import array
 import os
-import time
-from multiprocessing.connection import Client
-from multiprocessing.connection import Listener
-from serialCDCACM import check_is_CDCACM, serial_CDCACM
-from serialCH340 import check_is_CH340, serial_CH340
+import signal
+import tempfile
+import threading
+import selectors
+import serialTransport
+from serialTransport import CHANNEL_DATA, CHANNEL_DATA_FLUSH, CHANNEL_CONTROL, ShmPipe
+from serialSession import SerialSession, open_serial, RX_MAX_LINE, RX_TIMEOUT, RX_TRANSFERS, TX_MAX_TRANSFER, TX_DEADLINE
+from serialEmulator import EMULATE_ENV, EMULATE_DELAY_ENV, serial_Emulated
+from serialTiming import ConnectTimer
+from serialSendAhead import SendAhead, SEND_AHEAD_ENV, SEND_AHEAD_LINES_ENV, RX_BUDGET, MAX_LINES
+from serialStreamer import FileStreamer
 
-def main(fd, debug=False):
-    dev = device_from_fd(fd)
-    
-    if dev.is_kernel_driver_active(0):
-        dev.detach_kernel_driver(0)
-        print("kernel driver detached")
+# After octoprint disconnected, the daemon keeps the usb device claimed and configured and its workers running for this
+# long (seconds), so that reconnecting (baudrate detection, error recovery, ...) only takes a socket connect. 0 quits
+# right away like before.
+IDLE_ENV = "TERMUX_CDC_ACM_IDLE"
+IDLE_TIMEOUT = 300
+
+# With TERMUX_CDC_ACM_TRACE (see usblib.start_trace), SIGUSR1 dumps the usb capture here as pcap. Octoprint can ask for
+# it with the "trace" command as well.
+TRACE_FILE_ENV = "TERMUX_CDC_ACM_TRACE_FILE"
+
+def report_errors(session):
+    for name, error in session.errors:
+        print(f"serialDaemon:: Error: {name} failed: {error}")
+
+def react_serial_state(event, ahead=None, streamer=None, telemetry=None):
+    # What the printer's usb side notified us of (see serialCDCACM's read_notification). A carrier going away is usually
+    # the board resetting: the "ok"s in flight never come, SendAhead starts counting over and a streamed file stops.
+    # An overrun lost bytes, an "ok" among them maybe: both sync up with the printer before sending on. Octoprint (if
+    # attached) gets an error right away either way.
+    if telemetry is not None:
+        telemetry("serial_state", **event)
+    others = [error for error in event["errors"] if error != "overrun"]
+    if others:
+        print(f"serialDaemon:: Warning: the printer's usb side reported {', '.join(others)}")
+    if event["lost"]:
+        reason = f"{', '.join(event['lost'])} went away, the printer reset"
+    elif "overrun" in event["errors"]:
+        reason = "the printer's usb side overran, lines may have been lost"
     else:
-        print("no kernel driver attached")
-     
-    # Configure usb-serial-converter
-    baudrate = int(os.environ["TERMUX_CDC_ACM_BAUDRATE"]) # From environment variable
-    
-    serial = None
-    if check_is_CDCACM(dev):
-        print("serialDaemon:: Connected device is DCDACM")
-        serial = serial_CDCACM(dev=dev, baudrate=baudrate)
-    if check_is_CH340(dev):
-        print("serialDaemon:: Connected device is CH340")
-        serial = serial_CH340(dev=dev, baudrate=baudrate)
-        
-    if serial:
-        # Create Ocotoprint-In-Printer-Out-listener for octoprint to attach to
-        OIPOaddress = ('localhost', 6001)     # family is deduced to be 'AF_INET'
-        OIPOlistener = Listener(OIPOaddress, authkey=b'secret password')
-        OIPOlistener._listener._socket.settimeout(3)
-        
-        # Connect to Octoprint-Out-Printer-In-listener of octoprint
-        OOPIaddress = ('localhost', 6000)
-        OOPIconn = Client(OOPIaddress, authkey=b'secret password')
-        
-        # Accept connection of octoprint on OIPOlistener
-        OIPOconn = OIPOlistener.accept()
-        
-        serial.purge() # clear whatever the printer has sent while octoprint wasn't connected
-        
-        databuf = b'' # Buffer to split received bytes into lines for octoprint's readline()
-        quitDaemon = False      
-        while not quitDaemon:
+        return
+    print(f"serialDaemon:: Warning: {reason}")
+    if telemetry is not None:
+        telemetry("error", reason=reason)
+    if streamer is not None and not streamer.done:
+        if event["lost"]:
+            streamer.abort()
+        else:
+            streamer.sync()
+    if ahead is not None:
+        if event["lost"]:
+            ahead.resync()
+        else:
+            ahead.sync()
+
+def start_stream(control, session, ahead, send, telemetry):
+    # A FileStreamer for octoprint's "stream" command, attached to the session, None (and "refused") if it can't start
+    if ahead is not None and (ahead.inflight or ahead.pending):
+        telemetry("refused", reason="lines of octoprint's are still in flight", streaming=False)
+        return None
+    try:
+        streamer = FileStreamer(control["path"], session.write, send, telemetry,
+            then=ahead.received if ahead is not None else send,
+            rx_budget=ahead.rx_budget if ahead is not None else RX_BUDGET,
+            max_lines=ahead.max_lines if ahead is not None else MAX_LINES,
+            start=control.get("start", 0))
+    except (OSError, ValueError) as e:
+        telemetry("refused", reason=f"can't stream {control['path']}: {e}", streaming=False)
+        return None
+    print(f"serialDaemon:: Streaming {control['path']} ({streamer.size} bytes)")
+    session.attach(streamer.received)
+    streamer.start()
+    return streamer
+
+def dump_trace(trace, path, telemetry=None):
+    # Writes usblib's capture ring (None if tracing is off) to path, for SIGUSR1 or octoprint's "trace" command
+    if trace is None:
+        if telemetry is not None:
+            telemetry("error", reason="tracing is off, see usblib.TRACE_ENV")
+        return
+    try:
+        records = trace.dump(path)
+    except OSError as e:
+        print(f"serialDaemon:: Error: can't write the trace to {path}: {e}")
+        if telemetry is not None:
+            telemetry("error", reason=f"can't write the trace to {path}: {e}")
+        return
+    print(f"serialDaemon:: Wrote {records} usb transfers to {path}")
+    if telemetry is not None:
+        telemetry("trace", path=path, records=records)
+
+def serve(conn, serial, session, wakeup_r, address, timer, ahead=None, trace=None):
+    # Attaches one octoprint connection to the session. Returns whether octoprint merely went away, so that the usb device
+    # is worth keeping around for the next connection, or whether the daemon should quit. The phases in timer go to
+    # serial_printer along with "ready". With ahead (SendAhead), lines go through it in both directions. trace is
+    # usblib's TraceRing while tracing.
+
+    # serial_printer starts with "open", which tells the baudrate and whether the data goes through shared memory rings
+    try:
+        channel, payload = conn.recv()
+    except (EOFError, OSError):
+        return True
+    opened = serialTransport.decode_control(payload)
+    baudrate = opened.get("baudrate", serial.baudrate)
+    if baudrate != serial.baudrate: # the only thing that needs the device to be touched again
+        print(f"serialDaemon:: Changing baudrate from {serial.baudrate} to {baudrate}")
+        with timer.phase("set baudrate"):
+            serial.set_baudrate(baudrate)
+    rx_pipe = tx_pipe = None
+    if opened.get("shm"):
+        with timer.phase("map shared memory"):
+            fds = conn.take_fds(2 * ShmPipe.FD_COUNT)
+            tx_pipe = ShmPipe(fds=fds[:ShmPipe.FD_COUNT])
+            rx_pipe = ShmPipe(fds=fds[ShmPipe.FD_COUNT:])
+        print("serialDaemon:: Exchanging data through shared memory")
+        send = lambda data: rx_pipe.write(data, timeout=RX_TIMEOUT/1000)
+    else:
+        def send(data):
             try:
-                if OOPIconn.poll():
-                    serial.write(OOPIconn.recv_bytes())
-            except EOFError: # This happens when the cdcacm_printer (__init__.py) closes the OOPIlistener
-                quitDaemon = True
+                conn.send(CHANNEL_DATA, data)
+            except OSError: # octoprint went away, the main loop notices that too and detaches us
+                pass
+    def telemetry(event, **values):
+        try:
+            conn.send_telemetry(event, **values)
+        except OSError:
+            pass
+    # Tells serial_printer where to find us again once it's gone. Before anything gets attached, so that it's the first
+    # frame serial_printer sees.
+    conn.send_control("ready", address=address, timings=timer.phases)
+    if ahead is not None:
+        ahead.attach(send)
+    else:
+        session.attach(send)
+    streamer = None # FileStreamer while a file streams, octoprint's lines go through it then
+    # octoprint hears of resets and overruns right away, not on its next timeout
+    session.watch(lambda event: react_serial_state(event, ahead, streamer, telemetry))
+    def write(data, flush=False):
+        if streamer is not None and not streamer.done:
+            streamer.inject(data, flush)
+        elif ahead is not None:
+            ahead.submit(data, flush)
+        else:
+            session.write(data, flush)
+
+    # The main loop only sleeps until octoprint sent something, or until one of the workers died
+    selector = selectors.DefaultSelector()
+    selector.register(conn, selectors.EVENT_READ, "octoprint")
+    selector.register(wakeup_r, selectors.EVENT_READ, "worker")
+    if tx_pipe is not None:
+        selector.register(tx_pipe, selectors.EVENT_READ, "shm")
+
+    warm = True
+    quitSession = False
+    while not quitSession:
+        for key, events in selector.select():
+            if key.data == "octoprint":
+                try:
+                    # recv() may have read several frames at once, handle all of them before sleeping again
+                    while True:
+                        channel, payload = conn.recv()
+                        if channel == CHANNEL_DATA:
+                            write(payload)
+                        elif channel == CHANNEL_DATA_FLUSH:
+                            write(payload, flush=True)
+                        elif channel == CHANNEL_CONTROL:
+                            control = serialTransport.decode_control(payload)
+                            if control["cmd"] == "quit":
+                                warm = False
+                                quitSession = True
+                            elif control["cmd"] == "stream":
+                                if streamer is None or streamer.done:
+                                    streamer = start_stream(control, session, ahead, send, telemetry)
+                                else:
+                                    telemetry("refused", reason=f"{streamer.path} is streaming already", streaming=True)
+                            elif control["cmd"] == "cancel" and streamer is not None:
+                                streamer.cancel()
+                            elif control["cmd"] == "trace":
+                                dump_trace(trace, control["path"], telemetry)
+                            else:
+                                print(f"serialDaemon:: Warning: ignoring control command {control['cmd']}")
+                        else:
+                            print(f"serialDaemon:: Warning: ignoring frame on unknown channel {channel}")
+                        if not conn.poll():
+                            break
+                except (EOFError, OSError): # This happens when serial_printer (serialPrinter.py) closes the connection
+                    quitSession = True
+                    break
+            elif key.data == "shm":
+                data = tx_pipe.read()
+                if data:
+                    write(data)
+            else:
+                report_errors(session)
+                warm = False
+                quitSession = True
                 break
-            
-            databuf += serial.read()
-            
-            if b'\n' in databuf:
-                line, databuf = databuf.split(b'\n', 1)
-                line = line+b'\n'
-                OIPOconn.send_bytes(line)
-                del(line)
-        serial.close
-        OOPIconn.close()
-        OIPOconn.close()
-        OIPOlistener.close()
+    selector.close()
+    if streamer is not None and not streamer.done: # octoprint wouldn't know where the print is after reconnecting
+        print("serialDaemon:: Octoprint went away while streaming, cancelling")
+        streamer.cancel()
+    if ahead is not None: # stays attached to the session, the printer still owes it the "ok"s of lines in flight
+        ahead.attach(None)
+        session.attach(ahead.received)
+    else:
+        session.attach(None)
+    session.watch(lambda event: react_serial_state(event, ahead))
+    for pipe in (rx_pipe, tx_pipe):
+        if pipe is not None:
+            pipe.close()
+    return warm
+
+def wait_for_octoprint(listener, wakeup_r, idle):
+    # The next connection to our own socket, None if nobody came within idle seconds or a worker died meanwhile
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ, "octoprint")
+    selector.register(wakeup_r, selectors.EVENT_READ, "worker")
+    try:
+        while True:
+            events = selector.select(idle)
+            if not events:
+                print("serialDaemon:: Nobody came back, quitting")
+                return None
+            if events[0][0].data == "worker":
+                return None
+            try:
+                return serialTransport.accept(listener)
+            except PermissionError as e:
+                print(e)
+    finally:
+        selector.close()
+
+def main(fd, debug=False):
+    timer = ConnectTimer()
+    timer.extend([["imports", time.perf_counter() - STARTED]])
+
+    # Configure usb-serial-converter
+    baudrate = int(os.environ["TERMUX_CDC_ACM_BAUDRATE"]) # From environment variable
+    trace = None
+    if os.environ.get(EMULATE_ENV) == "1":
+        serial = serial_Emulated(baudrate=baudrate, delay=float(os.environ.get(EMULATE_DELAY_ENV, 0))/1000)
     else:
-        print(f"serialDaemon:: Error: Couldn't find matching driver for usb device {hex(dev.idVendor)=}, {hex(dev.idProduct)=} !")
-        print(dev.get_active_configuration())
-    
+        with timer.phase("import usb"):
+            from usblib import device_from_fd, start_trace, TRACE_ENV
+        if int(os.environ.get(TRACE_ENV, 0)) > 0:
+            trace = start_trace(int(os.environ[TRACE_ENV]))
+            path = os.environ.get(TRACE_FILE_ENV, os.path.join(tempfile.gettempdir(), f"termux_cdc_acm_{os.getpid()}.pcap"))
+            # Not right in the handler, it may have interrupted a thread holding the ring's lock
+            signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=dump_trace, args=(trace, path)).start())
+            print(f"serialDaemon:: Tracing usb transfers, SIGUSR1 (kill -USR1 {os.getpid()}) writes them to {path}")
+        with timer.phase("device_from_fd"):
+            dev = device_from_fd(fd)
+        serial = open_serial(dev, baudrate, timer, fd=fd)
+
+    if serial:
+        # Our own socket, octoprint reconnects to it while we are idle
+        address = serialTransport.new_address()
+        listener = serialTransport.listen(address)
+        idle = float(os.environ.get(IDLE_ENV, IDLE_TIMEOUT))
+
+        # The workers keep running between connections, wakeup tells the main loop when one of them died
+        wakeup_r, wakeup_w = os.pipe()
+        wakeup = lambda: os.write(wakeup_w, b'\0')
+        session = SerialSession(serial, None, wakeup,
+            max_line=int(os.environ.get("TERMUX_CDC_ACM_MAX_LINE", RX_MAX_LINE)),
+            tx_max_transfer=int(os.environ.get("TERMUX_CDC_ACM_TX_MAX_TRANSFER", TX_MAX_TRANSFER)),
+            tx_deadline=float(os.environ.get("TERMUX_CDC_ACM_TX_DEADLINE", TX_DEADLINE)),
+            rx_transfers=int(os.environ.get("TERMUX_CDC_ACM_RX_TRANSFERS", RX_TRANSFERS)))
+        with timer.phase("purge"):
+            session.start()
+        ahead = None
+        rx_budget = int(os.environ.get(SEND_AHEAD_ENV, 0))
+        if rx_budget > 0:
+            ahead = SendAhead(session.write, rx_budget, int(os.environ.get(SEND_AHEAD_LINES_ENV, MAX_LINES)))
+            session.attach(ahead.received)
+        session.watch(lambda event: react_serial_state(event, ahead))
+        if ahead is not None:
+            print(f"serialDaemon:: Sending ahead up to {ahead.max_lines} lines / {rx_budget} bytes")
 
-fd = int(sys.argv[1])
-main(fd)
+        # Connect to the session's unix socket that octoprint is listening on
+        with timer.phase("connect"):
+            conn = serialTransport.connect(os.environ[serialTransport.ADDRESS_ENV])
+        while conn is not None:
+            warm = serve(conn, serial, session, wakeup_r, address, timer, ahead, trace)
+            conn.close()
+            conn = None
+            if warm and idle:
+                print(f"serialDaemon:: Octoprint disconnected, keeping the printer open for {idle:g}s")
+                conn = wait_for_octoprint(listener, wakeup_r, idle)
+                timer = ConnectTimer()
+        report_errors(session)
+        session.stop()
+        if ahead is not None:
+            print(f"serialDaemon:: Send-ahead: {ahead.stats()}")
+        if trace is not None:
+            print(f"serialDaemon:: Trace: {trace.stats()}")
+        if getattr(serial, "counters", None):
+            print(f"serialDaemon:: Serial state: {serial.counters}")
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+        serialTransport.close_listener(listener, address)
+        serial.close()
 
+if __name__ == "__main__":
+    fd = int(sys.argv[1])
+    main(fd)
@@ -0,0 +1,118 @@
+import usb
+import usb.core
+import usb.util
+try: # part of the octoprint plugin package, or imported by serialDaemon.py as a script
+    from .usblib import read_into, Endpoint, AsyncReader
+except ImportError:
+    from usblib import read_into, Endpoint, AsyncReader
+
+# Which driver handles which usb-serial-converter. Drivers register themselves with @register: by VID/PID for vendor
+# specific chips (CH340, CP210x, ...) and by interface class for standard ones (CDC-ACM). Matching a device is a dict
+# lookup or two instead of probing every driver in turn, probe() then only runs for the one that matched.
+DRIVERS = {}    # name (DeviceProfile.driver) -> driver class
+BY_ID = {}      # (idVendor, idProduct) -> driver class
+BY_CLASS = {}   # bInterfaceClass -> driver class
+
+def register(name, ids=(), interface_class=None):
+    def decorate(cls):
+        cls.name = name
+        DRIVERS[name] = cls
+        for vid_pid in ids:
+            BY_ID[vid_pid] = cls
+        if interface_class is not None:
+            BY_CLASS[interface_class] = cls
+        return cls
+    return decorate
+
+def load_drivers():
+    # The driver modules register themselves when imported
+    try:
+        from . import serialCDCACM, serialCH340, serialCP210x, serialFTDI
+    except ImportError:
+        import serialCDCACM, serialCH340, serialCP210x, serialFTDI
+
+def match(dev):
+    # The driver class for dev, None if there is none. VID/PID first, a vendor specific chip may have a class interface
+    # of its own that isn't the one to talk to.
+    driver = BY_ID.get((dev.idVendor, dev.idProduct))
+    if driver is not None:
+        return driver
+    for interface in dev.get_active_configuration():
+        driver = BY_CLASS.get(interface.bInterfaceClass)
+        if driver is not None:
+            return driver
+    return None
+
+
+class serial_USB():
+    # What all drivers have in common: claiming the interfaces, the endpoints from the profile and the transfers on
+    # them. A driver only describes its device: probe() finds the interfaces and endpoints, setup() does the control
+    # transfers configuring the converter and set_baudrate() those for the baudrate. Everything else happens in
+    # SerialSession (USBReader, USBWriter), the same for every driver.
+    name = None
+    endpoint_notify = None  # interrupt IN endpoint of drivers with notifications, see SerialSession's NotificationReader
+
+    def __init__(self, dev, baudrate, profile=None):
+        self.dev = dev
+        self.baudrate = baudrate
+        self.profile = profile if profile is not None else self.probe(dev)
+
+        # Lock usb device
+        for interface in self.profile.interfaces:
+            usb.util.claim_interface(self.dev, interface)
+
+        # The endpoints straight from the profile, transfers on them don't look anything up in the descriptors
+        self.endpoint_IN = Endpoint(self.dev, *self.profile.endpoint_IN, self.profile.data_interface)
+        self.endpoint_OUT = Endpoint(self.dev, *self.profile.endpoint_OUT, self.profile.data_interface)
+
+        self.setup()
+        self.set_baudrate(self.baudrate)
+
+    @staticmethod
+    def probe(dev):
+        # A DeviceProfile for dev, None if the driver can't handle it after all
+        raise NotImplementedError
+
+    def setup(self):
+        # Control transfers that configure the converter once, after claiming its interfaces
+        pass
+
+    def set_baudrate(self, baudrate):
+        # Also used by serialDaemon when octoprint comes back to a warm session with a different baudrate
+        raise NotImplementedError
+
+    def purge(self):
+        # Purge whatever the printer has sent while not being connected
+        while(True):
+            try:
+                self.endpoint_IN.read(self.endpoint_IN.wMaxPacketSize, timeout=1) # 1 millisecond timeout
+            except usb.core.USBTimeoutError:
+                break
+
+    def write(self, data, timeout=None):
+        # Returns how many bytes got through, 0 if the printer didn't take anything within timeout
+        try:
+            return self.endpoint_OUT.write(data, timeout=timeout)
+        except usb.core.USBTimeoutError:
+            return 0
+
+    def read(self, size=1024, timeout=1):
+        try:
+            return self.endpoint_IN.read(size, timeout=timeout).tobytes()
+        except usb.core.USBTimeoutError:
+            return b''
+
+    def read_into(self, buffer, timeout=1):
+        # Reads straight into buffer (e.g. a memoryview into a ring buffer), returns how many bytes arrived
+        try:
+            return read_into(self.dev, self.endpoint_IN, buffer, timeout=timeout)
+        except usb.core.USBTimeoutError:
+            return 0
+
+    def async_reader(self, on_data, count, size=None):
+        # count transfers always waiting on the IN-endpoint (see usblib.AsyncReader), instead of read_into() one at a time
+        return AsyncReader(self.endpoint_IN, on_data, count, size)
+
+    def close(self):
+        for interface in self.profile.interfaces:
+            usb.util.release_interface(self.dev, interface)
@@ -0,0 +1,218 @@
+import time
+import threading
+from collections import deque
+
+# A printer that only exists in software, for benchmarks and stress tests without hardware. With TERMUX_CDC_ACM_EMULATE=1
+# serial_printer starts serialDaemon.py directly instead of through termux-usb, and the daemon uses serial_Emulated
+# instead of a usb driver.
+EMULATE_ENV = "TERMUX_CDC_ACM_EMULATE"
+EMULATE_DELAY_ENV = "TERMUX_CDC_ACM_EMULATE_DELAY" # milliseconds until the emulated printer answers a line
+
+class EmulatedEndpoint():
+    def __init__(self, wMaxPacketSize):
+        self.wMaxPacketSize = wMaxPacketSize
+
+
+class serial_Emulated():
+    # Same interface as the drivers (serialDrivers.serial_USB). Answers every line it gets with "ok" (M105 with temperatures)
+    # after delay seconds, handing out at most one packet per read like a full speed usb device.
+    def __init__(self, baudrate=115200, delay=0.0, packet_size=64, transfer_time=0.0):
+        self.baudrate = baudrate
+        self.delay = delay
+        self.transfer_time = transfer_time  # seconds each write takes, like waiting for the next usb frame
+        self.transfers = 0
+        self.endpoint_IN = EmulatedEndpoint(packet_size)
+        self.endpoint_OUT = EmulatedEndpoint(packet_size)
+        self.incoming = b''         # start of a line that hasn't been completed yet
+        self.replies = deque()      # (when, reply) of what the printer is going to send
+        self.changed = threading.Condition()
+        self.lines_received = 0
+
+    def _reply(self, line):
+        if line.startswith(b"M105"):
+            return b"ok T:210.0 /210.0 B:60.0 /60.0 @:64 B@:0\n"
+        return b"ok\n"
+
+    def set_baudrate(self, baudrate):
+        self.baudrate = baudrate
+
+    def purge(self):
+        with self.changed:
+            self.replies.clear()
+
+    def write(self, data, timeout=None):
+        self.transfers += 1
+        if self.transfer_time:
+            time.sleep(self.transfer_time)
+        lines = (self.incoming + bytes(data)).split(b'\n')
+        self.incoming = lines.pop()
+        if lines:
+            when = time.monotonic() + self.delay
+            with self.changed:
+                self.lines_received += len(lines)
+                self.replies.extend((when, self._reply(line)) for line in lines)
+                self.changed.notify_all()
+        return len(data)
+
+    def read_into(self, buffer, timeout=1):
+        deadline = time.monotonic() + timeout/1000
+        with self.changed:
+            while True:
+                now = time.monotonic()
+                if self.replies and self.replies[0][0] <= now:
+                    break
+                if now >= deadline:
+                    return 0
+                wait = deadline - now
+                if self.replies:
+                    wait = min(wait, self.replies[0][0] - now)
+                self.changed.wait(wait)
+
+            # Pack whatever is due into one packet
+            size = min(len(buffer), self.endpoint_IN.wMaxPacketSize)
+            n = 0
+            while self.replies and self.replies[0][0] <= now and n < size:
+                reply = self.replies[0][1]
+                part = reply[:size - n]
+                buffer[n:n + len(part)] = part
+                n += len(part)
+                if len(part) < len(reply):
+                    self.replies[0] = (self.replies[0][0], reply[len(part):])
+                else:
+                    self.replies.popleft()
+            return n
+
+    def read(self, size=1024, timeout=1):
+        buffer = bytearray(size)
+        return bytes(buffer[:self.read_into(buffer, timeout)])
+
+    def close(self):
+        pass
+
+
+class EmulatedAsyncReader():
+    # Same interface as usblib.AsyncReader, on serial_EmulatedStream
+    def __init__(self, device, on_data, count, size):
+        self.device = device
+        self.on_data = on_data
+        self.count = count
+        self.size = size
+        self.error = None
+        self.transfers = 0
+        self.bytes = 0
+
+    def start(self):
+        self.device.submit(self.count, self.size)
+
+    def handle_events(self, timeout=0.1):
+        for data in self.device.completed(timeout):
+            self.transfers += 1
+            self.bytes += len(data)
+            self.on_data(memoryview(data))
+            self.device.submit(1, self.size)
+
+    def stats(self):
+        return {"transfers": self.transfers, "bytes": self.bytes, "starved": self.device.starved}
+
+    def close(self):
+        self.device.submit(-self.device.submitted, self.size)
+
+
+class serial_EmulatedStream():
+    # A device that keeps sending at line rate (baudrate/10 bytes per second), like a printer dumping a long listing.
+    # Every 1ms usb frame the new bytes go into the transfers the host has waiting, what doesn't fit into them into a
+    # fifo_size byte FIFO, and what doesn't fit there either is lost (an overrun), like on a CH340 or a printer's MCU.
+    FRAME = 0.001
+    PATTERN = b"echo: streaming 0123456789 abcdefghijklmnopqrstuvwxyz\n"
+
+    def __init__(self, baudrate=1000000, fifo_size=64, packet_size=64):
+        self.baudrate = baudrate
+        self.fifo_size = fifo_size
+        self.endpoint_IN = EmulatedEndpoint(packet_size)
+        self.endpoint_OUT = EmulatedEndpoint(packet_size)
+        self.fifo = 0               # bytes waiting in the device
+        self.submitted = 0          # transfers the host has waiting (async_reader())
+        self.size = 0               # their size
+        self.done = deque()         # completed transfers
+        self.sent = 0               # bytes the device produced
+        self.overruns = 0           # bytes it lost
+        self.starved = 0            # frames without a transfer waiting while there was data
+        self.offset = 0             # into PATTERN, which the data repeats
+        self.changed = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _frame(self, new):
+        # One usb frame: new bytes arrive, the host's waiting transfers take what they can (a short packet ends one)
+        self.sent += new
+        self.fifo += new
+        if self.fifo and not self.submitted:
+            self.starved += 1
+        while self.fifo and self.submitted:
+            n = min(self.fifo, self.size)
+            self.fifo -= n
+            self.submitted -= 1
+            self.done.append(self._payload(n))
+            if n < self.size:
+                break
+        if self.fifo > self.fifo_size:
+            self.overruns += self.fifo - self.fifo_size
+            self.fifo = self.fifo_size
+
+    def _payload(self, n):
+        start = self.offset % len(self.PATTERN)
+        self.offset += n
+        return (self.PATTERN * (2 + n // len(self.PATTERN)))[start:start + n]
+
+    def _run(self):
+        # Catches up frame by frame after the thread didn't get to run for a while, the device doesn't wait for us
+        per_frame = self.baudrate / 10 * self.FRAME
+        frame = 0
+        start = time.monotonic()
+        while not self.stopped:
+            time.sleep(max(0, start + (frame + 1) * self.FRAME - time.monotonic()))
+            with self.changed:
+                while start + (frame + 1) * self.FRAME <= time.monotonic():
+                    frame += 1
+                    self._frame(int(frame * per_frame) - self.sent)
+                self.changed.notify_all()
+
+    def submit(self, count, size):
+        with self.changed:
+            self.submitted += count
+            self.size = size
+
+    def completed(self, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.done or self.stopped, timeout)
+            done, self.done = self.done, deque()
+        return done
+
+    def read_into(self, buffer, timeout=1):
+        # A synchronous read is one transfer waiting until the next frame
+        with self.changed:
+            self.submitted += 1
+            self.size = len(buffer)
+            if not self.changed.wait_for(lambda: self.done or self.stopped, timeout/1000) or not self.done:
+                self.submitted -= 1 # cancelled
+                return 0
+            data = self.done.popleft()
+        buffer[:len(data)] = data
+        return len(data)
+
+    def async_reader(self, on_data, count, size=None):
+        return EmulatedAsyncReader(self, on_data, count, size or 8 * self.endpoint_IN.wMaxPacketSize)
+
+    def purge(self):
+        with self.changed:
+            self.fifo = 0
+
+    def write(self, data, timeout=None):
+        return len(data)
+
+    def close(self):
+        self.stopped = True
+        with self.changed:
+            self.changed.notify_all()
+        self.thread.join()
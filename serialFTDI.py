@@ -0,0 +1,186 @@
+import os
+import usb.core
+import usb.util
+try: # part of the octoprint plugin package, or imported by serialDaemon.py as a script
+    from .usblib import ctrl_transfer, AsyncReader
+    from .serialProfiles import DeviceProfile
+    from .serialDrivers import serial_USB, register
+except ImportError:
+    from usblib import ctrl_transfer, AsyncReader
+    from serialProfiles import DeviceProfile
+    from serialDrivers import serial_USB, register
+
+# FTDI FT232R/FT232H/FT2232/FT4232H/FT230X, without pyftdi (or the kernel's ftdi_sio, which android doesn't let us use).
+# FT232R, FT2232C/D (H: high speed), FT4232H, FT232H, FT230X/FT231X. Multi port chips are used on their first port.
+FTDI_IDS = ((0x0403, 0x6001), (0x0403, 0x6010), (0x0403, 0x6011), (0x0403, 0x6014), (0x0403, 0x6015))
+
+# The chip sends what it has received once a packet is full or when the latency timer runs out. Its default of 16 ms
+# comes on top of every "ok", 1 ms makes it answer about as fast as a CDC-ACM board.
+LATENCY_ENV = "TERMUX_CDC_ACM_FTDI_LATENCY"
+LATENCY = 1     # milliseconds, 1 to 255
+
+# Vendor requests
+SIO_RESET = 0x00
+SIO_SET_MODEM_CTRL = 0x01
+SIO_SET_FLOW_CTRL = 0x02
+SIO_SET_BAUD_RATE = 0x03
+SIO_SET_DATA = 0x04
+SIO_SET_LATENCY_TIMER = 0x09
+SIO_GET_LATENCY_TIMER = 0x0A
+REQTYPE_OUT = usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE
+REQTYPE_IN = usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE
+SIO_RESET_SIO = 0
+SIO_RESET_PURGE_RX = 1
+SIO_RESET_PURGE_TX = 2
+SIO_DATA_8N1 = 0x0008
+
+# Every IN packet starts with two status bytes: modem status and line status
+STATUS_SIZE = 2
+LINE_ERRORS = 0x1E  # overrun, parity, framing error and break bits of the line status
+# -> serial.counters, named like serialCDCACM's SERIAL_STATE counters
+LINE_ERROR_BITS = (("overrun", 0x02), ("parity", 0x04), ("framing", 0x08), ("break", 0x10))
+MODEM_RI = 0x40
+MODEM_CARRIERS = (("dsr", 0x20), ("dcd", 0x80))
+
+# bcdDevice of the high speed chips, their baudrate generator runs at 120 MHz instead of 48 MHz
+HIGH_SPEED_CHIPS = (0x0700, 0x0800, 0x0900)  # FT2232H, FT4232H, FT232H
+# These take the port in the low byte of SET_BAUD_RATE's wIndex as well, the others only the divisor's upper bits
+PORT_INDEX_CHIPS = (0x0500, 0x1000) + HIGH_SPEED_CHIPS  # FT2232C/D, FT230X/FT231X
+FRACTIONS = (0, 3, 2, 4, 1, 5, 6, 7)        # eighths of the divisor -> how the chip encodes them
+
+def ftdi_divisor(baudrate, high_speed=False):
+    # (divisor register value, baudrate the chip actually runs at) like the Linux ftdi_sio driver computes them: an
+    # integer divisor with a fraction in eighths of 3 MHz (12 MHz on high speed chips, which can't go below 1200 baud
+    # that way)
+    high_speed = high_speed and baudrate >= 1200
+    clock = 12000000 if high_speed else 3000000
+    divisor3 = max(8, (8 * clock + baudrate // 2) // baudrate)  # the divisor shifted 3 bits to the left
+    if divisor3 < 16 and divisor3 not in (8, 12): # below 2 only 1 and 1.5 work
+        divisor3 = min((8, 12, 16), key=lambda d: abs(d - divisor3))
+    divisor3 = min(divisor3, 0x3FFF << 3 | 7)
+    value = divisor3 >> 3 | FRACTIONS[divisor3 & 7] << 14
+    if value == 1:          # 1.0
+        value = 0
+    elif value == 0x4001:   # 1.5
+        value = 1
+    if high_speed:
+        value |= 0x20000    # no divide by 2.5, which is what gets 12 MHz out of 120 MHz
+    return value, 8 * clock / divisor3
+
+def baudrate_request(value, bcdDevice, port):
+    # (wValue, wIndex) of SET_BAUD_RATE for a divisor register value: the divisor's upper bits go into wIndex
+    if bcdDevice in PORT_INDEX_CHIPS:
+        return value & 0xFFFF, value >> 8 & 0xFF00 | port
+    return value & 0xFFFF, value >> 16
+
+def check_is_FTDI(dev):
+    return (dev.idVendor, dev.idProduct) in FTDI_IDS
+
+def probe_FTDI(dev):
+    # The first interface with a pair of bulk endpoints, None if this isn't an FTDI chip
+    if not check_is_FTDI(dev):
+        return None
+    for interface in dev.get_active_configuration():
+        endpoint_IN, endpoint_OUT = DeviceProfile.bulk_endpoints(interface)
+        if endpoint_IN is not None and endpoint_OUT is not None:
+            return DeviceProfile("FTDI", interface.bInterfaceNumber, interface.bInterfaceNumber, endpoint_IN, endpoint_OUT)
+    print("serial_FTDI:: Error: Could not find the bulk endpoints!")
+    return None
+
+@register("FTDI", ids=FTDI_IDS)
+class serial_FTDI(serial_USB):
+    probe = staticmethod(probe_FTDI)
+
+    @property
+    def port(self):
+        # Requests address the port as its interface number + 1
+        return self.profile.control_interface + 1
+
+    def _request(self, request, value=0):
+        ctrl_transfer(self.dev, REQTYPE_OUT, request, value, self.port, None)
+
+    def setup(self):
+        self.high_speed = self.dev.bcdDevice in HIGH_SPEED_CHIPS
+        self.packet_size = self.endpoint_IN.wMaxPacketSize
+        self.modem_status = 0
+        self.line_status = 0
+        self.counters = dict.fromkeys(tuple(name for name, bit in LINE_ERROR_BITS) + ("ring", "dcd lost", "dsr lost"), 0)
+        self._request(SIO_RESET, SIO_RESET_SIO)
+        self._request(SIO_SET_DATA, SIO_DATA_8N1)
+        self._request(SIO_SET_FLOW_CTRL, 0)
+        self.set_latency_timer(int(os.environ.get(LATENCY_ENV, LATENCY)))
+
+    def set_latency_timer(self, latency):
+        self._request(SIO_SET_LATENCY_TIMER, max(1, min(latency, 255)))
+        print(f"serial_FTDI:: latency timer {self.get_latency_timer()} ms")
+
+    def get_latency_timer(self):
+        return ctrl_transfer(self.dev, REQTYPE_IN, SIO_GET_LATENCY_TIMER, 0, self.port, 1)[0]
+
+    def set_baudrate(self, baudrate):
+        self.baudrate = baudrate
+        value, self.actual_baudrate = ftdi_divisor(baudrate, self.high_speed)
+        error = (self.actual_baudrate - baudrate) / baudrate * 100
+        print(f"serial_FTDI:: {baudrate} baud: running at {self.actual_baudrate:.0f} ({error:+.2f}%), divisor {value:#07x}")
+        if abs(error) > 2:
+            print(f"serial_FTDI:: Warning: {baudrate} baud is {error:+.2f}% off, the printer may not understand us")
+        value, index = baudrate_request(value, self.dev.bcdDevice, self.port)
+        ctrl_transfer(self.dev, REQTYPE_OUT, SIO_SET_BAUD_RATE, value, index, None)
+
+    def purge(self):
+        # Reading until a timeout never ends, a status packet comes every latency period. The chip's buffers get purged
+        # instead, then what was on its way already gets read.
+        self._request(SIO_RESET, SIO_RESET_PURGE_RX)
+        self._request(SIO_RESET, SIO_RESET_PURGE_TX)
+        while self.read(self.packet_size, timeout=1):
+            pass
+
+    def _status(self, status):
+        # Every packet has one, only changes and errors cost more than the comparison
+        modem, line = status[0], status[1] if len(status) > 1 else 0
+        if line & LINE_ERRORS or modem != self.modem_status:
+            self._count(modem, line)
+        self.modem_status, self.line_status = modem, line
+
+    def _count(self, modem, line):
+        for name, bit in LINE_ERROR_BITS:
+            if line & bit:
+                self.counters[name] += 1
+        if modem & MODEM_RI and not self.modem_status & MODEM_RI:
+            self.counters["ring"] += 1
+        for name, bit in MODEM_CARRIERS:
+            if self.modem_status & bit and not modem & bit:
+                self.counters[f"{name} lost"] += 1
+
+    def _payloads(self, data):
+        # The data of each packet in a transfer, as memoryviews into it
+        view = memoryview(data)
+        payloads = []
+        for start in range(0, len(view), self.packet_size):
+            self._status(view[start:start+STATUS_SIZE])
+            if len(view) - start > STATUS_SIZE:
+                payloads.append(view[start+STATUS_SIZE:start+self.packet_size])
+        return payloads
+
+    def read_into(self, buffer, timeout=1):
+        # Reads into buffer and moves the packets' data together in place, over their status bytes. With the latency
+        # timer the chip sends a status only packet every few milliseconds, that's a read of 0 bytes here. Only used
+        # without asynchronous transfers (RX_TRANSFERS = 0 or no libusb for them), async_reader() doesn't move anything.
+        n = super().read_into(buffer, timeout)
+        view = memoryview(buffer)
+        end = 0
+        for payload in self._payloads(view[:n]):
+            view[end:end+len(payload)] = payload
+            end += len(payload)
+        return end
+
+    def read(self, size=1024, timeout=1):
+        # Only purge() uses it
+        return b''.join(self._payloads(super().read(size, timeout)))
+
+    def async_reader(self, on_data, count, size=None):
+        # on_data gets the data of each packet as a view into the transfer, nothing gets copied for the status bytes
+        def received(data):
+            for payload in self._payloads(data):
+                on_data(payload)
+        return AsyncReader(self.endpoint_IN, received, count, size)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+# Launched through "termux-usb -e", which only hands the usb file descriptor to its child. All this does is pass it on
+# to serial_printer over the session's unix socket (SCM_RIGHTS), so that octoprint can drive the printer in-process.
+# It stays around until serial_printer closes the connection, so that termux-usb doesn't tear anything down early.
+
+import sys
+import os
+import serialTransport
+
+def main(fd):
+    conn = serialTransport.connect(os.environ[serialTransport.ADDRESS_ENV])
+    conn.send_control("usb_fd", fds=[fd])
+    try:
+        while True:
+            conn.recv()
+    except (EOFError, OSError):
+        pass
+    conn.close()
+
+
+if __name__ == "__main__":
+    fd = int(sys.argv[1])
+    main(fd)
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import ctypes
+import select
+import logging
+import threading
+import subprocess
+
+PORT_TTL = 10           # seconds after which the port list gets refreshed anyway
+MIN_INTERVAL = 1        # seconds between two refreshes, no matter how often they get asked for
+SETTLE_TIME = 0.2       # seconds to let a device finish appearing before listing the ports
+READY_TIMEOUT = 2       # seconds octoprint waits at most for the very first listing (termux-usb -l takes ~0.5s)
+PORT_PREFIX = "/dev/bus/usb/"   # what termux-usb's device names look like
+WATCH_DIR = "/dev/bus/usb"
+
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+logger = logging.getLogger("octoprint.plugins.Termux_CDC_ACM")
+
+def termux_usb_list():
+    # Goes through the Termux:API app, which takes hundreds of milliseconds
+    return json.loads(subprocess.check_output(['termux-usb', '-l']))
+
+def _inotify(path):
+    # An inotify fd that becomes readable when usb devices come or go below path, None where that isn't possible (no
+    # inotify, or no access to /dev/bus/usb, which is the normal case for Android apps)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    try:
+        dirs = [path] + [entry.path for entry in os.scandir(path) if entry.is_dir()] # one directory per bus
+    except OSError:
+        dirs = []
+    watched = [d for d in dirs if libc.inotify_add_watch(fd, d.encode(), IN_CREATE | IN_DELETE) >= 0]
+    if not watched:
+        os.close(fd)
+        return None
+    return fd
+
+def _drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+class PortInventory():
+    # The usb ports termux-usb knows about, kept up to date by a background thread, so that octoprint refreshing its
+    # connection panel never waits for termux-usb. The thread lists the ports again after PORT_TTL, when something
+    # changed in /dev/bus/usb (if we may watch it), or when kick() asked for it.
+    def __init__(self, list_ports=termux_usb_list, ttl=PORT_TTL, watch_dir=WATCH_DIR):
+        self.list_ports = list_ports
+        self.ttl = ttl
+        self.watch_dir = watch_dir
+        self.names = []             # sorted, for octoprint's dropdown
+        self.ports = frozenset()    # the same, for lookups
+        self.refreshed = 0          # time.monotonic() of the last refresh
+        self.ready = threading.Event()  # set after the first refresh
+        self.stopped = False
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.thread = threading.Thread(target=self._run, name="PortInventory", daemon=True)
+
+    def __contains__(self, port):
+        return port in self.ports
+
+    def start(self):
+        self.thread.start()
+
+    def kick(self):
+        # Refresh soon, without waiting for it
+        os.write(self.wakeup_w, b'\0')
+
+    def wait(self, timeout=READY_TIMEOUT):
+        # Waits up to timeout for the first refresh, returns whether there has been one
+        return self.ready.wait(timeout)
+
+    def missed(self, port):
+        # Someone asked for a port we don't know: if it looks like one of termux-usb's, a printer may have been plugged
+        # in since the last refresh (nothing tells us where /dev/bus/usb can't be watched). Refresh soon, without
+        # waiting for it, the next connect attempt finds it.
+        if port.startswith(PORT_PREFIX):
+            self.kick()
+
+    def refresh(self):
+        try:
+            names = sorted(self.list_ports())
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            logger.warning(f"Couldn't list usb ports: {e}")
+        else:
+            if names != self.names:
+                logger.info(f"usb ports: {names}")
+            # Replaced, not modified, so that readers always see a complete list without locking
+            self.names = names
+            self.ports = frozenset(names)
+        self.refreshed = time.monotonic()
+        self.ready.set()
+
+    def _run(self):
+        inotify = _inotify(self.watch_dir)
+        watching = [self.wakeup_r] + ([inotify] if inotify is not None else [])
+        try:
+            while not self.stopped:
+                self.refresh()
+                readable = select.select(watching, [], [], self.ttl)[0]
+                if inotify in readable:
+                    time.sleep(SETTLE_TIME) # a device shows up as several events, take them all at once
+                    _drain(inotify)
+                _drain(self.wakeup_r)
+                time.sleep(max(0, self.refreshed + MIN_INTERVAL - time.monotonic()))
+        finally:
+            if inotify is not None:
+                os.close(inotify)
+
+    def stop(self):
+        self.stopped = True
+        self.kick()
+        if self.thread.is_alive():
+            self.thread.join()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import subprocess
+import os
+import sys
+import signal
+import time
+import logging
+import pathlib
+import select
+import queue
+from collections import deque
+
+try: # part of the octoprint plugin package, or imported by serialBenchmark.py as a script
+    from . import serialTransport
+    from .serialTransport import CHANNEL_DATA, CHANNEL_DATA_FLUSH, CHANNEL_TELEMETRY, CHANNEL_CONTROL
+    from .serialEmulator import EMULATE_ENV
+    from .serialTiming import ConnectTimer, CONNECT_BUDGET
+except ImportError:
+    import serialTransport
+    from serialTransport import CHANNEL_DATA, CHANNEL_DATA_FLUSH, CHANNEL_TELEMETRY, CHANNEL_CONTROL
+    from serialEmulator import EMULATE_ENV
+    from serialTiming import ConnectTimer, CONNECT_BUDGET
+
+WRITE_TIMEOUT = 10 # seconds, only used when waiting for room in the shared memory ring
+IN_PROCESS_ENV = "TERMUX_CDC_ACM_INPROCESS" # "1" to drive the printer right inside octoprint instead of serialDaemon.py
+READY_TIMEOUT = 3 # seconds serialDaemon may take to answer "open"
+QUIT_TIMEOUT = 2 # seconds serialDaemon may take to quit after SIGTERM, then it gets killed
+
+logger = logging.getLogger("octoprint.plugins.Termux_CDC_ACM")
+
+class WarmDaemon():
+    # A serialDaemon that outlived its serial_printer: it still has the usb device claimed and configured, and waits on
+    # its own address for the next serial_printer of the same port (see SessionSupervisor)
+    def __init__(self, proc, address):
+        self.proc = proc
+        self.address = address
+
+    @property
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def stop(self):
+        # termux-usb and the daemon run in their own process group (setsid), terminating only the shell would leave the
+        # daemon waiting until its idle timeout
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+
+
+class serial_printer(object):
+    def __init__(self, comm_instance, port, baudrate, read_timeout, on_close=None, daemon=None):
+        self.comm_instance = comm_instance
+        self.port = port
+        self.baudrate = baudrate
+        self.read_timeout = read_timeout
+        self.lines = deque() # serialDaemon sends all lines it has at once, readline() hands them out one by one
+        self.partial = b''   # start of a line that hasn't been completed yet (only happens with shared memory)
+        self.in_process = os.environ.get(IN_PROCESS_ENV) == "1"
+        self.emulate = os.environ.get(EMULATE_ENV) == "1"
+        self.on_close = on_close # SessionSupervisor wants to know when this session is gone
+        self.warm = None         # WarmDaemon to hand over to SessionSupervisor on close(), once serialDaemon offered it
+        self.session = None
+        self.rx = self.tx = None
+        self.stream_status = None   # last telemetry event of a file serialDaemon streams (see stream_file())
+        self.streaming = False      # from stream_file() until serialDaemon is done with it (or refused it)
+        self.on_telemetry = None    # called with each of those events, if set
+        
+        # How long each phase of connecting took, as {phase: seconds} in connect_timings afterwards
+        self.timer = ConnectTimer()
+        self.connect_timings = {}
+        
+        # A warm daemon (the previous connection's) still has the printer open, then this is just a connect
+        self.conn = None
+        if daemon is not None and not self.in_process:
+            try:
+                with self.timer.phase("reattach"):
+                    self.conn = serialTransport.connect(daemon.address)
+                self.fd_proc = daemon.proc
+            except OSError: # it quit in the meantime (idle timeout, or the printer went away)
+                daemon.stop()
+        if self.conn is None:
+            self._start_daemon()
+            if self.in_process:
+                self._open_in_process()
+                self._log_connect()
+                return
+        
+        with self.timer.phase("handshake"):
+            # Optionally move the data into shared memory rings, the socket then only carries control messages
+            if os.environ.get(serialTransport.SHM_ENV) == "1":
+                self.rx = serialTransport.ShmPipe()
+                self.tx = serialTransport.ShmPipe()
+            self.conn.send_control("open", fds=self.tx.fds() + self.rx.fds() if self.tx else (), shm=self.tx is not None, baudrate=baudrate)
+            
+            # serialDaemon answers with the address it can be reached at after we are gone, and how long its part took.
+            # Whatever else comes first (an older daemon) is kept for readline().
+            deadline = time.monotonic() + READY_TIMEOUT
+            ready = None
+            while ready is None:
+                if not self.conn.poll(max(0, deadline - time.monotonic())):
+                    self.close()
+                    raise IOError(f"serial_printer:: serialDaemon for {self.port} didn't answer")
+                channel, payload = self.conn.recv()
+                if channel == CHANNEL_CONTROL:
+                    control = serialTransport.decode_control(payload)
+                    if control.get("cmd") == "ready":
+                        ready = control
+                elif channel == CHANNEL_DATA:
+                    self._received(payload)
+                elif channel == CHANNEL_TELEMETRY:
+                    self._telemetry(payload)
+        self.warm = WarmDaemon(self.fd_proc, ready["address"])
+        self.timer.extend(ready.get("timings", ()), prefix="daemon ")
+        self._log_connect()
+    
+    def _log_connect(self):
+        self.connect_timings = self.timer.as_dict()
+        # The permission popup waits for the user, that's not ours to speed up
+        elapsed = self.timer.elapsed() - self.connect_timings.get("permission", 0)
+        log = logger.warning if elapsed > CONNECT_BUDGET else logger.info
+        log(f"Connected to {self.port} in {elapsed * 1e3:.0f}ms (budget {CONNECT_BUDGET * 1e3:.0f}ms): {self.timer.summary()}")
+    
+    def _start_daemon(self):
+        # Get permission firsthand (so that timeouts in communication with serialDaemon do not get triggered by the user taking time to press "yes" on the permission popup)
+        if not self.emulate:
+            with self.timer.phase("permission"):
+                subprocess.check_output(['termux-usb', '-r', self.port])
+
+        # One unix socket per session, its address is unique so a session that is still being torn down doesn't block this one
+        self.address = serialTransport.new_address()
+        self.listener = serialTransport.listen(self.address)
+        
+        # Start the Daemon (or in-process just the helper handing over the usb file descriptor), so that it can connect to our listener
+        script = "serialFdHelper.py" if self.in_process else "serialDaemon.py"
+        cdcDaemonpath = str(pathlib.Path(__file__).parent.absolute() / pathlib.Path(script))
+        self.fd_env = os.environ.copy()
+        self.fd_env["TERMUX_CDC_ACM_BAUDRATE"] = str(self.baudrate)
+        self.fd_env[serialTransport.ADDRESS_ENV] = self.address
+        if self.emulate: # no usb device to get, serialDaemon uses serial_Emulated
+            command = [sys.executable, cdcDaemonpath, "-1"]
+        else:
+            command = ["termux-usb", "-e", cdcDaemonpath, self.port]
+        with self.timer.phase("spawn"): # without a shell in between, that's one process less to start
+            self.fd_proc = subprocess.Popen(command, env=self.fd_env, preexec_fn=os.setsid)
+        
+        # Accept connection from Daemon, by then it has the printer set up
+        try:
+            with self.timer.phase("daemon startup"):
+                self.conn = serialTransport.accept(self.listener, timeout=3)
+        except BaseException:
+            # It may still come up later and keep the printer claimed, termux-usb and the daemon share a process group
+            try:
+                os.killpg(self.fd_proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            self.fd_proc.wait()
+            raise
+        finally:
+            serialTransport.close_listener(self.listener, self.address)
+            self.listener = None
+    
+    def _open_in_process(self):
+        # pyusb only gets imported into octoprint when it's actually used
+        with self.timer.phase("import usb"):
+            from .usblib import device_from_fd, start_trace, TRACE_ENV
+            from .serialSession import SerialSession, open_serial
+        if int(os.environ.get(TRACE_ENV, 0)) > 0:
+            start_trace(int(os.environ[TRACE_ENV]))
+        
+        self.conn.recv() # serialFdHelper's "usb_fd"
+        self.usb_fd = self.conn.take_fds(1)[0]
+        with self.timer.phase("device_from_fd"):
+            dev = device_from_fd(self.usb_fd)
+        self.serial = open_serial(dev, self.baudrate, self.timer, fd=self.usb_fd)
+        if self.serial is None:
+            os.close(self.usb_fd) # close() only closes it along with a session
+            self.close()
+            raise IOError(f"serial_printer:: No driver for the usb device at {self.port}")
+        
+        # The session's LineForwarder hands the batches of lines over through this queue, None means it died
+        self.batches = queue.SimpleQueue()
+        self.session = SerialSession(self.serial, send=lambda data: self.batches.put(bytes(data)), on_error=lambda: self.batches.put(None))
+        self.session.watch(self._serial_state)
+        with self.timer.phase("purge"):
+            self.session.start()
+    
+    @property
+    def is_alive(self):
+        if self.session is not None:
+            return not self.session.errors
+        return self.fd_proc.poll() is None
+    
+    @property
+    def timeout(self):
+        return self.read_timeout
+    
+    @timeout.setter
+    def timeout(self, value):
+        self.read_timeout = value
+    
+    def write(self, data, flush=False):
+        # flush: to be written to the printer right away, not merged with what comes next (the shared memory ring has no
+        # message boundaries, there everything waits the same)
+        if self.session is not None:
+            self.session.write(bytes(data), flush)
+            return len(data)
+        if self.tx is not None:
+            return self.tx.write(data, timeout=WRITE_TIMEOUT)
+        self.conn.send(CHANNEL_DATA_FLUSH if flush else CHANNEL_DATA, data)
+        return len(data)
+    
+    def stream_file(self, path, start=0):
+        # Has serialDaemon print the G-code file at path (from byte offset start) by itself, octoprint then only gets
+        # events: progress, temperature, resend, error and done (the plugin's "stream" api command, see __init__.py).
+        # Meant for when the printer isn't busy with anything octoprint sent. Lines written meanwhile get sent in
+        # between, without line numbers.
+        if self.session is not None:
+            logger.warning("Streaming files needs serialDaemon, it isn't used with " + IN_PROCESS_ENV)
+            return False
+        self.stream_status = None
+        self.streaming = True
+        self.conn.send_control("stream", path=str(path), start=start)
+        return True
+    
+    def cancel_stream(self):
+        if self.session is None:
+            self.conn.send_control("cancel")
+    
+    def dump_trace(self, path):
+        # Writes the usb transfers recorded with TERMUX_CDC_ACM_TRACE to path as pcap (Wireshark). From serialDaemon the
+        # answer comes as a "trace" (or "error") event.
+        if self.session is not None:
+            from .usblib import dump_trace
+            return dump_trace(str(path))
+        self.conn.send_control("trace", path=str(path))
+    
+    def _telemetry(self, payload):
+        event = serialTransport.decode_control(payload)
+        if event["event"] == "serial_state":
+            return self._serial_state(event)
+        self.stream_status = event
+        if event["event"] == "temperature": # octoprint's own parser keeps the temperatures up to date meanwhile
+            self.lines.append(event["line"].encode() + b'\n')
+        elif event["event"] == "done":
+            self.streaming = False
+        elif event["event"] == "refused":
+            self.streaming = event.get("streaming", False)
+        if event["event"] in ("error", "refused"):
+            logger.error(f"serialDaemon: {event}")
+        elif event["event"] in ("started", "done", "trace"):
+            logger.info(f"serialDaemon: {event}")
+        if self.on_telemetry is not None:
+            self.on_telemetry(event)
+    
+    def _serial_state(self, event):
+        # SERIAL_STATE notifications of CDC-ACM boards, from serialDaemon or our own session
+        if event.get("lost"):
+            logger.error(f"The printer reset ({', '.join(event['lost'])} went away): {event}")
+        elif event.get("errors"):
+            logger.warning(f"The printer's usb side reported {', '.join(event['errors'])}: {event}")
+        if self.on_telemetry is not None:
+            self.on_telemetry(dict(event, event="serial_state"))
+    
+    def _received(self, data):
+        # data holds whole lines, but through shared memory it may also end in the middle of one
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        self.lines.extend(line+b'\n' for line in lines)
+    
+    def _wait(self, timeout):
+        # Whether the socket has a frame for us, after waiting up to timeout for that or for the shared memory ring
+        if self.session is not None: # in-process, the socket is only there to keep serialFdHelper alive
+            try:
+                batch = self.batches.get(timeout=timeout)
+            except queue.Empty:
+                return False
+            if batch is None:
+                raise EOFError
+            self._received(batch)
+            return False
+        if self.rx is None:
+            return self.conn.poll(timeout)
+        if not self.conn.poll():
+            select.select([self.rx, self.conn], [], [], timeout)
+        self._received(self.rx.read())
+        return self.conn.poll()
+        
+    def readline(self):
+        try:
+            deadline = time.monotonic() + self.read_timeout
+            while not self.lines:
+                if self._wait(max(0, deadline - time.monotonic())):
+                    channel, payload = self.conn.recv()
+                    if channel == CHANNEL_DATA:
+                        self._received(payload)
+                    elif channel == CHANNEL_TELEMETRY:
+                        self._telemetry(payload)
+                elif time.monotonic() >= deadline:
+                    return b''
+            return self.lines.popleft()
+        except (EOFError, OSError): # serialDaemon or the in-process session crashed
+            self.warm = None
+            self.close()
+            return b''
+        
+    def close(self):
+        if getattr(self, "closed", False): # e.g. __del__() after close(), the daemon may belong to someone else by now
+            return
+        self.closed = True
+        if getattr(self, "session", None) is not None:
+            import usb.util
+            self.session.stop()
+            self.serial.close()
+            usb.util.dispose_resources(self.serial.dev)
+            os.close(self.usb_fd)
+            self.session = None
+        on_close = getattr(self, "on_close", None)
+        warm = getattr(self, "warm", None)
+        keep_warm = warm is not None and warm.is_alive and on_close is not None # or nobody would pick it up
+        try:
+            if not keep_warm:
+                self.conn.send_control("quit")
+        except (AttributeError, OSError):
+            pass
+        try:
+            self.conn.close() # serialDaemon either goes idle now (warm) or quits
+        except AttributeError: # this fails if connection has been closed beforehand (e.g. __del__() after close())
+            pass
+        for pipe in (getattr(self, "rx", None), getattr(self, "tx", None)):
+            if pipe is not None:
+                pipe.close()
+        self.rx = self.tx = None
+        if not keep_warm:
+            try:
+                self.fd_proc.terminate()
+                self.fd_proc.wait(QUIT_TIMEOUT)
+            except AttributeError:
+                pass
+            except subprocess.TimeoutExpired:
+                logger.warning(f"serialDaemon for {self.port} didn't quit, killing it")
+                self.fd_proc.kill()
+                self.fd_proc.wait()
+        if on_close is not None:
+            self.on_close = None
+            on_close(self)
+        
+    def __del__(self):
+        self.close()
@@ -0,0 +1,119 @@
+import os
+import json
+import zlib
+
+# What open_serial learned about a usb-serial-converter from its descriptors: which driver, which interfaces and which
+# endpoints. Stored on disk per VID/PID together with a checksum of the raw descriptors, so that connecting again skips
+# walking the configuration with pyusb. Different descriptors (firmware update, another device with the same ids) don't
+# match the checksum and get probed again.
+PROFILES_ENV = "TERMUX_CDC_ACM_PROFILES"   # path of the store, "" to not keep one
+PROFILES_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "termux_cdc_acm", "profiles.json")
+MAX_DESCRIPTORS = 4096
+PROFILE_VERSION = 2     # profiles stored by older versions lack fields, those devices get probed again
+
+USB_DT_DEVICE = 0x01
+USB_DT_CONFIG = 0x02
+USB_REQ_GET_DESCRIPTOR = 0x06
+
+def raw_descriptors(dev, fd=None):
+    # Device descriptor followed by the configuration descriptors. Reading the usbfs file descriptor termux-usb gave us
+    # returns exactly that without talking to the device, GET_DESCRIPTOR is the fallback.
+    if fd is not None and fd >= 0:
+        try:
+            return os.pread(fd, MAX_DESCRIPTORS, 0)
+        except OSError:
+            pass
+    device = bytes(dev.ctrl_transfer(0x80, USB_REQ_GET_DESCRIPTOR, USB_DT_DEVICE << 8, 0, 18))
+    header = bytes(dev.ctrl_transfer(0x80, USB_REQ_GET_DESCRIPTOR, USB_DT_CONFIG << 8, 0, 4))
+    wTotalLength = int.from_bytes(header[2:4], "little")
+    return device + bytes(dev.ctrl_transfer(0x80, USB_REQ_GET_DESCRIPTOR, USB_DT_CONFIG << 8, 0, wTotalLength))
+
+def descriptor_digest(raw):
+    return f"{len(raw)}-{zlib.crc32(raw):08x}"
+
+
+class DeviceProfile():
+    # Everything the drivers need to set up a device. Endpoints are (bEndpointAddress, wMaxPacketSize, bmAttributes).
+    def __init__(self, driver, control_interface, data_interface, endpoint_IN, endpoint_OUT, endpoint_notify=None):
+        self.driver = driver                        # "CDCACM", "CH340", ...
+        self.control_interface = control_interface  # bInterfaceNumber control requests go to
+        self.data_interface = data_interface        # bInterfaceNumber of the bulk endpoints
+        self.endpoint_IN = tuple(endpoint_IN)
+        self.endpoint_OUT = tuple(endpoint_OUT)
+        self.endpoint_notify = tuple(endpoint_notify) if endpoint_notify is not None else None # interrupt IN, if any
+
+    @property
+    def interfaces(self):
+        # To claim, without claiming one twice
+        return sorted({self.control_interface, self.data_interface})
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["driver"], d["control_interface"], d["data_interface"], d["endpoint_IN"], d["endpoint_OUT"],
+            d.get("endpoint_notify"))
+
+    @staticmethod
+    def bulk_endpoints(interface):
+        # (IN, OUT) of an interface found with pyusb, in the form DeviceProfile keeps them
+        endpoint_IN = endpoint_OUT = None
+        for endpoint in interface.endpoints():
+            if endpoint.bmAttributes & 0x03 == 0x02: # Both endpoints have the "Bulk" attribute
+                # Bit7 of the bEndpointAddress determines the direction: 0=OUT, 1=IN
+                description = (endpoint.bEndpointAddress, endpoint.wMaxPacketSize, endpoint.bmAttributes)
+                if endpoint.bEndpointAddress & 1<<7:
+                    endpoint_IN = description
+                else:
+                    endpoint_OUT = description
+        return endpoint_IN, endpoint_OUT
+
+    @staticmethod
+    def interrupt_endpoint(interface):
+        # The first interrupt IN endpoint of an interface (e.g. CDC notifications), None if it has none
+        for endpoint in interface.endpoints():
+            if endpoint.bmAttributes & 0x03 == 0x03 and endpoint.bEndpointAddress & 1<<7:
+                return (endpoint.bEndpointAddress, endpoint.wMaxPacketSize, endpoint.bmAttributes)
+        return None
+
+
+class ProfileStore():
+    # The profiles on disk, a small json file read once and rewritten whenever a new profile got added
+    def __init__(self, path=None):
+        self.path = os.environ.get(PROFILES_ENV, PROFILES_PATH) if path is None else path
+        self.profiles = None    # "vid:pid" -> {"digest": ..., "profile": {...}}, loaded on first use
+
+    @staticmethod
+    def key(vid, pid):
+        return f"{vid:04x}:{pid:04x}"
+
+    def _load(self):
+        if self.profiles is None:
+            self.profiles = {}
+            if self.path:
+                try:
+                    with open(self.path) as f:
+                        self.profiles = json.load(f)
+                except (OSError, ValueError): # none yet, or broken: it only costs probing again
+                    pass
+        return self.profiles
+
+    def get(self, vid, pid, digest):
+        entry = self._load().get(self.key(vid, pid))
+        if entry is None or entry["digest"] != digest or entry.get("version") != PROFILE_VERSION:
+            return None
+        return DeviceProfile.from_dict(entry["profile"])
+
+    def put(self, vid, pid, digest, profile):
+        self._load()[self.key(vid, pid)] = {"digest": digest, "version": PROFILE_VERSION, "profile": profile.to_dict()}
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(self.profiles, f, indent=1)
+            os.replace(tmp, self.path) # never leaves a half written file behind for the next connect
+        except OSError as e:
+            print(f"serialProfiles:: Warning: couldn't save device profile: {e}")
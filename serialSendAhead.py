@@ -0,0 +1,162 @@
+import threading
+from collections import deque
+
+# Optional streaming mode of serialDaemon. Octoprint sends one line and waits for its "ok", which makes every line cost
+# a round trip through the socket, the daemon and usb. With send-ahead the daemon writes lines to the printer as long
+# as they fit into what's left of the printer's receive buffer, and answers octoprint with an "ok" right away, so that
+# the next line comes without waiting. The printer's real "ok"s free up the buffer again and get swallowed.
+SEND_AHEAD_ENV = "TERMUX_CDC_ACM_SEND_AHEAD"        # bytes of the printer's receive buffer we may fill, 0 is off
+SEND_AHEAD_LINES_ENV = "TERMUX_CDC_ACM_SEND_AHEAD_LINES"
+RX_BUDGET = 127         # Marlin's RX_BUFFER_SIZE is 128
+MAX_LINES = 4           # Marlin's BUFSIZE
+
+# Commands whose "ok" octoprint has to see for real: it waits for them on purpose (heating, homing, ...) or wants what
+# comes with the ok (temperatures, position). They still get sent ahead, but aren't answered early.
+SYNC_COMMANDS = frozenset((
+    b"G28", b"G29", b"M0", b"M1", b"M105", b"M109", b"M114", b"M190", b"M191", b"M303", b"M400", b"M600",
+    ))
+
+# After an overrun the counting may be off: sync() stops sending ahead until the printer answered this. Its "ok" is the
+# only one with temperatures, so it's recognised even if an "ok" in front of it got lost.
+SYNC_LINE = b"M105\n"
+SYNC_DUE = 1        # SYNC_LINE waits for room in the printer's buffer
+SYNC_WAITING = 2    # sent, waiting for its "ok"
+
+def command_of(line):
+    # b"N12 M105*34" -> b"M105"
+    for word in line.split():
+        if word[:1] in (b"N", b"n") and word[1:].isdigit():
+            continue
+        return word.split(b"*")[0].upper()
+    return b""
+
+
+class SendAhead():
+    # Sits between octoprint and the session: submit() gets what octoprint wrote, received() what the printer sent.
+    # write(data, flush) goes to the printer (SerialSession.write), forward(data) to octoprint (same as LineForwarder's
+    # send, None while nobody is attached). Both sides run in different threads, everything happens under one lock.
+    def __init__(self, write, rx_budget=RX_BUDGET, max_lines=MAX_LINES):
+        self.write = write
+        self.forward = None
+        self.rx_budget = rx_budget
+        self.max_lines = max_lines
+        self.lock = threading.Lock()
+        self.partial = b''          # start of a line from octoprint that hasn't been completed yet
+        self.pending = deque()      # (line, flush) waiting for room in the printer's buffer
+        self.inflight = deque()     # (length, answered, reports, sync) of lines the printer hasn't said "ok" to yet
+        self.inflight_bytes = 0     # reports: M105, whose "ok" carries temperatures. sync: our SYNC_LINE.
+        self.after_resend = False   # octoprint swallows the "ok" following a resend request, it must get it
+        self.syncing = None         # SYNC_DUE or SYNC_WAITING while sync() holds back octoprint's lines
+        self.early_oks = 0
+        self.swallowed_oks = 0
+        self.syncs = 0
+        self.lost_oks = 0
+
+    def attach(self, forward):
+        with self.lock:
+            self.forward = forward
+            self.partial = b'' # the rest of that line went away with the last connection
+
+    def _forward(self, data):
+        # The shared memory ring may take only part of it in time
+        while data and self.forward is not None:
+            sent = self.forward(data)
+            data = data[sent:] if sent is not None else b''
+
+    def _fits(self, line):
+        if not self.inflight: # a line longer than the whole budget still goes out on its own
+            return True
+        return self.inflight_bytes + len(line) <= self.rx_budget and len(self.inflight) < self.max_lines
+
+    def _pump(self):
+        # Writes pending lines while the printer has room for them, answering the ones octoprint doesn't wait for
+        answers = 0
+        if self.syncing == SYNC_DUE and self._fits(SYNC_LINE):
+            self.write(SYNC_LINE, True)
+            self.inflight.append((len(SYNC_LINE), True, True, True))
+            self.inflight_bytes += len(SYNC_LINE)
+            self.syncing = SYNC_WAITING
+        while self.pending and not self.syncing:
+            line, flush = self.pending[0]
+            if not self._fits(line):
+                break
+            self.pending.popleft()
+            command = command_of(line)
+            answered = command not in SYNC_COMMANDS
+            self.write(line, flush)
+            self.inflight.append((len(line), answered, command == b"M105", False))
+            self.inflight_bytes += len(line)
+            answers += answered
+        if answers:
+            self.early_oks += answers
+            self._forward(b"ok\n" * answers)
+
+    def submit(self, data, flush=False):
+        with self.lock:
+            lines = (self.partial + bytes(data)).split(b'\n')
+            self.partial = lines.pop()
+            self.pending.extend((line + b'\n', flush) for line in lines)
+            self._pump()
+
+    def received(self, data):
+        # A batch of complete lines from the printer, passed on to octoprint without the "ok"s it already got
+        with self.lock:
+            out = []
+            for line in bytes(data).splitlines(keepends=True):
+                if line.startswith(b"ok") and self.inflight:
+                    if self.syncing and b"T:" in line:
+                        # The answer to the first M105 in flight, whatever is in front of it lost its "ok". Octoprint
+                        # still waits for those it wasn't answered for early.
+                        out.append(b"ok\n" * self._realign())
+                        if not self.inflight:
+                            out.append(line)
+                            continue
+                    length, answered, reports, sync = self.inflight.popleft()
+                    self.inflight_bytes -= length
+                    if sync:
+                        self.syncing = None
+                    if answered and not self.after_resend:
+                        self.swallowed_oks += 1
+                        rest = line[2:].strip()
+                        if rest: # e.g. "ok T:210.0 /210.0", the values are still worth something
+                            out.append(b" " + rest + b"\n")
+                        continue
+                    self.after_resend = False
+                elif line.lower().startswith((b"resend", b"rs")):
+                    self.after_resend = True
+                out.append(line)
+            self._forward(b''.join(out))
+            self._pump()
+
+    def _realign(self):
+        # Drops what's in flight in front of the first M105, returns how many of those octoprint is waiting for
+        waiting = 0
+        while self.inflight and not self.inflight[0][2]:
+            length, answered, reports, sync = self.inflight.popleft()
+            self.inflight_bytes -= length
+            self.lost_oks += 1
+            waiting += not answered
+        return waiting
+
+    def sync(self):
+        # Bytes from the printer got lost (overrun), maybe an "ok" among them, maybe not: instead of guessing, hold
+        # octoprint's lines back until the printer answered SYNC_LINE, which comes after everything in flight
+        with self.lock:
+            if not self.syncing:
+                self.syncing = SYNC_DUE
+                self.syncs += 1
+                self._pump()
+
+    def resync(self):
+        # The printer reset, the "ok"s for what's in flight never come: start counting its receive buffer over instead
+        # of waiting for them forever
+        with self.lock:
+            self.inflight.clear()
+            self.inflight_bytes = 0
+            self.after_resend = False
+            self.syncing = None
+            self._pump()
+
+    def stats(self):
+        return {"early oks": self.early_oks, "swallowed oks": self.swallowed_oks, "in flight": len(self.inflight),
+            "syncs": self.syncs, "lost oks": self.lost_oks}
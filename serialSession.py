@@ -0,0 +1,344 @@
+import time
+import queue
+import threading
+try: # part of the octoprint plugin package, or imported by serialDaemon.py as a script
+    from .serialBuffer import LineRing
+    from .serialTiming import ConnectTimer
+except ImportError:
+    from serialBuffer import LineRing
+    from serialTiming import ConnectTimer
+
+# Receiving and transmitting run in their own threads with their own queues, so a stalled bulk write never delays lines
+# coming from the printer and vice versa
+RX_RING_SIZE = 16384    # bytes read from the printer that haven't been forwarded to octoprint yet
+RX_MAX_LINE = 4096      # longer lines get cut, so that a printer that never sends b'\n' can't fill up the ring
+TX_QUEUE_SIZE = 64      # messages from octoprint that haven't been written to the printer yet
+RX_TIMEOUT = 1000       # milliseconds, only limits how long stopping the RX worker takes
+TX_TIMEOUT = 1000       # milliseconds per bulk write attempt, the rest gets retried until the printer takes it
+TX_MAX_TRANSFER = 4096  # bytes, messages that queued up get merged into bulk transfers up to this size, 0 to not merge
+TX_DEADLINE = 0.0       # milliseconds to wait for more messages to fill up a packet, 0 only merges what's queued already
+RX_TRANSFERS = 4        # IN transfers kept submitted all the time (usblib.AsyncReader), 0 reads one at a time
+
+class Worker(threading.Thread):
+    def __init__(self, wakeup):
+        super().__init__(daemon=True)
+        self.wakeup = wakeup    # called when the worker died, so that the main loop notices
+        self.error = None
+        self.should_stop = False
+
+    def run(self):
+        try:
+            while not self.should_stop:
+                self.runOne()
+        except Exception as e: # e.g. usb.core.USBError when the printer got unplugged
+            self.error = e
+            self.wakeup()
+
+    def runOne(self):
+        raise NotImplementedError
+
+    def stop(self):
+        self.should_stop = True
+
+
+class USBReader(Worker):
+    # Blocks on the IN-endpoint instead of polling it, reading straight into the free space of the RX ring. With
+    # transfers, that many IN transfers wait on the endpoint all the time instead and get copied into the ring as they
+    # complete, so that a fast printer never finds the endpoint without one while we are busy (drivers without
+    # async_reader(), or where libusb's asynchronous API isn't available, read one at a time anyway).
+    def __init__(self, serial, ring, wakeup, timeout=RX_TIMEOUT, transfers=RX_TRANSFERS):
+        super().__init__(wakeup)
+        self.serial = serial
+        self.ring = ring
+        self.timeout = timeout
+        self.reader = None
+        if transfers and hasattr(serial, "async_reader"):
+            try:
+                self.reader = serial.async_reader(self._received, transfers)
+            except Exception as e: # e.g. a pyusb backend that isn't libusb1, or libusb without the symbols
+                print(f"serialSession:: Warning: no asynchronous transfers ({e}), reading one at a time")
+
+    def _received(self, data):
+        while data:
+            space = self.ring.free(timeout=self.timeout/1000) # waits if octoprint isn't keeping up
+            if not space:
+                if self.ring.closed:
+                    return
+                continue
+            n = min(len(space), len(data))
+            space[:n] = data[:n]
+            self.ring.commit(n)
+            data = data[n:]
+
+    def run(self):
+        if self.reader is not None:
+            self.reader.start()
+            if self.reader.error is not None and not self.reader.pending: # not even one got submitted
+                print(f"serialSession:: Warning: {self.reader.error}, reading one at a time")
+                self.reader.close()
+                self.reader = None
+        if self.reader is None:
+            return super().run()
+        try:
+            super().run()
+        finally: # transfers are only cancelled and freed in the thread handling their events
+            self.reader.close()
+
+    def runOne(self):
+        if self.reader is not None:
+            self.reader.handle_events(self.timeout/1000)
+            return
+        space = self.ring.free(timeout=self.timeout/1000) # waits if octoprint isn't keeping up
+        if space:
+            self.ring.commit(self.serial.read_into(space, timeout=self.timeout))
+
+    def stop(self):
+        super().stop()
+        self.ring.close()
+
+
+class USBWriter(Worker):
+    # Sleeps on the TX queue and writes to the OUT-endpoint, retrying whatever didn't make it within one timeout.
+    # Messages that queued up meanwhile (or arrive within deadline) go out together, in transfers that are a multiple of
+    # wMaxPacketSize except for the last one, instead of one short transfer per line. A message written with flush
+    # goes out right away together with whatever is in front of it.
+    def __init__(self, serial, tx_queue, wakeup, timeout=TX_TIMEOUT, max_transfer=TX_MAX_TRANSFER, deadline=TX_DEADLINE):
+        super().__init__(wakeup)
+        self.serial = serial
+        self.tx_queue = tx_queue
+        self.timeout = timeout
+        self.packet = serial.endpoint_OUT.wMaxPacketSize
+        self.max_transfer = max_transfer - max_transfer % self.packet
+        self.deadline = deadline
+        self.timeouts = 0
+        self.messages = 0       # what octoprint wrote
+        self.transfers = 0      # what went over usb for it, not counting zero length packets
+        self.bytes = 0
+        self.zlps = 0
+
+    def _collect(self):
+        # The next message, and whatever can be merged with it. None if stop() woke us up.
+        item = self.tx_queue.get()
+        if item is None:
+            return None
+        data, flush = item
+        self.messages += 1
+        if not self.max_transfer:
+            return data
+        data = bytearray(data)
+        deadline = time.monotonic() + self.deadline/1000
+        while not flush and len(data) < self.max_transfer:
+            try:
+                item = self.tx_queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or len(data) % self.packet == 0: # nothing to wait for, or no partial packet to fill
+                    break
+                try:
+                    item = self.tx_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is None: # stopping, but still write what we have
+                break
+            data += item[0]
+            flush = item[1]
+            self.messages += 1
+        return data
+
+    def _write(self, data):
+        data = memoryview(data)
+        while data and not self.should_stop:
+            sent = self.serial.write(data, timeout=self.timeout)
+            if not sent: # printer doesn't take data right now, keep trying
+                self.timeouts += 1
+            data = data[sent:]
+
+    def runOne(self):
+        data = self._collect()
+        if data is None: # stop() wakes us up this way
+            return
+        transfer = self.max_transfer or len(data)
+        for start in range(0, len(data), transfer):
+            chunk = memoryview(data)[start:start + transfer]
+            self._write(chunk)
+            self.transfers += 1
+            self.bytes += len(chunk)
+        # A transfer ending on a full packet isn't over for the device until a short packet comes, which would be the
+        # beginning of the next one. If nothing is coming, end it with a zero length packet.
+        if self.max_transfer and len(data) % self.packet == 0 and self.tx_queue.empty() and not self.should_stop:
+            self.serial.write(b'', timeout=self.timeout)
+            self.zlps += 1
+
+    def stats(self):
+        return {
+            "messages": self.messages,
+            "transfers": self.transfers,
+            "bytes": self.bytes,
+            "bytes/transfer": self.bytes / self.transfers if self.transfers else 0,
+            "zero length packets": self.zlps,
+            "timeouts": self.timeouts,
+            }
+
+    def stop(self):
+        super().stop()
+        try:
+            self.tx_queue.put_nowait(None)
+        except queue.Full: # not waiting in get() then
+            pass
+
+
+class LineForwarder(Worker):
+    # Hands octoprint the lines the printer sent. All complete lines that are in the RX ring get sent as one message (a
+    # batch of lines each ending in b'\n') straight out of the ring, serial_printer splits them up again on its side.
+    # send is either the socket's data channel or the shared memory ring, None while nobody is attached (the lines get
+    # dropped then, like purge() would have).
+    def __init__(self, send, ring, wakeup):
+        super().__init__(wakeup)
+        self.send = send
+        self.send_lock = threading.Lock()   # held while sending, so that attach() never pulls send away mid-batch
+        self.ring = ring
+
+    def attach(self, send):
+        with self.send_lock:
+            self.send = send
+
+    def runOne(self):
+        segments, cut = self.ring.lines()
+        if not segments: # ring got closed
+            return
+        if len(segments) == 1 and not cut:
+            data = segments[0]
+        else: # wrapped around the end of the ring, or a line too long that got cut
+            data = b''.join(segments) + (b'\n' if cut else b'')
+        with self.send_lock:
+            while data and self.send is not None and not self.should_stop:
+                sent = self.send(data)
+                data = data[sent:] if sent is not None else b'' # the shared memory ring may take only part of it in time
+        self.ring.release()
+
+    def stop(self):
+        super().stop()
+        self.ring.close()
+
+
+class NotificationReader(Worker):
+    # Blocks on the notification endpoint of drivers that have one (CDC-ACM's SERIAL_STATE), on_event gets what the
+    # device reports (line state changes, breaks, framing/parity errors, overruns) as it happens. Nothing polls the
+    # device for it.
+    def __init__(self, serial, wakeup, timeout=RX_TIMEOUT):
+        super().__init__(wakeup)
+        self.serial = serial
+        self.timeout = timeout
+        self.on_event = None
+
+    def run(self):
+        # Boards that don't implement notifications properly are no reason to stop the session
+        try:
+            while not self.should_stop:
+                self.runOne()
+        except Exception as e:
+            print(f"serialSession:: Warning: stopped listening for notifications: {e}")
+
+    def runOne(self):
+        for event in self.serial.read_notification(self.timeout):
+            on_event = self.on_event
+            if on_event is not None:
+                on_event(event)
+
+
+def open_serial(dev, baudrate, timer=None, fd=None, profiles=None):
+    # Picks and sets up the driver for the usb-serial-converter, None if there is none for it. fd is the usbfs file
+    # descriptor dev came from, reading the descriptors from it is how known devices get recognised.
+    timer = timer if timer is not None else ConnectTimer()
+    with timer.phase("import drivers"):
+        try:
+            from .serialDrivers import DRIVERS, load_drivers, match
+            from .serialProfiles import ProfileStore, raw_descriptors, descriptor_digest
+        except ImportError:
+            from serialDrivers import DRIVERS, load_drivers, match
+            from serialProfiles import ProfileStore, raw_descriptors, descriptor_digest
+        load_drivers()
+
+    with timer.phase("detach kernel driver"):
+        if dev.is_kernel_driver_active(0):
+            dev.detach_kernel_driver(0)
+            print("kernel driver detached")
+        else:
+            print("no kernel driver attached")
+
+    with timer.phase("descriptors"):
+        profiles = profiles if profiles is not None else ProfileStore()
+        digest = descriptor_digest(raw_descriptors(dev, fd))
+        profile = profiles.get(dev.idVendor, dev.idProduct, digest)
+        if profile is None: # new device, or its descriptors changed
+            driver = match(dev)
+            profile = driver.probe(dev) if driver is not None else None
+            if profile is not None:
+                profiles.put(dev.idVendor, dev.idProduct, digest, profile)
+
+    serial = None
+    if profile is not None:
+        with timer.phase("driver setup"): # claiming interfaces and the control transfers configuring the converter
+            print(f"serialSession:: Connected device is {profile.driver}")
+            serial = DRIVERS[profile.driver](dev=dev, baudrate=baudrate, profile=profile)
+    if serial is None:
+        print(f"serialSession:: Error: Couldn't find matching driver for usb device {hex(dev.idVendor)=}, {hex(dev.idProduct)=} !")
+        print(dev.get_active_configuration())
+    return serial
+
+
+class SerialSession():
+    # The I/O pipeline for one printer: USBReader, LineForwarder and USBWriter. It runs in serialDaemon.py, or right
+    # inside octoprint when serial_printer got the usb file descriptor handed over.
+    # send gets called with batches of lines for octoprint (memoryviews only valid during the call), on_error when one
+    # of the workers died. serialDaemon keeps the session running between octoprint connections and only swaps send.
+    def __init__(self, serial, send, on_error, max_line=RX_MAX_LINE, tx_max_transfer=TX_MAX_TRANSFER, tx_deadline=TX_DEADLINE,
+            rx_transfers=RX_TRANSFERS):
+        self.serial = serial
+        self.ring = LineRing(capacity=RX_RING_SIZE, max_line=max_line, chunk=serial.endpoint_IN.wMaxPacketSize)
+        self.tx_queue = queue.Queue(TX_QUEUE_SIZE)
+        self.forwarder = LineForwarder(send, self.ring, on_error)
+        self.writer = USBWriter(serial, self.tx_queue, on_error, max_transfer=tx_max_transfer, deadline=tx_deadline)
+        self.reader = USBReader(serial, self.ring, on_error, transfers=rx_transfers)
+        self.workers = [
+            self.reader,
+            self.forwarder,
+            self.writer,
+            ]
+        self.notifier = None
+        if getattr(serial, "endpoint_notify", None) is not None:
+            self.notifier = NotificationReader(serial, on_error)
+            self.workers.append(self.notifier)
+
+    def start(self):
+        self.serial.purge() # clear whatever the printer has sent while octoprint wasn't connected
+        for worker in self.workers:
+            worker.start()
+
+    def attach(self, send):
+        # Where the lines go from now on, None to drop them
+        self.forwarder.attach(send)
+
+    def watch(self, on_event):
+        # Where the device's notifications go from now on (see NotificationReader), None to drop them
+        if self.notifier is not None:
+            self.notifier.on_event = on_event
+
+    def write(self, data, flush=False):
+        # flush: don't wait for more to merge it with (only matters with a deadline), e.g. for a single command
+        self.tx_queue.put((data, flush))
+
+    @property
+    def errors(self):
+        return [(type(worker).__name__, worker.error) for worker in self.workers if worker.error is not None]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+        if self.ring.overflows:
+            print(f"serialSession:: Warning: cut {self.ring.overflows} lines ({self.ring.overflow_bytes} bytes) longer than {self.ring.max_line} bytes")
+        stats = self.writer.stats()
+        if stats["transfers"]:
+            print(f"serialSession:: TX: {stats['messages']} messages in {stats['transfers']} transfers, {stats['bytes/transfer']:.1f} bytes/transfer, {stats['zero length packets']} zero length packets")
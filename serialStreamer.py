@@ -0,0 +1,280 @@
+import os
+import mmap
+import time
+import threading
+from collections import deque
+
+try:
+    from .serialSendAhead import RX_BUDGET, MAX_LINES, SYNC_LINE
+except ImportError:
+    from serialSendAhead import RX_BUDGET, MAX_LINES, SYNC_LINE
+
+# Prints a G-code file straight from serialDaemon: octoprint sends "stream" with the path, the daemon maps the file and
+# feeds it to the printer itself, with line numbers, checksums, resends and counting characters against the printer's
+# receive buffer like SendAhead. Octoprint is out of the loop for every single line, it only gets events on the telemetry
+# channel (progress, temperatures, errors, done), the answers to its own lines and host action commands.
+PROGRESS_INTERVAL = 1.0 # seconds between "progress" events
+HISTORY = 128           # lines kept for resend requests, far more than can be in flight
+
+FILE = 0        # kinds of lines in flight: ours, whose "ok"s nobody else sees
+OCTOPRINT = 1   # sent by octoprint in between (temperature polling, ...), it gets their answers
+SYNC = 2        # SYNC_LINE of sync(), nothing else goes out until its "ok" came
+
+def checksum(line):
+    cs = 0
+    for byte in line:
+        cs ^= byte
+    return cs
+
+def strip_line_number(line):
+    # b"N12 M105*34" -> b"M105", our numbering is the only one the printer may see
+    if line[:1] in (b"N", b"n"):
+        number, _, rest = line.partition(b" ")
+        if number[1:].isdigit():
+            line = rest
+    return line.split(b"*")[0].strip()
+
+def resend_line_number(line):
+    # b"Resend: 12", b"rs N12", b"Resend:12" -> 12, None if there is no number
+    digits = bytes(byte for byte in line.split(b":", 1)[-1] if 0x30 <= byte <= 0x39)
+    return int(digits) if digits else None
+
+
+class FileStreamer():
+    # Sits between the printer and octoprint while a file streams, like SendAhead: received() gets the printer's lines
+    # (attached to the session), inject() what octoprint writes meanwhile. write(data, flush) goes to the printer,
+    # forward(data) to octoprint, telemetry(event, **values) to its telemetry channel. The file's "ok"s, echo and busy
+    # messages stay here. When the file is done (or
+    # cancelled and the printer answered everything in flight) it passes everything on to then(data) instead.
+    def __init__(self, path, write, forward, telemetry, then=None, rx_budget=RX_BUDGET, max_lines=MAX_LINES, start=0):
+        self.path = path
+        self.write = write
+        self.forward = forward
+        self.telemetry = telemetry
+        self.then = then if then is not None else forward
+        self.rx_budget = rx_budget
+        self.max_lines = max_lines
+        self.lock = threading.Lock()
+
+        with open(path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        if self.size:
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.pos = start            # offset of the next line in the file
+        self.line_number = 1        # of the next line from the file
+        self.next_line = None       # formatted line from the file that didn't fit into the printer's buffer yet
+        self.history = deque(maxlen=HISTORY)    # (line number, formatted line) for resends
+        self.resends = deque()      # formatted lines to send again before going on with the file
+        self.injected = deque()     # octoprint's lines, they go before the file's
+        self.partial = b''          # start of a line from octoprint that hasn't been completed yet
+        self.inflight = deque()     # (length, kind, generation, reports) of lines the printer hasn't said "ok" to yet,
+                                    # reports: an M105, whose "ok" carries temperatures
+        self.inflight_bytes = 0
+        self.generation = 0         # +1 per resend, resend requests for lines sent before that are repeats
+        self.syncing = False        # sync() holds everything back until the printer answered SYNC_LINE
+        self.cancelled = False
+        self.done = False
+        self.started = self.progressed = time.monotonic()
+        self.lines_sent = 0
+        self.resend_requests = 0
+
+    def start(self):
+        with self.lock:
+            self.telemetry("started", path=self.path, size=self.size, pos=self.pos)
+            # The printer numbers from here on, its "ok" is ours
+            self._send(b"M110 N0\n", FILE)
+            self._pump()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            self.next_line = None
+            self.resends.clear()
+            self._check_done()
+
+    def abort(self):
+        # The printer reset, nothing in flight gets an "ok" anymore
+        with self.lock:
+            self.cancelled = True
+            self.next_line = None
+            self.resends.clear()
+            self.inflight.clear()
+            self.inflight_bytes = 0
+            self.syncing = False
+            self._check_done()
+
+    def sync(self):
+        # Bytes from the printer got lost (overrun), maybe an "ok" among them: hold everything back until the printer
+        # answered SYNC_LINE, see SendAhead.sync()
+        with self.lock:
+            if self.done or self.syncing:
+                return
+            self.syncing = True
+            self._send(SYNC_LINE, SYNC)
+
+    def _realign(self):
+        # Drops what's in flight in front of the first M105, their "ok"s got lost. Returns how many of those were
+        # octoprint's, it waits for them.
+        waiting = 0
+        while self.inflight and not self.inflight[0][3]:
+            length, kind, generation, reports = self.inflight.popleft()
+            self.inflight_bytes -= length
+            waiting += kind == OCTOPRINT
+        return waiting
+
+    def _send(self, data, kind):
+        self.write(data, False)
+        self.inflight.append((len(data), kind, self.generation, b"M105" in data))
+        self.inflight_bytes += len(data)
+
+    def _forward(self, data):
+        # The shared memory ring may take only part of it in time
+        while data and self.forward is not None:
+            sent = self.forward(data)
+            data = data[sent:] if sent is not None else b''
+
+    def _fits(self, data):
+        if not self.inflight: # a line longer than the whole budget still goes out on its own
+            return True
+        return self.inflight_bytes + len(data) <= self.rx_budget and len(self.inflight) < self.max_lines
+
+    def _read_line(self):
+        # The next line from the file with a line number and checksum, None at the end. Comments and empty lines never
+        # reach the printer.
+        while self.pos < self.size:
+            end = self.map.find(b'\n', self.pos)
+            if end < 0:
+                end = self.size
+            line = self.map[self.pos:end].split(b';', 1)[0].strip()
+            self.pos = end + 1
+            if line:
+                line = b"N%d %s" % (self.line_number, line)
+                line = b"%s*%d\n" % (line, checksum(line))
+                self.history.append((self.line_number, line))
+                self.line_number += 1
+                return line
+        return None
+
+    def _pump(self):
+        if self.syncing:
+            return
+        while self.injected and self._fits(self.injected[0]):
+            self._send(self.injected.popleft(), OCTOPRINT)
+        if self.cancelled:
+            return
+        while self.resends and self._fits(self.resends[0]):
+            self._send(self.resends.popleft(), FILE)
+            self.lines_sent += 1
+        if self.resends:
+            return
+        while True:
+            if self.next_line is None:
+                self.next_line = self._read_line()
+                if self.next_line is None:
+                    return
+            if not self._fits(self.next_line):
+                return
+            self._send(self.next_line, FILE)
+            self.next_line = None
+            self.lines_sent += 1
+
+    def _resend(self, line):
+        number = resend_line_number(line)
+        if self.inflight and self.inflight[0][2] < self.generation:
+            return # the printer rejects every line that was in flight with the one it wants back, once is enough
+        self.resend_requests += 1
+        self.generation += 1
+        if number is None or not any(n == number for n, _ in self.history):
+            self.telemetry("error", line=line.decode(errors="replace").strip(), reason="resend of a line we don't have anymore")
+            self.cancelled = True
+            return
+        lines = [sent for n, sent in self.history if n >= number]
+        self.resends = deque(lines)
+        self.next_line = None
+        self.line_number = number + len(lines)
+        self.telemetry("resend", line_number=number)
+
+    def _check_done(self):
+        if self.done or any(kind != OCTOPRINT for _, kind, _, _ in self.inflight):
+            return
+        if self.cancelled or (self.next_line is None and not self.resends and self.pos >= self.size):
+            self.done = True
+            self.telemetry("done", cancelled=self.cancelled, lines=self.lines_sent, pos=min(self.pos, self.size),
+                size=self.size, resends=self.resend_requests, seconds=round(time.monotonic() - self.started, 3))
+            if self.size:
+                self.map.close()
+
+    def _progress(self):
+        now = time.monotonic()
+        if now - self.progressed >= PROGRESS_INTERVAL:
+            self.progressed = now
+            self.telemetry("progress", pos=min(self.pos, self.size), size=self.size, lines=self.lines_sent,
+                lines_per_s=round(self.lines_sent / (now - self.started), 1))
+
+    def inject(self, data, flush=False):
+        # Octoprint's own print job must not get mixed into the file: its lines come with line numbers and checksums
+        # (octoprint only sends those while printing), they get refused. The plugin cancels such a job anyway.
+        with self.lock:
+            if self.done:
+                self.write(data, flush)
+                return
+            lines = (self.partial + bytes(data)).split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                if line[:1] in (b"N", b"n") and b"*" in line:
+                    self.telemetry("error", line=line.decode(errors="replace"),
+                        reason="octoprint is printing while a file streams, its line didn't go to the printer")
+                    self._forward(b"ok\n") # octoprint waits for one before its next line
+                    continue
+                self.injected.append(strip_line_number(line) + b'\n')
+            self._pump()
+
+    def received(self, data):
+        with self.lock:
+            if self.done:
+                return self.then(data)
+            out = []
+            for line in bytes(data).splitlines(keepends=True):
+                # Until its "ok", what the printer says is the answer to the line in front (M114's position, ...)
+                octoprints = not self.inflight or self.inflight[0][1] == OCTOPRINT
+                if line.startswith(b"ok"):
+                    if not self.inflight: # one we don't know of, octoprint may know what to do with it
+                        out.append(line)
+                        continue
+                    if self.syncing and b"T:" in line:
+                        out.append(b"ok\n" * self._realign())
+                        if not self.inflight:
+                            out.append(line)
+                            continue
+                    length, kind, generation, reports = self.inflight.popleft()
+                    self.inflight_bytes -= length
+                    if kind == SYNC:
+                        self.syncing = False
+                    if kind == OCTOPRINT:
+                        out.append(line)
+                    elif b"T:" in line: # M105 from the file, or ours
+                        self.telemetry("temperature", line=line.decode(errors="replace").strip())
+                    continue
+                lower = line.lower()
+                if lower.startswith((b"resend", b"rs")):
+                    self._resend(line)
+                    continue
+                if lower.startswith(b"error"):
+                    text = line.decode(errors="replace").strip()
+                    if b"checksum" in lower or b"line" in lower: # line number or checksum mismatch, a resend follows
+                        self.telemetry("error", line=text, reason="resend")
+                        continue
+                    self.telemetry("error", line=text)
+                    self.cancelled = True
+                elif b"T:" in line: # autoreported, serial_printer hands them on to octoprint's parser
+                    self.telemetry("temperature", line=line.decode(errors="replace").strip())
+                elif octoprints or line.startswith(b"//action:"): # octoprint asked, or the printer asks the host
+                    out.append(line)
+            self._forward(b''.join(out))
+            self._pump()
+            self._progress()
+            self._check_done()
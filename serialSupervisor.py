@@ -0,0 +1,78 @@
+import threading
+from collections import defaultdict
+
+class SessionSupervisor():
+    # Keeps track of one session (serial_printer with its own serialDaemon, socket and I/O threads) per printer, so that
+    # several printers can be connected at once. Sessions don't share anything but this bookkeeping: their socket
+    # addresses are unique, and opening or tearing down one port never waits for another port.
+    def __init__(self, factory):
+        self.factory = factory  # called with port=..., on_close=..., daemon=... and whatever open() got, e.g. serial_printer
+        self.sessions = {}
+        self.warm = {}          # port -> WarmDaemon, still holding the printer open after its session closed
+        self.lock = threading.Lock()                        # only guards the dicts, never held while opening/closing
+        self.port_locks = defaultdict(threading.Lock)       # one connect/disconnect at a time per port
+
+    def open(self, port, **kwargs):
+        with self.lock:
+            port_lock = self.port_locks[port]
+        with port_lock:
+            # Whatever is left of an earlier session holds the usb device, get rid of it first
+            old = self.get(port)
+            if old is not None:
+                old.close()
+            # Reattaching to the daemon of the previous session skips termux-usb and setting up the device
+            with self.lock:
+                daemon = self.warm.pop(port, None)
+            session = self.factory(port=port, on_close=lambda session: self._forget(port, session), daemon=daemon, **kwargs)
+            with self.lock:
+                self.sessions[port] = session
+            return session
+
+    def _forget(self, port, session):
+        daemon = getattr(session, "warm", None)
+        replaced = None
+        with self.lock:
+            if self.sessions.get(port) is session:
+                del self.sessions[port]
+            if daemon is not None and daemon.is_alive:
+                replaced = self.warm.get(port)
+                self.warm[port] = daemon
+        if replaced is not None:
+            replaced.stop()
+
+    def get(self, port):
+        with self.lock:
+            return self.sessions.get(port)
+
+    def reap(self):
+        # Closes the sessions whose daemon or workers died, without touching the others. Returns their ports.
+        with self.lock:
+            dead = [(port, session) for port, session in self.sessions.items() if not session.is_alive]
+        for port, session in dead:
+            session.close()
+        # Warm daemons end themselves after their idle timeout, forget those
+        with self.lock:
+            for port, daemon in list(self.warm.items()):
+                if not daemon.is_alive:
+                    del self.warm[port]
+        return [port for port, session in dead]
+
+    def close(self, port):
+        session = self.get(port)
+        if session is not None:
+            session.close()
+
+    def close_all(self):
+        # Also stops the warm daemons, for shutting down
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.close()
+        with self.lock:
+            daemons, self.warm = list(self.warm.values()), {}
+        for daemon in daemons:
+            daemon.stop()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
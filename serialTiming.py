@@ -0,0 +1,33 @@
+import time
+from contextlib import contextmanager
+
+# Connecting should take less than this (seconds, not counting the user answering the permission popup), serial_printer
+# logs a warning with the breakdown otherwise
+CONNECT_BUDGET = 1.0
+
+class ConnectTimer():
+    # Wall clock time of each phase of setting up a connection. serial_printer and serialDaemon.py each keep one, the
+    # daemon's phases come along with its "ready" and end up in serial_printer.connect_timings.
+    def __init__(self):
+        self.phases = []    # [name, seconds] in the order they happened, a list so that it goes through json as it is
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append([name, time.perf_counter() - start])
+
+    def extend(self, phases, prefix=""):
+        self.phases.extend([prefix + name, seconds] for name, seconds in phases)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        return {name: seconds for name, seconds in self.phases}
+
+    def summary(self):
+        return ", ".join(f"{name} {seconds * 1e3:.1f}ms" for name, seconds in self.phases)
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import mmap
+import array
+import socket
+import struct
+import threading
+import select
+
+# serial_printer (__init__.py) and serialDaemon.py talk over one unix socket per session. Everything on it is a frame:
+# a header holding the channel and the payload length, followed by the payload.
+CHANNEL_DATA = 0        # bytes to/from the printer
+CHANNEL_CONTROL = 1     # commands and their replies
+CHANNEL_TELEMETRY = 2   # statistics and events from the daemon
+CHANNEL_DATA_FLUSH = 3  # bytes to the printer like CHANNEL_DATA, written right away instead of waiting to be merged
+
+HEADER = struct.Struct("<BI") # channel, payload length
+
+ADDRESS_ENV = "TERMUX_CDC_ACM_SOCKET"
+SHM_ENV = "TERMUX_CDC_ACM_SHM"  # "1" to move the data channel into shared memory rings, see ShmPipe
+RECV_SIZE = 65536
+MAX_FDS = 16                    # per frame
+SHM_SIZE = 65536
+
+def new_address():
+    # Unique per session, so that a session that is still being torn down can't get in the way of the next one.
+    # Abstract socket names (leading b'\0') don't leave files behind, they are written as "@name" for environment variables.
+    name = f"termux_cdc_acm-{os.getpid()}-{os.urandom(4).hex()}"
+    if sys.platform.startswith("linux") or sys.platform == "android":
+        return "@" + name
+    import tempfile # only here and in ShmPipe's fallback, it costs serialDaemon milliseconds at startup otherwise
+    return os.path.join(tempfile.gettempdir(), name + ".sock")
+
+def _sockaddr(address):
+    if address.startswith("@"):
+        return "\0" + address[1:]
+    return address
+
+def listen(address):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(_sockaddr(address))
+    sock.listen(1)
+    return sock
+
+def accept(listener, timeout=None):
+    # Only the same user may connect, the abstract namespace is visible to all apps
+    listener.settimeout(timeout)
+    sock, _ = listener.accept()
+    sock.settimeout(None)
+    pid, uid, gid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    if uid != os.getuid():
+        sock.close()
+        raise PermissionError(f"serialTransport:: connection from foreign uid {uid} refused")
+    return FramedConnection(sock)
+
+def connect(address):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(_sockaddr(address))
+    return FramedConnection(sock)
+
+def close_listener(listener, address):
+    listener.close()
+    if not address.startswith("@"):
+        try:
+            os.unlink(address)
+        except FileNotFoundError:
+            pass
+
+
+class FramedConnection():
+    # Length-prefixed frames over a stream socket. Sending is one sendmsg() per frame without joining header and
+    # payload, receiving reads as much as is there and splits it into frames, so that a batch of small frames costs one
+    # syscall. Sending is thread safe, receiving is meant for one thread.
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.rbuf = bytearray(RECV_SIZE)
+        self.rpos = 0   # start of the first frame that hasn't been returned by recv()
+        self.rlen = 0   # end of what has been received
+        self.fds = []   # file descriptors that came along with the frames, see take_fds()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, channel, data=b'', fds=()):
+        header = HEADER.pack(channel, len(data))
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))] if fds else []
+        with self.send_lock:
+            sent = self.sock.sendmsg([header, data], ancdata)
+            if sent < len(header) + len(data): # only happens for big frames
+                rest = memoryview(header + bytes(data))[sent:]
+                self.sock.sendall(rest)
+
+    def _frame(self):
+        # (channel, payload) of the next complete frame in rbuf, or None
+        available = self.rlen - self.rpos
+        if available < HEADER.size:
+            return None
+        channel, size = HEADER.unpack_from(self.rbuf, self.rpos)
+        if available < HEADER.size + size:
+            if HEADER.size + size > len(self.rbuf): # make room for a frame bigger than the buffer
+                self.rbuf.extend(bytes(HEADER.size + size - len(self.rbuf)))
+            return None
+        start = self.rpos + HEADER.size
+        self.rpos = start + size
+        return channel, bytes(self.rbuf[start:self.rpos])
+
+    def _fill(self):
+        if self.rpos: # move the incomplete rest to the front
+            self.rbuf[:self.rlen - self.rpos] = self.rbuf[self.rpos:self.rlen]
+            self.rlen -= self.rpos
+            self.rpos = 0
+        n, ancdata, flags, _ = self.sock.recvmsg_into([memoryview(self.rbuf)[self.rlen:]], socket.CMSG_SPACE(MAX_FDS * 4))
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                self.fds.extend(array.array("i", data[:len(data) - len(data) % 4]))
+        if not n:
+            raise EOFError
+        self.rlen += n
+
+    def poll(self, timeout=0):
+        # Whether recv() would return a frame without blocking (at least partially, a frame may be on its way)
+        if self.rlen - self.rpos >= HEADER.size:
+            return True
+        return bool(select.select([self.sock], [], [], timeout)[0])
+
+    def recv(self):
+        # Blocks until a complete frame is there, raises EOFError when the other side closed the connection
+        frame = self._frame()
+        while frame is None:
+            self._fill()
+            frame = self._frame()
+        return frame
+
+    def take_fds(self, count):
+        # The first count file descriptors received, they arrive together with (or before) the frame they belong to
+        fds, self.fds = self.fds[:count], self.fds[count:]
+        return fds
+
+    def send_control(self, cmd, fds=(), **args):
+        self.send(CHANNEL_CONTROL, json.dumps(dict(args, cmd=cmd)).encode(), fds)
+
+    def send_telemetry(self, event, **args):
+        self.send(CHANNEL_TELEMETRY, json.dumps(dict(args, event=event)).encode())
+
+    def close(self):
+        self.sock.close()
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+def decode_control(payload):
+    return json.loads(payload)
+
+
+class _Counter():
+    # An eventfd (or a pipe where there is none) that adds up the numbers written to it. ShmPipe uses two of them to
+    # publish how many bytes were put into/taken out of the ring. Going through a syscall on both sides also orders the
+    # accesses to the shared memory, which plain loads and stores from Python couldn't guarantee.
+    def __init__(self, rfd=None, wfd=None):
+        if rfd is None:
+            if hasattr(os, "eventfd"):
+                rfd = wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            else:
+                rfd, wfd = os.pipe()
+        os.set_blocking(rfd, False)
+        self.rfd = rfd
+        self.wfd = wfd
+
+    def add(self, n):
+        os.write(self.wfd, struct.pack("Q", n))
+
+    def take(self, timeout=0):
+        # Sum of everything added since the last call, 0 if nothing came within timeout (None waits forever)
+        if timeout != 0 and not select.select([self.rfd], [], [], timeout)[0]:
+            return 0
+        try:
+            data = os.read(self.rfd, 4096) # an eventfd returns one sum, a pipe several 8 byte numbers
+        except BlockingIOError:
+            return 0
+        return sum(struct.unpack(f"{len(data) // 8}Q", data))
+
+    def close(self):
+        os.close(self.rfd)
+        if self.wfd != self.rfd:
+            os.close(self.wfd)
+
+
+class ShmPipe():
+    # One direction of the shared memory data path: a single-producer/single-consumer byte ring in a memfd that both
+    # processes mmap. Bytes are copied into it and out of it, without another copy through the kernel like a socket has.
+    # The producer announces written bytes on one counter and the consumer announces freed space on another, so both
+    # only keep their own position and never read the other one's from shared memory.
+    # The memfd and the counters are handed to the other process over the unix socket (fds(), then ShmPipe(fds=...)).
+    FD_COUNT = 5
+
+    def __init__(self, size=SHM_SIZE, fds=None):
+        if fds is None:
+            if hasattr(os, "memfd_create"):
+                memfd = os.memfd_create("termux_cdc_acm", os.MFD_CLOEXEC)
+            else:
+                import tempfile
+                memfd, path = tempfile.mkstemp()
+                os.unlink(path)
+            os.ftruncate(memfd, size)
+            self.data = _Counter()
+            self.space = _Counter()
+        else:
+            memfd = fds[0]
+            self.data = _Counter(fds[1], fds[2])
+            self.space = _Counter(fds[3], fds[4])
+        self.memfd = memfd
+        self.size = os.fstat(memfd).st_size
+        self.mem = mmap.mmap(memfd, self.size)
+        self.head = 0   # absolute positions, only the consumer moves head and only the producer moves tail
+        self.tail = 0
+
+    def fds(self):
+        return [self.memfd, self.data.rfd, self.data.wfd, self.space.rfd, self.space.wfd]
+
+    def fileno(self):
+        # Readable when there is data for the consumer, for select()
+        return self.data.rfd
+
+    def write(self, data, timeout=None):
+        # Producer: copy data into the ring, waiting for space for up to timeout. Returns how many bytes went in.
+        data = memoryview(data)
+        written = pending = 0
+        while written < len(data):
+            self.head += self.space.take()
+            free = self.size - (self.tail - self.head)
+            if not free:
+                if pending: # the consumer has to know about what's in there before we can wait for it
+                    self.data.add(pending)
+                    pending = 0
+                freed = self.space.take(timeout)
+                if not freed:
+                    break
+                self.head += freed
+                continue
+            pos = self.tail % self.size
+            n = min(free, len(data) - written, self.size - pos)
+            self.mem[pos:pos + n] = data[written:written + n]
+            self.tail += n
+            written += n
+            pending += n
+        if pending:
+            self.data.add(pending)
+        return written
+
+    def read(self, timeout=0):
+        # Consumer: everything that is in the ring, waiting for up to timeout if it is empty. b'' if nothing came.
+        self.tail += self.data.take()
+        if self.tail == self.head:
+            self.tail += self.data.take(timeout)
+            if self.tail == self.head:
+                return b''
+        pos = self.head % self.size
+        n = self.tail - self.head
+        if pos + n <= self.size:
+            data = self.mem[pos:pos + n]
+        else:
+            data = self.mem[pos:self.size] + self.mem[0:pos + n - self.size]
+        self.head = self.tail
+        self.space.add(n)
+        return data
+
+    def close(self):
+        self.mem.close()
+        os.close(self.memfd)
+        self.data.close()
+        self.space.close()
@@ -1,17 +1,18 @@
 #!/usr/bin/env python
 
+import ctypes
 import logging
 import struct
 import threading
 import time
+from collections import deque
 
+import usb._interop
 import usb.backend.libusb1 as libusb1
 import usb.control
 import usb.core
 import usb.util
 
-# from pyftdi.misc import hexdump
-from pyftdi.misc import hexline
 
 
 LOGGER = logging.getLogger(__name__)
@@ -92,7 +93,215 @@ FLOW_CONTROL_XON_XOFF = 3
 #: in msec
 DEFAUL_TIMEOUT = 500
 
+#: bytes per bulk transfer of the buffer threads (a multiple of the packet
+#: size), and how many IN transfers are kept submitted
+TRANSFER_SIZE = 4096
+RX_TRANSFERS = 4
+
+# ----------------------------------------------------------------------------
+
+
+def hexline(data, sep=" "):
+    """Format data like pyftdi.misc.hexline, "(length) hex bytes : printable",
+    without importing pyftdi (and pulling in its dependencies at connect
+    time) just for this."""
+    data = bytes(data)
+    hexa = sep.join("%02x" % x for x in data)
+    printable = "".join(chr(x) if 32 <= x < 127 else "." for x in data)
+    return "(%d) %s : %s" % (len(data), hexa, printable)
+
+
 # ----------------------------------------------------------------------------
+# tracing
+
+
+#: bytes of the capture ring, 0 (the default) is off
+TRACE_ENV = "TERMUX_CDC_ACM_TRACE"
+#: bytes of data kept per transfer
+TRACE_SNAPLEN = 1024
+
+# usbmon's transfer types
+TRACE_INTERRUPT = 1
+TRACE_CONTROL = 2
+TRACE_BULK = 3
+
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+_PCAP_HEADER = struct.Struct("<IHHiIII")
+_PCAP_RECORD = struct.Struct("<IIII")
+_USBMON_PACKET = struct.Struct("<QBBBBHbbqiiII8siiII")
+
+_trace = None
+
+
+class TraceRing:
+    """Timestamped transfers in a fixed size binary ring, the oldest get
+    overwritten. dump() writes them as a pcap file with usbmon headers,
+    which Wireshark opens like a capture of Linux' usbmon.
+
+    A record is RECORD (time.time_ns(), transfer type, endpoint address,
+    length, captured) followed by the captured data, the setup packet first
+    for control transfers. The direction is the endpoint's (bit 7 of
+    bmRequestType for control transfers).
+    """
+
+    RECORD = struct.Struct("<QBBxxII")
+
+    def __init__(self, capacity=1 << 20, snaplen=TRACE_SNAPLEN):
+        self.capacity = capacity
+        self.snaplen = snaplen
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        # absolute positions like RingBuffer's
+        self.head = 0
+        self.tail = 0
+        self.records = 0
+        self.overwritten = 0
+        self.lock = threading.Lock()
+
+    def _put(self, pos, data):
+        s = pos % self.capacity
+        n = min(len(data), self.capacity - s)
+        self.buf[s : s + n] = data[:n]
+        if n < len(data):
+            self.buf[: len(data) - n] = data[n:]
+
+    def _get(self, pos, size):
+        s = pos % self.capacity
+        if s + size <= self.capacity:
+            return bytes(self.view[s : s + size])
+        return bytes(self.view[s:]) + bytes(self.view[: s + size - self.capacity])
+
+    def record(self, xfer, endpoint, data, setup=b""):
+        """Record a transfer of data (length is what got transferred)."""
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)  # lists, array.array of a control transfer
+        length = len(data)
+        data = memoryview(data).cast("B")[: self.snaplen]
+        header = self.RECORD.pack(
+            time.time_ns(), xfer, endpoint, length, len(setup) + len(data)
+        )
+        size = len(header) + len(setup) + len(data)
+        if size > self.capacity:
+            return
+        with self.lock:
+            while self.tail + size - self.head > self.capacity:
+                captured = self.RECORD.unpack(self._get(self.head, self.RECORD.size))[4]
+                self.head += self.RECORD.size + captured
+                self.records -= 1
+                self.overwritten += 1
+            for part in (header, setup, data):
+                self._put(self.tail, part)
+                self.tail += len(part)
+            self.records += 1
+
+    def snapshot(self):
+        """The records as (ns, transfer type, endpoint, length, setup,
+        data), oldest first."""
+        with self.lock:
+            raw = self._get(self.head, self.tail - self.head)
+        records = []
+        pos = 0
+        while pos < len(raw):
+            ns, xfer, endpoint, length, captured = self.RECORD.unpack_from(raw, pos)
+            pos += self.RECORD.size
+            setup = b""
+            if xfer == TRACE_CONTROL:
+                setup, pos, captured = raw[pos : pos + 8], pos + 8, captured - 8
+            records.append((ns, xfer, endpoint, length, setup, raw[pos : pos + captured]))
+            pos += captured
+        return records
+
+    def dump(self, path):
+        """Write the records to path as pcap (LINKTYPE_USB_LINUX_MMAPPED),
+        returns how many there were."""
+        records = self.snapshot()
+        with open(path, "wb") as f:
+            f.write(
+                _PCAP_HEADER.pack(
+                    0xA1B2C3D4, 2, 4, 0, 0,
+                    _USBMON_PACKET.size + 8 + self.snaplen,
+                    LINKTYPE_USB_LINUX_MMAPPED,
+                )
+            )
+            urb = 0
+            for ns, xfer, endpoint, length, setup, data in records:
+                urb += 1
+                if xfer == TRACE_CONTROL:
+                    # usbmon has the setup packet on the submission and IN
+                    # data on the completion
+                    out = not endpoint & 0x80
+                    events = [
+                        (b"S", setup, data if out else b"", length if out else struct.unpack("<H", setup[6:])[0]),
+                        (b"C", b"", b"" if out else data, length),
+                    ]
+                else:
+                    # OUT data goes with the submission, IN data with the
+                    # completion
+                    events = [(b"C" if endpoint & 0x80 else b"S", b"", data, length)]
+                sec, usec = ns // 1000000000, ns // 1000 % 1000000
+                for kind, setup_, data_, length_ in events:
+                    packet = _USBMON_PACKET.pack(
+                        urb, kind[0], xfer, endpoint, 0, 0,
+                        0 if setup_ else ord("-"),
+                        0 if data_ else ord("<" if endpoint & 0x80 else ">"),
+                        sec, usec, -115 if kind == b"S" else 0,  # -EINPROGRESS
+                        length_, len(data_), setup_,
+                        0, 0, 0, 0,
+                    )
+                    f.write(_PCAP_RECORD.pack(
+                        sec, usec, len(packet) + len(data_), len(packet) + length_
+                    ))
+                    f.write(packet)
+                    f.write(data_)
+        return len(records)
+
+    def stats(self):
+        return {
+            "records": self.records,
+            "bytes": self.tail - self.head,
+            "overwritten": self.overwritten,
+        }
+
+
+def start_trace(capacity=1 << 20, snaplen=TRACE_SNAPLEN):
+    """Record every transfer from now on into a new TraceRing of capacity
+    bytes, returns it. Costs nothing while tracing is off."""
+    global _trace
+    _trace = TraceRing(capacity, snaplen)
+    return _trace
+
+
+def stop_trace():
+    """Stop recording, returns the TraceRing (None if there was none)."""
+    global _trace
+    ring, _trace = _trace, None
+    return ring
+
+
+def dump_trace(path):
+    """Write what got recorded to path as pcap, returns the number of
+    records, None if not tracing."""
+    ring = _trace
+    return None if ring is None else ring.dump(path)
+
+
+def ctrl_transfer(
+    device, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None
+):
+    """device.ctrl_transfer(), recorded while tracing."""
+    ret = device.ctrl_transfer(bmRequestType, bRequest, wValue, wIndex, data_or_wLength, timeout)
+    if _trace is not None:
+        if bmRequestType & 0x80:
+            # pyusb returns the count when reading into a given buffer
+            data = data_or_wLength[:ret] if isinstance(ret, int) else ret
+            wLength = data_or_wLength if isinstance(data_or_wLength, int) else len(data_or_wLength)
+        else:
+            data = data_or_wLength if data_or_wLength is not None else b""
+            wLength = len(data)
+        setup = struct.pack("<BBHHH", bmRequestType, bRequest, wValue, wIndex, wLength)
+        _trace.record(TRACE_CONTROL, bmRequestType & 0x80, data, setup)
+    return ret
 
 
 def device_from_fd(fd):
@@ -139,6 +348,345 @@ def device_from_fd(fd):
     return device
 
 
+class BufferWindow:
+    """Present a writable buffer (e.g. a memoryview slice into a larger
+    bytearray) the way pyusb's backends expect an array.array, so that
+    transfers land directly in it."""
+
+    itemsize = 1
+
+    def __init__(self, buffer):
+        self._cbuf = (ctypes.c_ubyte * len(buffer)).from_buffer(buffer)
+
+    def buffer_info(self):
+        return ctypes.addressof(self._cbuf), len(self._cbuf)
+
+    def __len__(self):
+        return len(self._cbuf)
+
+
+class Endpoint:
+    """What a transfer needs to know about an endpoint, without looking it
+    up in the configuration descriptor like pyusb does for each transfer.
+
+    Has the attributes of a usb.core.Endpoint that the drivers use, and can
+    be built from a cached device profile without parsing any descriptors.
+    The interface has to be claimed already.
+    """
+
+    def __init__(self, device, bEndpointAddress, wMaxPacketSize, bmAttributes, bInterfaceNumber):
+        self.device = device
+        self.bEndpointAddress = bEndpointAddress
+        self.wMaxPacketSize = wMaxPacketSize
+        self.bmAttributes = bmAttributes
+        self.bInterfaceNumber = bInterfaceNumber
+        backend = device.backend
+        if usb.util.endpoint_type(bmAttributes) == usb.util.ENDPOINT_TYPE_INTR:
+            self._read, self._write = backend.intr_read, backend.intr_write
+            self._xfer = TRACE_INTERRUPT
+        else:
+            self._read, self._write = backend.bulk_read, backend.bulk_write
+            self._xfer = TRACE_BULK
+
+    def _timeout(self, timeout):
+        return self.device.default_timeout if timeout is None else timeout
+
+    def read_into(self, buffer, timeout=None):
+        n = self._read(
+            self.device._ctx.handle,
+            self.bEndpointAddress,
+            self.bInterfaceNumber,
+            BufferWindow(buffer),
+            self._timeout(timeout),
+        )
+        if _trace is not None and n:
+            _trace.record(self._xfer, self.bEndpointAddress, memoryview(buffer)[:n])
+        return n
+
+    def read(self, size_or_buffer, timeout=None):
+        if isinstance(size_or_buffer, int):
+            buffer = bytearray(size_or_buffer)
+            return memoryview(buffer)[: self.read_into(buffer, timeout)]
+        return self.read_into(size_or_buffer, timeout)
+
+    def write(self, data, timeout=None):
+        n = self._write(
+            self.device._ctx.handle,
+            self.bEndpointAddress,
+            self.bInterfaceNumber,
+            usb._interop.as_array(data),
+            self._timeout(timeout),
+        )
+        if _trace is not None:
+            _trace.record(self._xfer, self.bEndpointAddress, data[:n])
+        return n
+
+
+def read_into(device, endpoint, buffer, timeout=None):
+    """Read from a bulk or interrupt IN endpoint straight into buffer.
+
+    Unlike device.read() no intermediate array is allocated (and then
+    copied by the caller). Returns the number of bytes read.
+    """
+    if isinstance(endpoint, Endpoint):
+        return endpoint.read_into(buffer, timeout)
+    backend = device.backend
+    intf, ep = device._ctx.setup_request(device, endpoint)
+    if usb.util.endpoint_type(ep.bmAttributes) == usb.util.ENDPOINT_TYPE_INTR:
+        fn = backend.intr_read
+    else:
+        fn = backend.bulk_read
+    if timeout is None:
+        timeout = device.default_timeout
+    n = fn(
+        device._ctx.handle,
+        ep.bEndpointAddress,
+        intf.bInterfaceNumber,
+        BufferWindow(buffer),
+        timeout,
+    )
+    if _trace is not None and n:
+        xfer = TRACE_INTERRUPT if fn == backend.intr_read else TRACE_BULK
+        _trace.record(xfer, ep.bEndpointAddress, memoryview(buffer)[:n])
+    return n
+
+
+# ----------------------------------------------------------------------------
+# asynchronous transfers
+
+
+LIBUSB_TRANSFER_COMPLETED = 0
+LIBUSB_TRANSFER_ERROR = 1
+LIBUSB_TRANSFER_TIMED_OUT = 2
+LIBUSB_TRANSFER_CANCELLED = 3
+LIBUSB_TRANSFER_STALL = 4
+LIBUSB_TRANSFER_NO_DEVICE = 5
+LIBUSB_TRANSFER_OVERFLOW = 6
+
+LIBUSB_TRANSFER_TYPE_BULK = 2
+LIBUSB_TRANSFER_TYPE_INTERRUPT = 3
+
+TRANSFER_STATUS = {
+    LIBUSB_TRANSFER_COMPLETED: "completed",
+    LIBUSB_TRANSFER_ERROR: "error",
+    LIBUSB_TRANSFER_TIMED_OUT: "timed out",
+    LIBUSB_TRANSFER_CANCELLED: "cancelled",
+    LIBUSB_TRANSFER_STALL: "stall",
+    LIBUSB_TRANSFER_NO_DEVICE: "no device",
+    LIBUSB_TRANSFER_OVERFLOW: "overflow",
+}
+
+
+class _Transfer(ctypes.Structure):
+    # struct libusb_transfer, without the trailing iso_packet_desc (never used
+    # for bulk and interrupt transfers)
+    pass
+
+
+_transfer_cb_fn = ctypes.CFUNCTYPE(None, ctypes.POINTER(_Transfer))
+
+_Transfer._fields_ = [
+    ("dev_handle", ctypes.c_void_p),
+    ("flags", ctypes.c_uint8),
+    ("endpoint", ctypes.c_ubyte),
+    ("type", ctypes.c_ubyte),
+    ("timeout", ctypes.c_uint),
+    ("status", ctypes.c_int),
+    ("length", ctypes.c_int),
+    ("actual_length", ctypes.c_int),
+    ("callback", _transfer_cb_fn),
+    ("user_data", ctypes.c_void_p),
+    ("buffer", ctypes.c_void_p),
+    ("num_iso_packets", ctypes.c_int),
+]
+
+
+class _Timeval(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+
+_async_lib = None
+
+
+def async_lib(backend):
+    """The libusb pyusb loaded, with prototypes for the asynchronous API.
+
+    A second ctypes handle on the same library, so that pyusb's own
+    prototypes stay untouched.
+    """
+    global _async_lib
+    if _async_lib is None:
+        lib = ctypes.CDLL(backend.lib._name, handle=backend.lib._handle)
+        lib.libusb_alloc_transfer.argtypes = [ctypes.c_int]
+        lib.libusb_alloc_transfer.restype = ctypes.POINTER(_Transfer)
+        lib.libusb_submit_transfer.argtypes = [ctypes.POINTER(_Transfer)]
+        lib.libusb_submit_transfer.restype = ctypes.c_int
+        lib.libusb_cancel_transfer.argtypes = [ctypes.POINTER(_Transfer)]
+        lib.libusb_cancel_transfer.restype = ctypes.c_int
+        lib.libusb_free_transfer.argtypes = [ctypes.POINTER(_Transfer)]
+        lib.libusb_free_transfer.restype = None
+        lib.libusb_handle_events_timeout_completed.argtypes = [
+            ctypes.c_void_p,
+            ctypes.POINTER(_Timeval),
+            ctypes.POINTER(ctypes.c_int),
+        ]
+        lib.libusb_handle_events_timeout_completed.restype = ctypes.c_int
+        lib.libusb_handle_events_completed.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+        lib.libusb_handle_events_completed.restype = ctypes.c_int
+        lib.libusb_error_name.argtypes = [ctypes.c_int]
+        lib.libusb_error_name.restype = ctypes.c_char_p
+        _async_lib = lib
+    return _async_lib
+
+
+class AsyncReader:
+    """Keep count transfers of size bytes submitted on an IN endpoint.
+
+    A synchronous read leaves the endpoint without a transfer from the
+    moment it returns until Python gets around to the next one, and a fast
+    device overruns its FIFO meanwhile. Here the device always has
+    somewhere to put data. Completed transfers are handed to
+    on_data(memoryview) in the order they were submitted (the view is only
+    valid during the call) and submitted again right after.
+
+    Callbacks only run inside handle_events(), which the owner calls in a
+    loop (e.g. its reader thread). Works with handles from device_from_fd
+    as well as with devices opened by pyusb, endpoint is an Endpoint.
+    """
+
+    def __init__(self, endpoint, on_data, count=4, size=None, timeout=0):
+        device = endpoint.device
+        self.lib = async_lib(device.backend)
+        self.ctx = device.backend.ctx
+        self.on_data = on_data
+        packet = endpoint.wMaxPacketSize
+        # transfers have to be a multiple of the packet size, or the last
+        # packet could overflow them
+        size = size or 8 * packet
+        self.size = -(-size // packet) * packet
+        self.error = None
+        self.stopping = False
+        self.pending = 0
+        self.transfers = 0  # completed with data
+        self.bytes = 0
+        self.starved = 0  # times the device had no transfer left to fill
+
+        self.address = endpoint.bEndpointAddress
+        if usb.util.endpoint_type(endpoint.bmAttributes) == usb.util.ENDPOINT_TYPE_INTR:
+            kind = LIBUSB_TRANSFER_TYPE_INTERRUPT
+            self._xfer = TRACE_INTERRUPT
+        else:
+            kind = LIBUSB_TRANSFER_TYPE_BULK
+            self._xfer = TRACE_BULK
+        handle = device._ctx.handle.handle
+        self._callback = _transfer_cb_fn(self._complete)  # referenced, or ctypes frees it
+        self.buffers = [bytearray(self.size) for _ in range(count)]
+        self._cbufs = [(ctypes.c_ubyte * self.size).from_buffer(b) for b in self.buffers]
+        self._transfers = []
+        for index, cbuf in enumerate(self._cbufs):
+            transfer = self.lib.libusb_alloc_transfer(0)
+            if not transfer:
+                self.close()
+                raise usb.core.USBError("libusb_alloc_transfer failed")
+            t = transfer.contents
+            t.dev_handle = handle.value
+            t.endpoint = endpoint.bEndpointAddress
+            t.type = kind
+            t.timeout = timeout
+            t.length = self.size
+            t.buffer = ctypes.addressof(cbuf)
+            t.callback = self._callback
+            t.user_data = index
+            self._transfers.append(transfer)
+        self.submitted = [False] * count
+
+    def _submit(self, index):
+        ret = self.lib.libusb_submit_transfer(self._transfers[index])
+        if ret < 0:
+            self.error = usb.core.USBError(
+                "libusb_submit_transfer failed: {}".format(self.lib.libusb_error_name(ret).decode()), ret
+            )
+            return
+        self.submitted[index] = True
+        self.pending += 1
+
+    def start(self):
+        for index in range(len(self._transfers)):
+            self._submit(index)
+
+    def _complete(self, transfer_p):
+        # runs inside handle_events(), exceptions must not reach ctypes
+        try:
+            t = transfer_p.contents
+            index = t.user_data or 0
+            self.submitted[index] = False
+            self.pending -= 1
+            status = t.status
+            if status in (LIBUSB_TRANSFER_COMPLETED, LIBUSB_TRANSFER_TIMED_OUT):
+                if not self.pending:
+                    self.starved += 1
+                if t.actual_length:
+                    self.transfers += 1
+                    self.bytes += t.actual_length
+                    data = memoryview(self.buffers[index])[: t.actual_length]
+                    if _trace is not None:
+                        _trace.record(self._xfer, self.address, data)
+                    self.on_data(data)
+                if not self.stopping and self.error is None:
+                    self._submit(index)
+            elif status != LIBUSB_TRANSFER_CANCELLED:
+                self.error = usb.core.USBError(
+                    "IN transfer failed: {}".format(TRANSFER_STATUS.get(status, status))
+                )
+        except Exception as e:
+            self.error = e
+
+    def handle_events(self, timeout=0.1):
+        """Run the callbacks of completed transfers, waiting up to timeout
+        seconds (None: until there is one) for one. Raises what went wrong
+        in them."""
+        if timeout is None:
+            ret = self.lib.libusb_handle_events_completed(self.ctx, None)
+        else:
+            tv = _Timeval(int(timeout), int(timeout % 1 * 1e6))
+            ret = self.lib.libusb_handle_events_timeout_completed(self.ctx, ctypes.byref(tv), None)
+        if ret < 0:
+            raise usb.core.USBError("libusb_handle_events failed", ret)
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        return {
+            "transfers": self.transfers,
+            "bytes": self.bytes,
+            "bytes/transfer": self.bytes / self.transfers if self.transfers else 0,
+            "starved": self.starved,
+        }
+
+    def cancel(self):
+        """Stop resubmitting and cancel what is submitted. Safe from any
+        thread, the cancellations wake up handle_events()."""
+        self.stopping = True
+        for index, transfer in enumerate(self._transfers):
+            if self.submitted[index]:
+                self.lib.libusb_cancel_transfer(transfer)
+
+    def close(self):
+        """Cancel what is still submitted, wait for it and free the
+        transfers. Call from the thread handling the events."""
+        self.cancel()
+        deadline = time.monotonic() + 1
+        while self.pending and time.monotonic() < deadline:
+            tv = _Timeval(0, 100000)
+            self.lib.libusb_handle_events_timeout_completed(self.ctx, ctypes.byref(tv), None)
+        if self.pending:  # freeing them now would crash libusb later
+            LOGGER.warning("%d transfers didn't finish, leaking them", self.pending)
+            return
+        for transfer in self._transfers:
+            self.lib.libusb_free_transfer(transfer)
+        self._transfers = []
+
+
 def shell_usbdevice(fd, device):
     # interactive explore
     backend = device.backend
@@ -181,77 +729,357 @@ def shell_usbdevice(fd, device):
 # ----------------------------------------------------------------------------
 
 
-class Buffer:
-    # https://stackoverflow.com/a/57748513/9360161
-    def __init__(self):
-        self.buf = bytearray()
+class RingBuffer:
+    """Fixed capacity byte ring between the USB threads and the user.
+
+    Reading and writing only move positions, nothing gets shifted around
+    (bytearray slicing moved the whole backlog on every read). Writers
+    block while it is full (backpressure), or write what fits with a
+    timeout of 0. read_view()/consume() hand out the data without copying
+    it. Readers wait on `readable`, writers on `writable`, so neither side
+    wakes up the other for nothing.
+
+    Searching for a delimiter is incremental: the buffer remembers how far
+    it has scanned and where the delimiters it found are, so each byte gets
+    looked at once no matter how often find() is asked while a long line
+    trickles in. Short lines take a shortcut: as long as nothing is indexed
+    and the data doesn't wrap around, one find() over the front is all
+    there is to it. read_until() returns a memoryview into the ring, valid
+    until the next read.
+
+    Watermarks with hysteresis: `above_high` gets set when the level
+    reaches `high` and cleared when it falls to `low`, `below_low` is its
+    complement. on_watermark(above) is called on each transition, with the
+    lock held.
+    """
+
+    def __init__(self, capacity=65536, high=None, low=None, on_watermark=None):
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        # absolute positions, modulo capacity gives the index into buf
+        self.head = 0  # first byte not read yet
+        self.tail = 0  # end of the data
+        self.reclaimed = 0  # writers may reuse what is before, see read_until()
+        self.high = capacity * 3 // 4 if high is None else high
+        self.low = capacity // 4 if low is None else low
+        self.on_watermark = on_watermark
         self.lock = threading.RLock()
-        self.changed = threading.Condition(self.lock)
-        # TODO: max size? - dequeue? / ringbuffer
+        self.readable = threading.Condition(self.lock)
+        self.writable = threading.Condition(self.lock)
+        # threads waiting on them, notifying nobody costs more than a short read or write
+        self.readers_waiting = 0
+        self.writers_waiting = 0
+        self.above_high = threading.Event()
+        self.below_low = threading.Event()
+        self.below_low.set()
+        # delimiter index
+        self.delimiter = None  # what found holds the positions of
+        self.scanned = 0  # everything before has been searched for it
+        self.found = deque()  # absolute end positions of delimiters
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def space(self):
+        return self.capacity - (self.tail - self.reclaimed)
+
+    def _levels(self):
+        level = len(self)
+        if level >= self.high and not self.above_high.is_set():
+            self.below_low.clear()
+            self.above_high.set()
+            if self.on_watermark is not None:
+                self.on_watermark(True)
+        elif level <= self.low and not self.below_low.is_set():
+            self.above_high.clear()
+            self.below_low.set()
+            if self.on_watermark is not None:
+                self.on_watermark(False)
+
+    def _segments(self, start, end):
+        """Index ranges into buf between the absolute positions start and
+        end, two if it wraps around."""
+        s, e = start % self.capacity, (end - 1) % self.capacity + 1
+        if end - start <= 0:
+            return []
+        if s < e:
+            return [(s, e)]
+        return [(s, self.capacity), (0, e)]
+
+    def _advance(self, size):
+        # drops size bytes from the front, without giving the space back
+        self.head += size
+        while self.found and self.found[0] - len(self.delimiter) < self.head:
+            self.found.popleft()
+        self.scanned = max(self.scanned, self.head)
+        self._levels()
+
+    def _reclaim(self):
+        # what read_until() handed out is done with once the next read comes
+        if self.reclaimed != self.head:
+            self.reclaimed = self.head
+            if self.writers_waiting:
+                self.writable.notify_all()
 
     def clear(self):
         with self.lock:
-            self.buf[:] = b""
-            self.changed.notify()
+            self._advance(len(self))
+            self._reclaim()
 
-    def write(self, data):
+    def _wait_readable(self, predicate, timeout):
+        self.readers_waiting += 1
+        try:
+            return self.readable.wait_for(predicate, timeout)
+        finally:
+            self.readers_waiting -= 1
+
+    def _wait_writable(self, predicate, timeout):
+        self.writers_waiting += 1
+        try:
+            return self.writable.wait_for(predicate, timeout)
+        finally:
+            self.writers_waiting -= 1
+
+    # writer side
+
+    def write(self, data, timeout=None):
+        """Append data, waiting up to timeout seconds (None: forever) for
+        room. Returns how much got written."""
+        if isinstance(data, int):
+            data = bytes((data,))
+        with self.lock:  # the usual case: it fits, without wrapping around
+            n = len(data)
+            s = self.tail % self.capacity
+            if n <= self.space() and s + n <= self.capacity:
+                self.buf[s : s + n] = data
+                self.tail += n
+                if self.tail - self.head >= self.high and not self.above_high.is_set():
+                    self._levels()
+                if self.readers_waiting:
+                    self.readable.notify_all()
+                return n
+        data = memoryview(data).cast("B")
+        written = 0
+        with Timeout(timeout) as to:
+            with self.lock:
+                while written < len(data):
+                    n = min(self.space(), len(data) - written)
+                    if n:
+                        for s, e in self._segments(self.tail, self.tail + n):
+                            self.buf[s:e] = data[written : written + e - s]
+                            written += e - s
+                        self.tail += n
+                        self._levels()
+                        if self.readers_waiting:
+                            self.readable.notify_all()
+                        continue
+                    if to.expired() or not self._wait_writable(lambda: self.space(), to.time_left()):
+                        break
+        return written
+
+    # reader side
+
+    def read_view(self, size=-1):
+        """Up to size bytes (all if not positive) as a memoryview into the
+        ring, without copying. Only what is contiguous, call again after
+        consume() for the rest. Valid until consume()."""
         with self.lock:
-            try:
-                if isinstance(data, int):
-                    self.buf.append(data)
-                    return 1
-                else:
-                    self.buf.extend(data)
-                    return len(data)
-            finally:
-                self.changed.notify()
+            self._reclaim()
+            segments = self._segments(self.head, self.tail)
+            if not segments:
+                return self.view[0:0]
+            s, e = segments[0]
+            if size is not None and size > 0:
+                e = min(e, s + size)
+            return self.view[s:e]
+
+    def consume(self, size):
+        """Drop size bytes from the front, e.g. after read_view()."""
+        with self.lock:
+            self._advance(min(size, len(self)))
+            self._reclaim()
 
-    def read(self, size):
+    def peek(self, size=-1):
         with self.lock:
-            try:
-                # if size == 1:
-                #     return self.buf.pop(0)
+            if size is None or size <= 0 or size > len(self):
+                size = len(self)
+            return b"".join(self.view[s:e] for s, e in self._segments(self.head, self.head + size))
 
-                if not size or size <= 0:
-                    # None, 0, negative
-                    size = len(self)
+    def read(self, size=-1):
+        with self.lock:
+            self._reclaim()
+            data = self.peek(size)
+            self.consume(len(data))
+            return data
 
-                data = self.buf[:size]
-                self.buf[:size] = b""
-                return data
-            finally:
-                self.changed.notify()
+    def _search(self, expected, start, end):
+        """Absolute position of expected between the absolute positions
+        start and end, -1 if it isn't there."""
+        segments = self._segments(start, end)
+        if not segments:
+            return -1
+        s, e = segments[0]
+        pos = self.buf.find(expected, s, e)
+        if pos != -1:
+            return start + pos - s
+        if len(segments) == 1:
+            return -1
+        # across the end of buf, then in the part at the beginning
+        overlap = len(expected) - 1
+        if overlap:
+            seam = bytes(self.view[max(s, e - overlap) : e]) + bytes(self.view[0 : min(overlap, segments[1][1])])
+            pos = seam.find(expected)
+            if pos != -1:
+                return start + (e - s) - min(overlap, e - s) + pos
+        pos = self.buf.find(expected, 0, segments[1][1])
+        if pos != -1:
+            return start + (e - s) + pos
+        return -1
+
+    def _scan(self, expected):
+        # adds the delimiters in what arrived since the last scan to found
+        if expected != self.delimiter:  # another one, start over
+            self.delimiter = expected
+            self.found.clear()
+            self.scanned = self.head
+        if self.scanned == self.tail:
+            return
+        elen = len(expected)
+        scanned = self.scanned
+        # one that started before scanned but didn't end there yet
+        start = max(self.head, scanned - (elen - 1))
+        segments = self._segments(start, self.tail)
+        if len(segments) == 1:  # the usual case, searched right in buf
+            s, e = segments[0]
+            offset = start - s
+            pos = self.buf.find(expected, s, e)
+            while pos != -1:
+                if offset + pos + elen > scanned:
+                    self.found.append(offset + pos + elen)
+                pos = self.buf.find(expected, pos + elen, e)
+        else:
+            while True:
+                pos = self._search(expected, start, self.tail)
+                if pos == -1:
+                    break
+                if pos + elen > scanned:
+                    self.found.append(pos + elen)
+                start = pos + elen
+        self.scanned = self.tail
+
+    def _find_front(self, expected, start=0):
+        """Offset of expected from the front if the data doesn't wrap around
+        and no delimiter is indexed (short lines, the usual case): one find()
+        over it, without _scan()'s bookkeeping. None otherwise."""
+        if expected != self.delimiter:  # another one, start over
+            self.delimiter = expected
+            self.found.clear()
+            self.scanned = self.head
+        head = self.head
+        s = head % self.capacity
+        e = s + self.tail - head
+        if e > self.capacity or self.found:
+            return None
+        # before scanned there is none
+        origin = self.scanned - len(expected) + 1
+        begin = head + start
+        pos = self.buf.find(expected, s + (begin if begin > origin else origin) - head, e)
+        if pos == -1:
+            if begin <= origin:
+                self.scanned = self.tail
+            return -1
+        return pos - s
+
+    def _find(self, expected, start=0):
+        elen = len(expected)
+        if self.scanned == self.tail and self.found and expected == self.delimiter:
+            if self.found[0] - elen >= self.head + start:  # nothing new, and the next one is known
+                return self.found[0] - elen - self.head
+        self._scan(expected)
+        for end in self.found:
+            if end - elen >= self.head + start:
+                return end - elen - self.head
+        return -1
+
+    def find(self, expected, start=0):
+        """Offset of expected from the front, -1 if it isn't there."""
+        if type(expected) is not bytes:
+            expected = bytes((expected,)) if isinstance(expected, int) else bytes(expected)
+        with self.lock:
+            pos = self._find_front(expected, start)
+            return self._find(expected, start) if pos is None else pos
+
+    def contains(self, expected):
+        return self.find(expected) != -1
 
     def read_until(self, expected, size=-1):
-        try:
-            elen = len(expected)
-        except TypeError:
-            elen = 1
+        """Read up to and including expected, at most size bytes. All there
+        is (or size) if expected isn't there.
+
+        Returns a memoryview into the ring, valid until the next read. Only
+        data wrapping around the end of the ring gets copied."""
+        if type(expected) is not bytes:
+            expected = bytes((expected,)) if isinstance(expected, int) else bytes(expected)
 
         with self.lock:
-            pos = self.buf.find(expected)
+            head = self.head
+            if self.reclaimed != head:
+                self._reclaim()
+            # short lines, the usual case: found in the contiguous part at the
+            # front, the line is a view of it
+            pos = self._find_front(expected)
+            if pos is not None and pos != -1 and (size is None or size <= 0 or pos + len(expected) <= size):
+                s = head % self.capacity
+                n = pos + len(expected)
+                self.head = head + n
+                if self.scanned < self.head:
+                    self.scanned = self.head
+                if self.tail - self.head <= self.low and not self.below_low.is_set():
+                    self._levels()
+                return self.view[s : s + n]
+            if pos is None:
+                pos = self._find(expected)
+            n = len(self) if pos == -1 else pos + len(expected)
+            if size is not None and size > 0:
+                n = min(n, size)
+            segments = self._segments(self.head, self.head + n)
+            if not segments:
+                data = self.view[0:0]
+            elif len(segments) == 1:
+                data = self.view[segments[0][0] : segments[0][1]]
+            else:
+                data = memoryview(b"".join(self.view[s:e] for s, e in segments))
+            self._advance(n)
+            return data
 
-            # not found, return max
-            if pos == -1:
-                return self.read(size)
+    def wait_readable(self, timeout=None, abort=None):
+        """Wait up to timeout seconds for data, True if there is some.
 
-            # found, compute total length
-            elen = pos + elen
-            # if len restriction then until limit
-            if size > 0 and elen > size:
-                return self.read(size)
-            # return normal
-            return self.read(elen)
+        abort() is checked on each wakeup as well, wake() makes a waiter
+        look at it without any data coming."""
+        with self.lock:
+            if abort is None:
+                return self._wait_readable(lambda: len(self), timeout)
+            return self._wait_readable(lambda: len(self) or abort(), timeout) and len(self)
 
-    def contains(self, expected):
+    def wait_more(self, than, timeout=None):
+        """Wait up to timeout seconds for more than `than` bytes, True if
+        there are."""
         with self.lock:
-            return -1 != self.buf.find(expected)
+            return self._wait_readable(lambda: len(self) > than, timeout)
 
-    def peek(self, size):
-        return self.buf[:size]
+    def wait_empty(self, timeout=None):
+        """Wait up to timeout seconds until everything got read, True if
+        so."""
+        with self.lock:
+            return self._wait_writable(lambda: not len(self), timeout)
 
-    def __len__(self):
-        return len(self.buf)
+    def wake(self):
+        """Wake up all waiters, e.g. a thread that should stop."""
+        with self.lock:
+            self.readable.notify_all()
+            self.writable.notify_all()
 
 
 class Timeout:
@@ -338,48 +1166,83 @@ class AbstractStoppableThread(threading.Thread):
         raise NotImplementedError
 
 
-# TODO: r/w may not need to happen in chunks?
+class SerialBufferReadThread(AbstractStoppableThread):
+    """Keeps `transfers` IN transfers of `transfer_size` bytes submitted
+    (see AsyncReader) and puts what arrives into buffer.
 
+    Sleeps in libusb until a transfer completes, stop() cancels them to
+    wake it up."""
 
-class SerialBufferReadThread(AbstractStoppableThread):
-    def __init__(self, serial, endpoint, buffer, timeout=None, *args, **kwargs):
+    def __init__(
+        self,
+        serial,
+        endpoint,
+        buffer,
+        transfer_size=TRANSFER_SIZE,
+        transfers=RX_TRANSFERS,
+        *args,
+        **kwargs
+    ):
         super(SerialBufferReadThread, self).__init__(serial, *args, **kwargs)
         self.endpoint = endpoint
         self.buffer = buffer
-        self.timeout = timeout
+        self.transfer_size = transfer_size
+        self.transfers = transfers
+        self.reader = None
 
-    def runOne(self):
-        ser = self.serial
-        device = ser.device
-        endp = self.endpoint
-        buf = self.buffer
+    def stop(self):
+        super(SerialBufferReadThread, self).stop()
+        reader = self.reader
+        if reader is not None:
+            reader.cancel()
 
-        data = None
+    def run(self):
+        self.reader = AsyncReader(
+            self.endpoint, self._received, self.transfers, self.transfer_size
+        )
         try:
-            data = device.read(endp.bEndpointAddress, endp.wMaxPacketSize, self.timeout)
+            if self.shouldRun():
+                self.reader.start()
+            super(SerialBufferReadThread, self).run()
+        finally:
+            self.reader.close()
+
+    def runOne(self):
+        self.reader.handle_events(None)
+
+    def _received(self, data):
+        if RXTXLOGGER.isEnabledFor(logging.DEBUG):
             RXTXLOGGER.debug("[RX] %s", hexline(data))
-        except libusb1.USBError as ue:
-            # 110/-7 for timeout
-            if ue.errno != 110:
-                raise
-            RXTXLOGGER.debug(
-                "RX Timeout: errno: %s, backend_error_code: %s",
-                ue.errno,
-                ue.backend_error_code,
-            )
-        if data is not None:
-            buf.write(data)
-        # TODO: event
+        buf = self.buffer
+        # blocks while the buffer is full, the device holds back meanwhile
+        while data and self.shouldRun():
+            data = data[buf.write(data, timeout=DEFAUL_TIMEOUT / 1000.0) :]
 
 
 class SerialBufferWriteThread(AbstractStoppableThread):
+    """Sends what gets into buffer in bulk transfers of up to
+    `transfer_size` bytes. Sleeps on the buffer until there is something,
+    stop() wakes it up."""
+
     def __init__(
-        self, serial, endpoint, buffer, timeout=DEFAUL_TIMEOUT, *args, **kwargs
+        self,
+        serial,
+        endpoint,
+        buffer,
+        timeout=DEFAUL_TIMEOUT,
+        transfer_size=TRANSFER_SIZE,
+        *args,
+        **kwargs
     ):
         super(SerialBufferWriteThread, self).__init__(serial, *args, **kwargs)
         self.endpoint = endpoint
         self.buffer = buffer
         self.timeout = timeout
+        self.transfer_size = transfer_size
+
+    def stop(self):
+        super(SerialBufferWriteThread, self).stop()
+        self.buffer.wake()
 
     def runOne(self):
         ser = self.serial
@@ -387,33 +1250,43 @@ class SerialBufferWriteThread(AbstractStoppableThread):
         endp = self.endpoint
         buf = self.buffer
 
-        if not buf:
-            with buf.changed:
-                buf.changed.wait(self.timeout / 1000.0)
+        if not buf.wait_readable(None, lambda: not self.shouldRun()):
+            return
 
-        data = buf.read(endp.wMaxPacketSize)
+        # straight out of the buffer, it only gets dropped once written
+        data = buf.read_view(self.transfer_size)
         if not data:
             return
 
-        RXTXLOGGER.debug("[TX] %s", hexline(data))
-        num = device.write(endp.bEndpointAddress, data, self.timeout)
+        if RXTXLOGGER.isEnabledFor(logging.DEBUG):
+            RXTXLOGGER.debug("[TX] %s", hexline(data))
+        # on top of the timeout, the time the bytes take on the wire (10
+        # bits each), a timed out transfer doesn't tell how much got out
+        timeout = self.timeout + len(data) * 10000 // ser.baudrate
+        num = device.write(endp.bEndpointAddress, data, timeout)
+        if _trace is not None:
+            _trace.record(TRACE_BULK, endp.bEndpointAddress, data[:num])
 
         if num < len(data):
-            RXTXLOGGER.error(
-                "TX data loss: wrote %s of %s bytes! data: %s",
-                num,
-                len(data),
-                hexline(data),
+            RXTXLOGGER.warning(
+                "TX: wrote %s of %s bytes, retrying the rest", num, len(data)
             )
-
-        # TODO: event
+        buf.consume(num)
 
 
 class CP210xSerial:
-    def __init__(self, device, baudRate=DEFAULT_BAUDRATE):
+    def __init__(
+        self,
+        device,
+        baudRate=DEFAULT_BAUDRATE,
+        transfer_size=TRANSFER_SIZE,
+        rx_transfers=RX_TRANSFERS,
+    ):
         assert self.is_usb_cp210x(device), "Unknown CP210x device!"
         self._device = device
         self._intf = 0
+        # looked up once, every transfer used to walk the configuration
+        self._endp_in, self._endp_out = self.get_endpoints(device)
 
         self._baudRate = baudRate
         self._rtsCts_enabled = False
@@ -424,8 +1297,13 @@ class CP210xSerial:
 
         self._is_open = False
         self._is_async = False
-        self._buf_in = Buffer()
-        self._buf_out = Buffer()
+        self._buf_in = RingBuffer()
+        self._buf_out = RingBuffer()
+        # multiple of the packet size, so that only the last packet of a
+        # transfer can be short
+        packet = self._endp_in.wMaxPacketSize
+        self._transfer_size = max(packet, transfer_size // packet * packet)
+        self._rx_transfers = rx_transfers
         self._thrd_buf_in = None
         self._thrd_buf_out = None
 
@@ -463,7 +1341,8 @@ class CP210xSerial:
     # --------------------------------
 
     def send_ctrl_cmd(self, request, value=0, data=None, intf=0):
-        ret = self._device.ctrl_transfer(
+        ret = ctrl_transfer(
+            self._device,
             CP210x_REQTYPE_HOST2DEVICE,
             request,
             wValue=value,
@@ -475,7 +1354,8 @@ class CP210xSerial:
 
     def recv_ctrl_cmd(self, request, blen, value=0, intf=0):
         buf = usb.util.create_buffer(blen)
-        ret = self._device.ctrl_transfer(
+        ret = ctrl_transfer(
+            self._device,
             CP210x_REQTYPE_DEVICE2HOST,
             request,
             wValue=value,
@@ -742,8 +1622,7 @@ class CP210xSerial:
                     delay = to.time_left()
                     if delay is None:
                         delay = 1000
-                    with buf.changed:
-                        buf.changed.wait(delay / 1000.0)
+                    buf.wait_readable(delay / 1000.0)
                 rlen = size - len(data)
                 chunk = buf.read(rlen)
                 data += chunk
@@ -778,42 +1657,28 @@ class CP210xSerial:
 
         Note that a unlimited size (-1/None) and a blocking timeout
         (None) may never return if the search pattern is never found!
+
+        Returns a memoryview into the RX buffer, valid until the next
+        read.
         """
         if not size or size <= 0:
             size = -1
 
-        # isinstance(expected, (tuple, list, array.array, bytes, bytearray))
-        try:
-            expected_last = expected[-1]
-        except:
-            # TypeError, IndexError
-            expected_last = expected
-
         buf = self._buf_in
         with Timeout(timeout) as to:
-            data = bytearray()
-            data += buf.read_until(expected, size)
-
-            # read in loop, blocking
-            while not to.expired() and data.find(expected) == -1:
-                if size > 0 and size <= len(data):
+            # the buffer only searches what arrived since the last time
+            while buf.find(expected) == -1:
+                if size > 0 and size <= len(buf):
                     break
+                if to.expired():
+                    break
+                # wait for more, delay
+                delay = to.time_left()
+                if delay is None:
+                    delay = DEFAUL_TIMEOUT
+                buf.wait_more(len(buf), delay / 1000.0)
 
-                if not buf:
-                    # wait for more, delay
-                    delay = to.time_left()
-                    if delay is None:
-                        delay = DEFAUL_TIMEOUT
-                    with buf.changed:
-                        buf.changed.wait(delay / 1000.0)
-                if size > 0:
-                    rlen = size - len(data)
-                else:
-                    rlen = size
-                chunk = buf.read_until(expected_last, rlen)
-                data += chunk
-
-        return data
+        return buf.read_until(expected, size)
 
     def read_until_or_none(self, expected=b"\n", size=None, timeout=None):
         """Read from RX buffer until chars found, return None if not found.
@@ -836,39 +1701,37 @@ class CP210xSerial:
 
         Note that a unlimited size (-1/None) and a blocking timeout
         (None) may never return if the search pattern is never found!
+
+        Returns a memoryview into the RX buffer like read_until().
         """
         if not size or size <= 0:
             size = -1
 
+        try:
+            elen = len(expected)
+        except TypeError:
+            elen = 1
+
         buf = self._buf_in
         with Timeout(timeout) as to:
-            while not to.expired() and not buf.contains(expected):
+            while True:
+                pos = buf.find(expected)
+                if pos != -1:
+                    # needle has to be in the size limit
+                    if size > 0 and pos + elen > size:
+                        return None
+                    return buf.read_until(expected, size)
                 # check if in size limit
                 if size > 0 and size < len(buf):
-                    break
+                    return None
+                if to.expired():
+                    return None
 
                 # wait for more, delay
                 delay = to.time_left()
                 if delay is None:
                     delay = DEFAUL_TIMEOUT
-                with buf.changed:
-                    buf.changed.wait(delay / 1000.0)
-
-        if not buf.contains(expected):
-            return None
-
-        # lock if parallel
-        with buf.lock:
-            # check if needle in size limit
-            if size > 0 and size < len(buf):
-                data_peek = buf.peek(size)
-                if -1 == data_peek.find(expected):
-                    return None
-
-            # needle should be in limit
-            data = bytearray()
-            data += buf.read_until(expected, size)
-            return data
+                buf.wait_more(len(buf), delay / 1000.0)
 
     def wait_on_read_buffer(self, duration):
         """Wait for RX buffer to contain data.
@@ -879,8 +1742,7 @@ class CP210xSerial:
         if self._buf_in:
             return True
 
-        with self._buf_in.changed:
-            return self._buf_in.changed.wait(duration)
+        return self._buf_in.wait_readable(duration)
 
     def wait_on_write_buffer(self, duration):
         """Wait for TX buffer to empty.
@@ -892,10 +1754,7 @@ class CP210xSerial:
         if not self._buf_out:
             return True
 
-        with self._buf_out.changed:
-            self._buf_out.changed.wait(duration)
-
-        return not self._buf_out
+        return self._buf_out.wait_empty(duration)
 
     def write(self, data):
         # TODO: check async
@@ -909,7 +1768,7 @@ class CP210xSerial:
 
     def read_sync_chunked(self, size):
         device = self._device
-        endp_in = CP210xSerial.get_endpoints(device)[0]
+        endp_in = self._endp_in
 
         if not size or size <= 0:
             return None
@@ -927,7 +1786,7 @@ class CP210xSerial:
 
     def write_sync_chunked(self, data):
         device = self._device
-        endp_out = CP210xSerial.get_endpoints(device)[1]
+        endp_out = self._endp_out
 
         if isinstance(data, int):
             data = bytearray([data])
@@ -951,7 +1810,7 @@ class CP210xSerial:
 
     def read_sync(self, size):
         device = self._device
-        endp_in = CP210xSerial.get_endpoints(device)[0]
+        endp_in = self._endp_in
 
         if not size or size <= 0:
             return None
@@ -961,7 +1820,7 @@ class CP210xSerial:
 
     def write_sync(self, data):
         device = self._device
-        endp_out = CP210xSerial.get_endpoints(device)[1]
+        endp_out = self._endp_out
 
         if isinstance(data, int):
             data = bytearray([data])
@@ -1042,14 +1901,22 @@ class CP210xSerial:
 
         # TODO: stop anyway and join?
 
-        endp_in, endp_out = CP210xSerial.get_endpoints(self.device)
+        endp_in, endp_out = self._endp_in, self._endp_out
 
         if start_in:
-            self._thrd_buf_in = SerialBufferReadThread(self, endp_in, self._buf_in)
+            self._thrd_buf_in = SerialBufferReadThread(
+                self,
+                endp_in,
+                self._buf_in,
+                transfer_size=self._transfer_size,
+                transfers=self._rx_transfers,
+            )
             self._thrd_buf_in.start()
 
         if start_out:
-            self._thrd_buf_out = SerialBufferWriteThread(self, endp_out, self._buf_out)
+            self._thrd_buf_out = SerialBufferWriteThread(
+                self, endp_out, self._buf_out, transfer_size=self._transfer_size
+            )
             self._thrd_buf_out.start()
 
     def _stop_threads_buffer_rw(self):
@@ -1121,7 +1988,7 @@ class CP210xSerial:
 
     def read_dump_forever(self):
         device = self._device
-        endp_in = CP210xSerial.get_endpoints(device)[0]
+        endp_in = self._endp_in
 
         while True:
             try: